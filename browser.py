@@ -106,11 +106,12 @@ class Browser:
             return meta_tags[0]['content']
         return None
 
-    def webpage_content(self, url: str, get_image: bool = True) -> tuple:
-        """ 访问网页，读取内容返回文本和一张图片 """
+    def webpage_content(self, url: str, get_image: bool = True, timeout: float = 30) -> tuple:
+        """ 访问网页，读取内容返回文本和一张图片. timeout 为页面载入超时(秒) """
+        self.driver.set_page_load_timeout(timeout)
         self.driver.get(url)
         # Wait for the page to load completely
-        self.wait_for_page_load()
+        self.wait_for_page_load(min(5, timeout))
 
         html_content = self.driver.page_source
 
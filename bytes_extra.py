@@ -0,0 +1,117 @@
+""" 解析微信数据库 MSG 表的 BytesExtra 字段 (protobuf 格式)
+
+结构:
+    1: {1: int, 2: int}                 消息属性
+    3: {1: int 类型, 2: string 值}      可重复, 类型见 ExtraType
+"""
+from enum import IntEnum
+
+
+class ExtraType(IntEnum):
+    """ BytesExtra 中 3 号字段记录的值类型 """
+    wxid = 1        # 群消息的发送者wxid
+    msg_source = 2  # 消息来源xml
+    thumb = 3       # 缩略图路径
+    path = 4        # 图片(.dat)、视频、文件路径
+
+
+# protobuf wire type
+_VARINT = 0
+_FIXED64 = 1
+_LEN = 2
+_FIXED32 = 5
+
+
+def read_varint(data:bytes, pos:int) -> tuple[int, int]:
+    """ 从 pos 读取一个 varint, 返回 (值, 下一个位置) """
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise ValueError("varint 不完整")
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+        if shift > 63:
+            raise ValueError("varint 过长")
+
+
+def iter_fields(data:bytes):
+    """ 逐个返回一层 protobuf 消息中的字段 (字段号, wire type, 值)
+    varint/fixed 类型的值为 int, 长度限定类型的值为 bytes (memoryview 切片, 不复制)
+    """
+    view = memoryview(data)
+    pos = 0
+    end = len(data)
+    while pos < end:
+        key, pos = read_varint(data, pos)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == _VARINT:
+            value, pos = read_varint(data, pos)
+        elif wire_type == _LEN:
+            length, pos = read_varint(data, pos)
+            if pos + length > end:
+                raise ValueError(f"字段 {field} 长度超出数据")
+            value = view[pos:pos + length]
+            pos += length
+        elif wire_type == _FIXED64:
+            if pos + 8 > end:
+                raise ValueError(f"字段 {field} 长度超出数据")
+            value = int.from_bytes(view[pos:pos + 8], "little")
+            pos += 8
+        elif wire_type == _FIXED32:
+            if pos + 4 > end:
+                raise ValueError(f"字段 {field} 长度超出数据")
+            value = int.from_bytes(view[pos:pos + 4], "little")
+            pos += 4
+        else:
+            raise ValueError(f"不支持的 wire type {wire_type}")
+        yield field, wire_type, value
+
+
+class BytesExtra:
+    """ 解析后的 BytesExtra """
+    __slots__ = ("values",)
+
+    def __init__(self, values:dict[int, str]) -> None:
+        """ 初始化
+        args:
+            values (dict): {类型: 值}, 类型见 ExtraType. 同一类型出现多次时保留第一个
+        """
+        self.values = values
+
+    @property
+    def wxid(self) -> str:
+        """ 群消息的发送者wxid """
+        return self.values.get(ExtraType.wxid)
+
+    @property
+    def thumb(self) -> str:
+        """ 缩略图路径 """
+        return self.values.get(ExtraType.thumb)
+
+    @property
+    def path(self) -> str:
+        """ 图片、视频或文件的路径 """
+        return self.values.get(ExtraType.path)
+
+
+def decode(data:bytes) -> BytesExtra:
+    """ 解析 BytesExtra. 数据格式错误时抛出 ValueError """
+    values = {}
+    for field, wire_type, value in iter_fields(data):
+        if field != 3 or wire_type != _LEN:
+            continue
+        extra_type = None
+        extra_value = None
+        for sub_field, sub_type, sub_value in iter_fields(value):
+            if sub_field == 1 and sub_type == _VARINT:
+                extra_type = sub_value
+            elif sub_field == 2 and sub_type == _LEN:
+                extra_value = sub_value
+        if extra_type is not None and extra_value is not None and extra_type not in values:
+            values[extra_type] = bytes(extra_value).decode("utf-8", errors="replace")
+    return BytesExtra(values)
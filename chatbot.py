@@ -1,13 +1,15 @@
 """ 微信机器人类。"""
+import asyncio
 import queue
-import re
-import os
+import pathlib
 import time
+import threading
 from typing import Tuple
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
-from wcferry import WxMsg
+from parsed_msg import ParsedMsg
 
 from wcf_wrapper import WcfWrapper
 import config
@@ -17,6 +19,31 @@ import openai_wrapper
 import preset
 from tools import toolbase
 import live_tools
+import dispatcher
+import routing
+import ratelimit
+import media
+
+
+class MsgTask:
+    """ 一条已完成预处理, 等待 AI 处理的消息 """
+    def __init__(self, receiver:str, at_list:str, text:str,
+        images:list[str], files:list[str], callback_msg:common.MSG_CALLBACK) -> None:
+        """ 初始化
+        args:
+            receiver (str): 回复对象 roomid 或 wxid
+            at_list (str): 回复时@的人
+            text (str): 发给 AI 的消息文本
+            images (list[str]): 图片文件列表
+            files (list[str]): 附件文件列表
+            callback_msg (MSG_CALLBACK): 回调函数, 发送 AI 返回的消息
+        """
+        self.receiver = receiver
+        self.at_list = at_list
+        self.text = text
+        self.images = images
+        self.files = files
+        self.callback_msg = callback_msg
 
 
 class Chatbot():
@@ -34,10 +61,20 @@ class Chatbot():
         self.wcfw = wcfw
         self.openai_wrapper = oaiw
         self.chat_presets:dict[str, preset.Preset] = {}     # 每个对话的预设 {roomid或wxid: 预设}
+        self._preset_lock = threading.Lock()                # 工作线程并发修改预设时加锁
+        self.routes = self._compile_routes()
+        self.rate_limiter = ratelimit.RateLimiter()
+
+        self._set_send_pacing()
+        self._set_prefetch()
+
+        # 临时文件清理
+        common.temp_storage().configure(self.config.temp_max_size * 2**20, self.config.temp_max_age * 3600)
+        common.temp_storage().start_sweeper()
 
         # 读取config中的对话预设
-        if self.config.group_presets:
-            for k,bili_rid in self.config.group_presets.items():
+        if self.routes.group_presets():
+            for k,bili_rid in self.routes.group_presets().items():
                 res = self.set_preset(k, bili_rid)
                 if res:
                     common.logger().info("加载群聊预设: %s,%s -> %s", k, self.wcfw.wxid_to_nickname(k), bili_rid)
@@ -47,45 +84,302 @@ class Chatbot():
         # 直播通知工具
         self.live_tools = live_tools.LiveMonitor(self.config.live_tools, self.wcfw)
 
+        # 消息接收线程
+        self._busy_replied:dict[str, float] = {}    # 每个对话上次回复忙碌提示的时间
+        self.receiver = dispatcher.MsgReceiver(self.wcfw, self.config.receive_queue_size,
+            self.config.dedup_window, self.config.dedup_size)
+        # 消息分发: 同一对话顺序处理, 不同对话并行处理
+        self.dispatcher = self._create_dispatcher()
+
+
 
+    def _set_send_pacing(self):
+        """ 根据配置设置发送间隔和重试 """
+        self.wcfw.sender.configure(self.config.send_interval, self.config.send_interval_global, self.config.send_retries)
+
+    def _set_prefetch(self):
+        """ 根据配置设置媒体预取 """
+        self.wcfw.prefetcher.configure(self.config.media_prefetch,
+            self.config.prefetch_queue_size, self.config.prefetch_cache_size,
+            int(self.config.prefetch_cache_mb * 1024 * 1024))
+
+    def _compile_routes(self) -> routing.RoutingTable:
+        """ 根据配置编译消息路由表 """
+        return routing.RoutingTable(self.config, self.wcfw.wxid_to_wxcode)
+
+    def _create_dispatcher(self) -> dispatcher.ChatDispatcher:
+        """ 创建消息分发器 """
+        d = dispatcher.ChatDispatcher(self.run_wxmsgs, self.config.concurrency,
+            coalesce_window=self.config.coalesce_window, max_batch=self.config.coalesce_max,
+            on_shed=self._on_shed_msg)
+        self._set_dispatch_limits(d)
+        common.logger().info("消息处理线程数: %d", d.max_workers)
+        return d
+
+    def _set_dispatch_limits(self, d:dispatcher.ChatDispatcher) -> None:
+        """ 根据配置设置分发器的过载保护和合并参数. 线程数/对话数上限只在创建时设置, 修改需要重启 """
+        try:
+            policy = dispatcher.OverloadPolicy[self.config.overload_policy]
+        except KeyError:
+            common.logger().warning("无效的过载策略 %s, 使用 drop_oldest", self.config.overload_policy)
+            policy = dispatcher.OverloadPolicy.drop_oldest
+        d.set_limits(self.config.max_pending_chat, self.config.max_pending_total,
+            policy, self.config.max_staleness)
+        d.set_coalesce(self.config.coalesce_window, self.config.coalesce_max)
+
+    def _on_shed_msg(self, chatid:str, msg:ParsedMsg, reason:dispatcher.ShedReason) -> None:
+        """ 过载保护丢弃消息时调用. reply_busy 策略下回复忙碌提示 (每个对话每分钟最多一次) """
+        common.logger().warning("过载保护: 丢弃消息(%s) 对话=%s, 消息id=%s", reason.name, chatid, msg.id)
+        if msg.rate_checked:    # 分发时已消耗限流令牌, 消息不会处理, 退还
+            self._refund_rate_limit(msg)
+        if reason != dispatcher.ShedReason.reply_busy or not self.config.busy_reply:
+            return
+        if msg.from_self() or (msg.from_group() and not self.routes.is_at_me(msg)):
+            return      # 只回复发给自己的消息
+        now = time.time()
+        if now - self._busy_replied.get(chatid, 0) < 60:
+            return
+        self._busy_replied[chatid] = now
+        at_list = msg.sender if msg.from_group() else ""
+        self.wcfw.queue_text(self.config.busy_reply, chatid, at_list)
+
+    def _prefetch(self, msg:ParsedMsg) -> None:
+        """ 开启 media_prefetch 时, 白名单对话的媒体消息交给预取器后台下载 """
+        if msg.type in media.MEDIA_TYPES:
+            if self.wcfw.prefetcher.enabled and self.routes.chat_allowed(msg):
+                self.wcfw.prefetcher.submit(msg)
+
+    def _dispatch(self, msg:ParsedMsg) -> None:
+        """ 把已通过 routes.may_respond 的消息交给分发器. 管理员命令优先处理, 不受过载保护限制
+        开启 preempt_runs 时, 新的@我/单聊消息或清除命令会取消该对话正在进行的 run.
+        只有通过前缀和限流检查、并被分发器接受的消息才会取消 run """
+        chatid = self.chat_id(msg)
+        cmd = self._admin_cmd_of(msg)
+        preempt = False
+        if self.config.preempt_runs and cmd is None and self._is_addressed(msg):
+            if not self._check_rate_limit(msg):     # 被限流的消息不会处理, 不取消 run
+                return
+            msg.rate_checked = True
+            preempt = True
+        if not self.dispatcher.submit(chatid, msg, cmd is not None):     # 被丢弃的消息在 _on_shed_msg 中退还限流令牌
+            return
+        if cmd == config.AdminCmd.clear_chat and self.config.preempt_runs:
+            self.openai_wrapper.request_cancel(chatid, "清除命令")
+        elif preempt:
+            self.openai_wrapper.request_cancel(chatid, "收到新消息")
+
+    def _is_addressed(self, msg:ParsedMsg) -> bool:
+        """ 消息是否是发给自己、并且会交给 AI 处理的 (单聊对方消息, 或群聊中@我/带触发前缀).
+        与 _filter_preprocess_wxmsg 的前缀和引用判断一致; 群聊语音不是发给自己的, 不算 """
+        if msg.from_self() or msg.type not in (1, 34, 49):
+            return False
+        if msg.type == 49 and msg.content_type != 57:   # type 49 只处理引用
+            return False
+        routes = self.routes
+        if msg.from_group():
+            if msg.type == 34:
+                return False
+            return routes.is_at_me(msg) or routes.group_route(msg.roomid).prefix.strip(msg.text.strip()) is not None
+        if not routes.single_prefix:
+            return True
+        return msg.type != 34 and routes.single_prefix.strip(msg.text.strip()) is not None
 
     def start_main_loop(self) -> None:
         """
         主循环, 接收并处理微信消息.
         该函数阻塞进程.
         """
-        while self.wcfw.wcf.is_receiving_msg():
+        self.receiver.start()
+        self._dispatch_loop()
+
+    def _dispatch_loop(self) -> None:
+        """ 从接收队列取出消息并分发, 直到接收线程停止且队列为空 """
+        while self.receiver.is_running() or self.receiver.backlog():
             try:
-                msg:WxMsg = self.wcfw.get_msg()
-                note = f"收到消息 {self.wcfw.msg_preview_str(msg)}"
-                common.logger().info(note)
+                msg:ParsedMsg = self.receiver.get(timeout=1)
             except queue.Empty:
-                time.sleep(0.001)
                 continue  # 无消息，继续
+
+            try:
+                self._prefetch(msg)
+                if not self.routes.may_respond(msg):    # 不响应的消息不生成预览 (可能需要RPC和XML解析), 只记录id
+                    common.logger().debug("忽略消息 id=%s, type=%s", msg.id, msg.type)
+                    continue
             except Exception as e:
-                common.logger().error("接收微信消息错误: %s", common.error_trace(e))
+                common.logger().error("路由消息错误:%s", common.error_trace(e))
+                continue
 
             try:
-                self.run_wxmsg(msg)
+                note = f"收到消息 {self.wcfw.msg_preview_str(msg)}"
+                common.logger().info(note)
+            except Exception as e:
+                common.logger().error("读取消息预览错误: %s", common.error_trace(e))
+
+            try:    # 交给工作线程处理, 不阻塞接收. 管理员命令不受过载保护限制
+                self._dispatch(msg)
             except Exception as e:
-                common.logger().error("处理消息错误:%s", common.error_trace(e))
+                common.logger().error("分发消息错误:%s", common.error_trace(e))
+
+    @staticmethod
+    def chat_id(msg:ParsedMsg) -> str:
+        """ 返回消息所属对话的id: 群聊为roomid, 单聊为发送者wxid """
+        if msg.from_group():
+            return msg.roomid
+        return msg.sender
 
 
-    def run_wxmsg(self, msg:WxMsg):
+    def run_wxmsg(self, msg:ParsedMsg):
         """ 读取并处理一条消息
 
         args:
-            msg (WxMsg): 消息对象. 群号: msg.roomid, 发送者微信ID: msg.sender, 消息内容: msg.content
+            msg (ParsedMsg): 消息对象. 群号: msg.roomid, 发送者微信ID: msg.sender, 消息内容: msg.content
+        """
+        self.run_wxmsgs([msg])
+
+    def run_wxmsgs(self, msgs:list[ParsedMsg]):
+        """ 读取并处理同一对话的一批消息. 需要 AI 处理的消息合并后调用一次 AI
+
+        args:
+            msgs (list[ParsedMsg]): 同一对话的消息列表, 按到达顺序
+        """
+
+        token = common.set_deadline(self._deadline_for(msgs), min(m.received for m in msgs))
+        try:
+            task = self._prepare_msgs(msgs)
+            if task is None:
+                return
+
+            try:
+                # 调用 OpenAI 运行消息 (阻塞直到全部消息处理结束). 期间附件不会被临时文件清理删除
+                with common.temp_storage().pinned(task.images + task.files):
+                    self.openai_wrapper.run_msg(task.receiver, task.text, task.images, task.files, task.callback_msg)
+
+            except common.DeadlineExceeded:
+                self._notify_timeout(task.receiver, task.at_list)
+            except Exception as e:
+                common.logger().error("响应消息时发生错误: %s", common.error_trace(e))
+                self.wcfw.queue_text(f"对不起, 响应该消息时发生错误: {common.error_info(e)}", task.receiver, task.at_list)
+        finally:
+            common.reset_deadline(token)
+
+    def _deadline_for(self, msgs:list[ParsedMsg]) -> float:
+        """ 返回处理这批消息的时限(秒), 按群聊/单聊配置. 0=不限
+        时限从这批消息中最早收到的消息开始计算, 包括在分发队列中等待的时间 """
+        if msgs and msgs[0].from_group():
+            return self.config.group_deadline
+        return self.config.single_deadline
+
+
+    def _prepare_msgs(self, msgs:list[ParsedMsg]) -> MsgTask:
+        """ 预处理一批消息, 并把需要 AI 处理的消息合并为一个任务
+
+        args:
+            msgs (list[ParsedMsg]): 同一对话的消息列表
+        returns:
+            MsgTask: 合并后的任务. 没有需要 AI 处理的消息时返回 None
+        """
+        tasks:list[MsgTask] = []
+        for msg in msgs:
+            try:
+                task = self._prepare_msg(msg)
+            except common.DeadlineExceeded:     # 预处理 (如语音转录) 超时: 这批消息都已超时, 通知发送者后放弃
+                at_ids = [t.at_list for t in tasks]
+                if msg.from_group() and not msg.from_self():
+                    at_ids.append(msg.sender)
+                self._notify_timeout(self.chat_id(msg), ",".join(dict.fromkeys(a for a in at_ids if a)))
+                return None
+            except Exception as e:
+                common.logger().error("预处理消息错误: %s", common.error_trace(e))
+                continue
+            if task:
+                tasks.append(task)
+
+        if not tasks:
+            return None
+        if len(tasks) == 1:
+            return tasks[0]
+
+        # 合并: 文本按顺序拼接, 附件合并, 回复时@所有发送者
+        at_ids = []
+        for t in tasks:
+            for wxid in t.at_list.split(","):
+                if wxid and wxid not in at_ids:
+                    at_ids.append(wxid)
+        receiver = tasks[0].receiver
+        at_list = ",".join(at_ids)
+        text = "\n".join(t.text for t in tasks)
+        images = [f for t in tasks for f in t.images]
+        files = [f for t in tasks for f in t.files]
+        common.logger().info("合并 %d 条消息, 一次调用AI处理 (%s)", len(tasks), receiver)
+        return MsgTask(receiver, at_list, text, images, files, self._reply_callback(receiver, at_list))
+
+    def _notify_timeout(self, receiver:str, at_list:str):
+        """ 记录超时, 并告知发送者消息已取消 """
+        common.logger().warning("处理对话 %s 的消息超时", receiver)
+        self.wcfw.queue_text("对不起, 处理该消息超时, 已取消", receiver, at_list)
+
+    def _reply_callback(self, receiver:str, at_list:str) -> common.MSG_CALLBACK:
+        """ 返回回调函数, 用于发送 AI 返回的消息 """
+        def callback_msg(msg:ChatMsg) -> int:
+            self.wcfw.queue_message(msg, receiver, at_list)    # 交给发送线程, 不等待发送完成
+            return 0
+        return callback_msg
+
+    def _check_rate_limit(self, msg:ParsedMsg) -> bool:
+        """ 群消息限流检查, 每个成员和每个群各有令牌桶. 管理员和自己的消息不受限制
+
+        returns:
+            bool: True=允许处理, False=被限流
+        """
+        limits = self._rate_limits(msg)
+        if not limits:
+            return True
+        if self.rate_limiter.allow(limits):
+            return True
+
+        sender_key = limits[0][0]
+        common.logger().warning("限流: 忽略消息 群=%s, 发送者=%s (累计 %d 条)",
+            msg.roomid, msg.sender, self.rate_limiter.throttled)
+        if self.config.slow_down_reply and self.rate_limiter.first_notice(sender_key):
+            self.wcfw.queue_text(self.config.slow_down_reply, msg.roomid, msg.sender)
+        return False
+
+    def _rate_limits(self, msg:ParsedMsg) -> list:
+        """ 返回消息适用的限流 [(key, 每分钟次数)], 成员在前. 不受限制时返回空列表 """
+        if not msg.from_group() or msg.from_self():
+            return []
+        route = self.routes.group_route(msg.roomid)
+        if not route.sender_rate and not route.room_rate:
+            return []
+        if self.wcfw.wxid_to_wxcode(msg.sender) in self.config.admins:
+            return []
+        return [((msg.roomid, msg.sender), route.sender_rate), (msg.roomid, route.room_rate)]
+
+    def _refund_rate_limit(self, msg:ParsedMsg) -> None:
+        """ 退还消息通过限流时消耗的令牌 """
+        limits = self._rate_limits(msg)
+        if limits:
+            self.rate_limiter.refund(limits)
+
+    def _prepare_msg(self, msg:ParsedMsg) -> MsgTask:
+        """ 过滤消息, 处理管理员命令, 构造需要 AI 处理的消息和附件
+
+        args:
+            msg (ParsedMsg): 消息对象
+        returns:
+            MsgTask: 待 AI 处理的任务. 无需 AI 处理 (忽略, 已处理的命令, 出错) 时返回 None
         """
 
         content = self._filter_preprocess_wxmsg(msg)
         if content is None:
-            return
+            return None
+        if not msg.rate_checked and not self._check_rate_limit(msg):
+            return None
 
         # 确定回复对象
         if msg.from_group():
             receiver = msg.roomid
-            nickname = self.wcfw.wcf.get_chatroom_members(msg.roomid).get(msg.sender, "")
+            nickname = self.wcfw.room_members.member_name(msg.roomid, msg.sender)
 
             if msg.from_self():
                 at_list = ""
@@ -104,8 +398,8 @@ class Chatbot():
                     self.process_admin_cmd(content, receiver, at_list)
                 except Exception as e:
                     common.logger().error("执行管理员命令错误: %s",common.error_trace(e))
-                    self.wcfw.send_text(f"执行管理员命令'{content}'发生错误", receiver, at_list)
-                return
+                    self.wcfw.queue_text(f"执行管理员命令'{content}'发生错误", receiver, at_list)
+                return None
 
         # 根据预设加上格式
         preset = self.chat_presets.get(receiver, self.config.default_preset)
@@ -117,8 +411,7 @@ class Chatbot():
 
         ### 调用 AI 处理消息
         # 回调函数, 处理 AI 返回消息
-        def callback_msg(msg:ChatMsg) -> int:
-            return self.wcfw.send_message(msg, receiver, at_list)
+        callback_msg = self._reply_callback(receiver, at_list)
 
         try:
             # 获取引用消息及附件
@@ -148,117 +441,114 @@ class Chatbot():
                         # self.openai_wrapper.run_video_msg(receiver, text, refer_msg.content, callback_msg)
                     case ContentType.ERROR:
                         # 处理错误
-                        self.wcfw.send_text("获取引用内容发生错误", receiver, at_list)
-                        return
+                        self.wcfw.queue_text("获取引用内容发生错误", receiver, at_list)
+                        return None
                     case _:
                         # 其他
                         # tp == WxMsgType.UNSUPPORTED
-                        self.wcfw.send_text("抱歉, 不支持引用这类消息", receiver, at_list)
-                        return
-
-            # 调用 OpenAI 运行消息 (阻塞直到全部消息处理结束)
-            self.openai_wrapper.run_msg(receiver, text, images, files, callback_msg)
+                        self.wcfw.queue_text("抱歉, 不支持引用这类消息", receiver, at_list)
+                        return None
 
+        except common.DeadlineExceeded:
+            raise
         except Exception as e:
             common.logger().error("响应消息时发生错误: %s", common.error_trace(e))
-            self.wcfw.send_text(f"对不起, 响应该消息时发生错误: {common.error_info(e)}", receiver, at_list)
+            self.wcfw.queue_text(f"对不起, 响应该消息时发生错误: {common.error_info(e)}", receiver, at_list)
+            return None
 
+        return MsgTask(receiver, at_list, text, images, files, callback_msg)
 
-    def _filter_preprocess_wxmsg(self, msg:WxMsg) -> str:
+    def _filter_preprocess_wxmsg(self, msg:ParsedMsg) -> str:
         """ 判断是否响应这条消息
         如果响应, 返回消息原文(去掉前缀)
         如果忽略, 返回None
+        先查路由表过滤, 不需要响应的消息不做XML解析和RPC调用
         """
 
         # 过滤消息类型
-        if msg.type == 1:           # 文本
-            pass
-        elif msg.type == 34:        # 语音
-            pass
-        elif msg.type == 49:        # 引用/文件/链接？ 进一步看content type
-            ct = self.wcfw.get_content_type(msg)
-            if ct == 57:            # 引用
-                pass
-            else:
-                return None
-        else:
+        if msg.type not in (1, 34, 49):     # 文本, 语音, 引用/文件/链接
             return None
 
         # return None
         def voice_msg_trans(msgid:str):
             ''' 转录语音消息，得到文字'''
-            audiofile = self.wcfw.wcf.get_audio_msg(msgid, common.temp_dir())
+            audiofile = self.wcfw.get_audio(msgid)
             text = self.openai_wrapper.audio_trans(audiofile)
             common.logger().info("语音消息转录得到文字：%s", text)
             return text
 
-        # 过滤消息内容
-        text_msg = self.wcfw.get_msg_text(msg).strip()
+        def is_quote(msg:ParsedMsg) -> bool:
+            ''' type 49 消息中只处理引用 (content type 57)'''
+            return msg.content_type == 57
+
+        routes = self.routes
         if msg.from_group():    #群聊消息
             # 白名单过滤
-            if "$all" in self.config.group_whitelist:
-                pass
-            else:
-                if msg.roomid not in self.config.group_whitelist:
-                    return None
+            route = routes.group_route(msg.roomid)
+            if not route.enabled:
+                return None
 
             # 群组语音消息
             if msg.type == 34:
-                if self.config.group_voice_msg:
+                if route.voice_msg:
                     return voice_msg_trans(msg.id)
                 else:
                     return None
 
+            if msg.type == 49 and not is_quote(msg):
+                return None
+            text_msg = msg.text.strip()
+
             # 群组中来自自己的消息, 如果有prefix开头, 去掉prefix; 否则忽略
             if msg.from_self() :
-                for p in self.config.self_prefix:
-                    if text_msg.startswith(p):
-                        text_msg = text_msg.removeprefix(p).strip()
-                        return text_msg
-                return None
+                return routes.self_prefix.strip(text_msg)
 
             # @我的消息, 处理
-            if self.wcfw.is_msg_at_me(msg):
+            if routes.is_at_me(msg):
                 #去掉@前缀, 获得消息正文
-                # 正则匹配: @开头 + 任意字符 + \u2005(1/4空格)或任意空白或结尾
-                text_msg = re.sub(r"@.*?([\u2005\s]|$)", "", text_msg).strip()
-                return text_msg
-            else:   # 其他情况, 忽略
-                return None
+                return routing.AT_PATTERN.sub("", text_msg).strip()
+
+            # 群单独设置的触发前缀
+            return route.prefix.strip(text_msg)
 
         else:   #单聊消息
             # 微信号白名单过滤
-            wxcode = self.wcfw.wxid_to_wxcode(msg.sender)
-            if "$all" in self.config.single_chat_whitelist:
-                pass
-            else:
-                if wxcode in self.config.single_chat_whitelist:
-                    pass
-                else:
-                    return None
+            if not routes.single_allowed(msg.sender):
+                return None
+
+            if msg.type == 49 and not is_quote(msg):
+                return None
+            text_msg = msg.text.strip()
 
             #来自自己的消息, 如果有prefix开头, 去掉prefix; 否则忽略
             if msg.from_self() :
-                for p in self.config.self_prefix:
-                    if text_msg.startswith(p):
-                        text_msg = text_msg.removeprefix(p).strip()
-                        return text_msg
-                return None
+                return routes.self_prefix.strip(text_msg)
 
             # 来自对方消息:
-            if not self.config.single_chat_prefix:  # 未定义前缀: 响应所有
+            if not routes.single_prefix:  # 未定义前缀: 响应所有
                 if msg.type == 34:  # 语音
                     return voice_msg_trans(msg.id)
                 else:
                     return text_msg
-            else:
-                for p in self.config.single_chat_prefix:    # 已定义前缀: 只响应前缀开头的消息
+            else:   # 已定义前缀: 只响应前缀开头的消息
+                return routes.single_prefix.strip(text_msg)
 
-                    if text_msg.startswith(p):
-                        return text_msg.removeprefix(p).strip()
-                    return None
-
-        return None
+    def _admin_cmd_of(self, msg:ParsedMsg) -> config.AdminCmd:
+        """ 在分发前快速判断消息是否是管理员命令, 不做完整的消息过滤
+        returns:
+            AdminCmd: 命令枚举类型. 不是管理员命令返回None
+        """
+        if msg.type != 1:
+            return None
+        text = routing.AT_PATTERN.sub("", msg.content).strip()    # 去掉@
+        for p in self.config.self_prefix + self.config.single_chat_prefix:
+            text = text.removeprefix(p).strip()
+        cmd = self._match_admin_cmd(text)
+        if not cmd:
+            return None
+        if self.wcfw.wxid_to_wxcode(msg.sender) not in self.config.admins:
+            return None
+        return cmd[1]
 
     def _match_admin_cmd(self, content:str) -> Tuple[str, config.AdminCmd]:
         """
@@ -299,10 +589,20 @@ class Chatbot():
             log_msg = "显示帮助信息"
             wx_msg = self.help_msg(receiver)
         elif cmd_enum == config.AdminCmd.reload_config:    # 重新加载config
+            pool_sizes = (self.config.concurrency, self.config.async_max_chats)
             self.config.load_config()
+            restart_note = ""
+            if (self.config.concurrency, self.config.async_max_chats) != pool_sizes:
+                restart_note = "\nconcurrency/async_max_chats 已修改, 需要重启程序才能生效"
+                common.logger().warning(restart_note.strip())
             self.openai_wrapper.load_config()
+            self._set_dispatch_limits(self.dispatcher)
+            self.routes = self._compile_routes()
+            self._set_send_pacing()
+            self._set_prefetch()
+            common.temp_storage().configure(self.config.temp_max_size * 2**20, self.config.temp_max_age * 3600)
             log_msg = "已完成命令:重新加载配置"
-            wx_msg = log_msg
+            wx_msg = log_msg + restart_note
         elif cmd_enum == config.AdminCmd.clear_chat:       # 清除记忆
             self.openai_wrapper.clear_chat_thread(receiver)
             log_msg = "已完成命令: 清除当前对话记忆"
@@ -317,8 +617,9 @@ class Chatbot():
             wx_msg = log_msg
 
         elif cmd_enum == config.AdminCmd.reset_preset:   # 为当前对话重置预设
-            self.chat_presets.pop(receiver, None)
-            self.openai_wrapper.clear_chat_prompt(receiver) #删除对应的对话预设
+            with self._preset_lock:
+                self.chat_presets.pop(receiver, None)
+                self.openai_wrapper.clear_chat_prompt(receiver) #删除对应的对话预设
             log_msg = "已完成重置预设"
             wx_msg = log_msg
         elif cmd_enum == config.AdminCmd.list_preset:  # 预设列表
@@ -327,6 +628,9 @@ class Chatbot():
         elif cmd_enum == config.AdminCmd.chat_id:  # 显示当前对话的id
             log_msg = f"当前对话id: {receiver}"
             wx_msg = log_msg
+        elif cmd_enum == config.AdminCmd.status:  # 显示运行状态
+            log_msg = "显示运行状态"
+            wx_msg = self.status_msg()
         elif cmd_enum == config.AdminCmd.test_msg:  # 发送测试卡片消息
             log_msg = "发送测试卡片消息"
             self.wcfw.send_test_msg(receiver)
@@ -337,7 +641,7 @@ class Chatbot():
         if log_msg:
             common.logger().info(log_msg)
         if wx_msg:
-            self.wcfw.send_text(wx_msg, receiver, at_list)
+            self.wcfw.queue_text(wx_msg, receiver, at_list)
         return True
 
     def set_preset(self, chatid:str, pr_name:str) -> bool:
@@ -352,8 +656,9 @@ class Chatbot():
         if not pr:
             return False
 
-        self.chat_presets[chatid] = pr
-        self.openai_wrapper.set_chat_prompt(chatid, pr.sys_prompt)
+        with self._preset_lock:
+            self.chat_presets[chatid] = pr
+            self.openai_wrapper.set_chat_prompt(chatid, pr.sys_prompt)
         return True
 
     def help_msg(self, chatid:str) -> str:
@@ -380,6 +685,42 @@ class Chatbot():
         text = '\n'.join(msgs)
         return text
 
+    def status_msg(self) -> str:
+        """ 返回运行状态统计文本 """
+        msgs = []
+        msgs.append("\n# 运行状态")
+        msgs.append(f"已接收消息: {self.receiver.received}")
+        msgs.append(f"重复消息: {self.receiver.duplicates()}")
+        msgs.append(f"接收速率: {self.receiver.rate():.1f} 条/分钟")
+        msgs.append(f"接收队列积压: {self.receiver.backlog()} (最大 {self.receiver.max_backlog})")
+        msgs.append(f"等待处理消息: {self.dispatcher.pending_count()}")
+        msgs.append(f"处理中对话: {self.dispatcher.active_count()}/{self.dispatcher.max_workers}")
+        msgs.append(f"已处理批次: {self.dispatcher.batches} (合并消息 {self.dispatcher.coalesced} 条)")
+        shed = ", ".join(f"{r.name}={n}" for r, n in self.dispatcher.shed_counts.items())
+        msgs.append(f"过载丢弃消息: {shed}")
+        msgs.append(f"限流忽略消息: {self.rate_limiter.throttled}")
+        msgs.append(f"取消运行: {self.openai_wrapper.runs_cancelled}")
+        p = self.openai_wrapper.poller
+        msgs.append(f"运行状态查询: 进行中 {p.active()}, 累计 {p.polls} 次, 平均每个run {p.avg_polls():.1f} 次, 最多 {p.max_polls} 次")
+        c = self.wcfw.contacts
+        msgs.append(f"联系人缓存: {len(c)} 个 (命中 {c.hits}, 未命中 {c.misses}, 刷新 {c.refreshes} 次)")
+        r = self.wcfw.room_members
+        msgs.append(f"群成员缓存: 命中 {r.hits}, 未命中 {r.misses}")
+        m = self.wcfw.recent_msgs
+        msgs.append(f"最近消息缓存: {len(m)} 条, {m.nbytes()/2**20:.1f} MB (命中 {m.hits}, 未命中 {m.misses})")
+        s = self.wcfw.sender
+        msgs.append(f"发送队列: {s.depth()} (最大 {s.max_depth}), 已发送 {s.sent}, 失败 {s.failed}, 重试 {s.retried}")
+        msgs.append(f"发送耗时: 平均 {s.avg_latency():.2f}秒, 最大 {s.max_latency:.2f}秒")
+        p = self.wcfw.prefetcher
+        if p.enabled:
+            msgs.append(f"媒体预取: 已下载 {p.prefetched}, 缓存 {len(p)} ({p.cached_bytes/1024/1024:.1f}MB), 排队 {p.backlog()}, 丢弃 {p.dropped}, 引用命中 {p.hits}, 未命中 {p.misses}")
+        msgs.append("## WCF 调用")
+        msgs.extend(self.wcfw.wcf.stats())
+        t = common.temp_storage()
+        msgs.append(f"临时文件清理: {t.removed} 个, {t.freed/2**20:.1f} MB")
+        text = '\n'.join(msgs)
+        return text
+
     def preprocess_video(self, video_file:str) -> tuple[str, list]:
         """ 预处理视频文件, 返回指示文本和图片列表
         args:
@@ -417,10 +758,11 @@ class Chatbot():
                 raise RuntimeError("Unable to read frame")
         cap.release()
 
-        # 在video_file同一目录，把每个frame写到临时文件，命名为 video_file_0.jpg, video_file_1.jpg, ...
+        # 把每个frame写到临时文件，命名为 视频文件名_frame_0_xxx.jpg, ...
         image_files = []
+        video_name = pathlib.Path(video_file).stem
         for i, frame in enumerate(frames):
-            image_file = f"{os.path.splitext(video_file)[0]}_frame_{i}.jpg"
+            image_file = common.unique_temp_file(f"{video_name}_frame_{i}", ".jpg")
             cv2.imwrite(image_file, frame)
             image_files.append(image_file)
 
@@ -430,6 +772,82 @@ class Chatbot():
 
         return instructions, image_files
 
+
+class AsyncChatbot(Chatbot):
+    """ asyncio 版本的机器人。
+    所有对话的 AI 调用作为协程在同一个事件循环中运行, 可以同时处理大量对话而不占用线程;
+    wcferry 调用、消息预处理等阻塞操作交给线程池执行。
+    消息的接收和分发在专用线程中进行, 路由检查中的联系人查询不阻塞事件循环。
+    """
+
+    openai_wrapper:openai_wrapper.AsyncOpenAIWrapper
+
+    def _create_dispatcher(self) -> dispatcher.AsyncChatDispatcher:
+        """ 创建协程消息分发器 """
+        d = dispatcher.AsyncChatDispatcher(self.run_wxmsgs, self.config.async_max_chats,
+            coalesce_window=self.config.coalesce_window, max_batch=self.config.coalesce_max,
+            on_shed=self._on_shed_msg)
+        self._set_dispatch_limits(d)
+        common.logger().info("最多同时处理对话数: %d, 阻塞调用线程数: %d", d.max_workers, self.config.concurrency)
+        return d
+
+    def start_main_loop(self) -> None:
+        """
+        主循环, 接收并处理微信消息.
+        该函数阻塞进程.
+        """
+        asyncio.run(self._main_loop())
+
+    async def _main_loop(self) -> None:
+        """ 运行事件循环, 等待分发线程结束. 分发器的 submit 通过 call_soon_threadsafe 在事件循环中创建任务 """
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(self.config.concurrency, thread_name_prefix="blocking"))  # 阻塞调用线程池
+        self.dispatcher.start(loop)
+        self.receiver.start()
+        finished = loop.create_future()
+
+        def dispatch_thread():
+            try:
+                self._dispatch_loop()
+            finally:
+                loop.call_soon_threadsafe(finished.set_result, None)
+
+        threading.Thread(target=dispatch_thread, name="msg_dispatch", daemon=True).start()
+        await finished
+
+    async def run_wxmsg(self, msg:ParsedMsg):
+        """ 读取并处理一条消息
+
+        args:
+            msg (ParsedMsg): 消息对象
+        """
+        await self.run_wxmsgs([msg])
+
+    async def run_wxmsgs(self, msgs:list[ParsedMsg]):
+        """ 读取并处理同一对话的一批消息. 预处理在线程池执行, AI 处理在事件循环中执行
+
+        args:
+            msgs (list[ParsedMsg]): 同一对话的消息列表, 按到达顺序
+        """
+        token = common.set_deadline(self._deadline_for(msgs), min(m.received for m in msgs))
+        try:
+            task = await asyncio.to_thread(self._prepare_msgs, msgs)
+            if task is None:
+                return
+
+            try:
+                with common.temp_storage().pinned(task.images + task.files):
+                    await self.openai_wrapper.run_msg(task.receiver, task.text, task.images, task.files, task.callback_msg)
+
+            except common.DeadlineExceeded:
+                self._notify_timeout(task.receiver, task.at_list)
+            except Exception as e:
+                common.logger().error("响应消息时发生错误: %s", common.error_trace(e))
+                self.wcfw.queue_text(f"对不起, 响应该消息时发生错误: {common.error_info(e)}", task.receiver, task.at_list)
+        finally:
+            common.reset_deadline(token)
+
+
 # 测试
 if __name__ == "__main__":
     pass
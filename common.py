@@ -1,5 +1,11 @@
 """ 常量和公共函数"""
 import logging
+import contextvars
+import contextlib
+import os
+import threading
+import time
+import uuid
 from typing import Callable
 import requests
 import pathlib
@@ -14,6 +20,7 @@ FILE_CONFIG_LOGGING = 'config_logging.yaml'
 TEMP_DIR = 'temp'
 LOGGING_DIR = 'logs'
 PRESET_DIR = 'presets'
+DATA_DIR = 'data'
 class ContentType(Enum):
     """ 表示用微信发送的消息的类型"""
     text = 1        # 文字
@@ -62,9 +69,252 @@ def get_path(folder:str) -> pathlib.Path:
         full_path.mkdir(parents=True, exist_ok=True)
     return full_path
 
+class DeadlineExceeded(Exception):
+    """ 处理消息超过了截止时间 """
+    def __init__(self, msg:str="处理超时") -> None:
+        super().__init__(msg)
+
+_deadline:contextvars.ContextVar[float] = contextvars.ContextVar("deadline", default=None)
+""" 当前处理的消息的截止时间 (time.monotonic). 每个线程/协程各自独立, asyncio.to_thread 会继承 """
+
+def set_deadline(seconds:float, start:float=None) -> contextvars.Token:
+    """ 为当前线程(协程)设置处理截止时间. seconds 为 0 或 None 表示不限时
+
+    Args:
+        seconds (float): 时限(秒)
+        start (float): 计时起点 (time.monotonic), 默认为当前时间
+
+    Returns:
+        Token: 用于 reset_deadline 恢复
+    """
+    if start is None:
+        start = time.monotonic()
+    deadline = start + seconds if seconds else None
+    return _deadline.set(deadline)
+
+def reset_deadline(token:contextvars.Token):
+    """ 恢复 set_deadline 之前的截止时间 """
+    _deadline.reset(token)
+
+def time_left() -> float:
+    """ 返回距截止时间的剩余秒数, 未设置截止时间返回None """
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+def check_deadline():
+    """ 已超过截止时间时抛出 DeadlineExceeded """
+    left = time_left()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded()
+
+def timeout_for(default:float) -> float:
+    """ 返回一次调用可用的超时时间: 默认超时和剩余时间中较小的. 已超时抛出 DeadlineExceeded """
+    left = time_left()
+    if left is None:
+        return default
+    if left <= 0:
+        raise DeadlineExceeded()
+    return min(default, left)
+
 def temp_file(name:str) -> str:
-    """ 返回临时文件名 """
-    return str((get_path(TEMP_DIR) / name).resolve())
+    """ 返回临时文件名, 并记录到临时文件索引 """
+    path = str((get_path(TEMP_DIR) / name).resolve())
+    register_temp_file(path)
+    return path
+
+_temp_index:dict[str, str] = None       # 临时文件索引 {文件主名(第一个.之前): 路径}
+_temp_index_lock = threading.Lock()
+
+def _temp_stem(name:str) -> str:
+    """ 返回文件主名: 第一个.之前的部分 """
+    return name.split('.', 1)[0]
+
+def _get_temp_index() -> dict[str, str]:
+    """ 返回临时文件索引, 第一次调用时扫描临时文件夹建立索引 """
+    global _temp_index
+    if _temp_index is None:
+        with _temp_index_lock:
+            if _temp_index is None:
+                index = {}
+                for file in get_path(TEMP_DIR).iterdir():
+                    if file.is_file():
+                        index.setdefault(_temp_stem(file.name), str(file.resolve()))
+                _temp_index = index
+    return _temp_index
+
+def register_temp_file(path:str):
+    """ 把写入临时文件夹的文件记录到索引. 不在临时文件夹中的文件忽略 """
+    if not path:
+        return
+    p = pathlib.Path(path).resolve()
+    if p.parent != get_path(TEMP_DIR).resolve():
+        return
+    _get_temp_index()[_temp_stem(p.name)] = str(p)
+
+def find_temp_file(stem:str) -> str:
+    """ 按文件主名(第一个.之前的部分)查找临时文件, 返回路径. 不存在返回None
+    索引中的文件可能尚未写入或已被删除, 查到时再确认文件存在 """
+    path = _get_temp_index().get(stem)
+    if path is None or not pathlib.Path(path).is_file():
+        return None
+    _temp_storage.touch(path)
+    return path
+
+def unregister_temp_file(path:str):
+    """ 删除临时文件后, 从索引中移除 """
+    p = pathlib.Path(path)
+    index = _get_temp_index()
+    stem = _temp_stem(p.name)
+    if index.get(stem) == str(p.resolve()):
+        index.pop(stem, None)
+
+def unique_temp_file(prefix:str, suffix:str) -> str:
+    """ 返回不重复的临时文件名: 前缀_时间戳_随机串后缀. 并发调用不会得到相同文件名
+
+    Args:
+        prefix (str): 文件名前缀, 例如 "tts"
+        suffix (str): 扩展名, 例如 ".mp3"
+    """
+    return temp_file(f"{prefix}_{timestamp()}_{uuid.uuid4().hex[:8]}{suffix}")
+
+
+class TempStorage:
+    """ 临时文件夹管理: 限制总大小和文件保留时间。
+    按最近使用时间(mtime)淘汰文件, 正在使用(pin)的文件不会被删除。
+    后台线程定期清理。
+    """
+
+    def __init__(self, folder:str) -> None:
+        """ 初始化
+
+        Args:
+            folder (str): 临时文件夹名
+        """
+        self.folder = folder
+        self.max_bytes = 0          # 总大小上限(字节), 0=不限
+        self.max_age = 0            # 文件保留时间(秒), 0=不限
+        self.interval = 600         # 清理间隔(秒)
+        self.removed = 0            # 已删除文件数
+        self.freed = 0              # 已释放字节数
+        self._pinned:dict[str, int] = {}    # 正在使用的文件 {路径: 引用数}
+        self._lock = threading.Lock()
+        self._thread:threading.Thread = None
+        self._stop_event = threading.Event()
+
+    def configure(self, max_bytes:int, max_age:float, interval:float=600):
+        """ 设置总大小上限(字节), 文件保留时间(秒) 和清理间隔(秒). 0=不限 """
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.interval = interval
+
+    def start_sweeper(self):
+        """ 启动后台清理线程 """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._sweep_loop, name="temp_sweeper", daemon=True)
+        self._thread.start()
+
+    def stop_sweeper(self):
+        """ 停止后台清理线程 """
+        self._stop_event.set()
+
+    def _sweep_loop(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                logger().error("清理临时文件错误: %s", error_trace(e))
+
+    @contextlib.contextmanager
+    def pinned(self, files:list[str]):
+        """ 上下文管理器: 期间文件不会被清理 """
+        self.pin(files)
+        try:
+            yield
+        finally:
+            self.unpin(files)
+
+    def pin(self, files:list[str]):
+        """ 标记文件正在使用, 在 unpin 之前不会被清理. 可以重复 pin, 需要同样次数的 unpin """
+        keys = [str(pathlib.Path(f).resolve()) for f in files or [] if f]
+        with self._lock:
+            for k in keys:
+                self._pinned[k] = self._pinned.get(k, 0) + 1
+
+    def unpin(self, files:list[str]):
+        """ 取消一次 pin """
+        keys = [str(pathlib.Path(f).resolve()) for f in files or [] if f]
+        with self._lock:
+            for k in keys:
+                n = self._pinned.get(k, 0) - 1
+                if n > 0:
+                    self._pinned[k] = n
+                else:
+                    self._pinned.pop(k, None)
+
+    def touch(self, path:str):
+        """ 更新文件的最近使用时间 """
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def sweep(self) -> tuple[int, int]:
+        """ 清理一次: 删除超过保留时间的文件, 然后按最近使用时间删除最旧的文件直到总大小低于上限
+
+        Returns:
+            (int, int): (删除文件数, 释放字节数)
+        """
+        files = []      # [(mtime, size, path)]
+        total = 0
+        for f in get_path(self.folder).iterdir():
+            try:
+                st = f.stat()
+            except OSError:
+                continue
+            if f.is_file():
+                files.append((st.st_mtime, st.st_size, str(f.resolve())))
+                total += st.st_size
+        files.sort()    # 最旧的在前
+
+        removed = 0
+        freed = 0
+        expire = time.time() - self.max_age if self.max_age else None
+        for mtime, size, path in files:
+            over_age = expire is not None and mtime < expire
+            over_size = self.max_bytes and total > self.max_bytes
+            if not over_age and not over_size:
+                break       # 之后的文件更新, 总大小也已低于上限
+            with self._lock:
+                if path in self._pinned:
+                    continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            unregister_temp_file(path)
+            total -= size
+            removed += 1
+            freed += size
+
+        if removed:
+            self.removed += removed
+            self.freed += freed
+            logger().info("清理临时文件 %d 个, 释放 %.1f MB, 剩余 %.1f MB", removed, freed/2**20, total/2**20)
+        return removed, freed
+
+_temp_storage = TempStorage(TEMP_DIR)
+
+def temp_storage() -> TempStorage:
+    """ 返回临时文件夹管理对象 """
+    return _temp_storage
+
+def data_file(name:str) -> str:
+    """ 返回数据文件名 (保存运行中产生的需要长期保留的数据) """
+    return str((get_path(DATA_DIR) / name).resolve())
 
 def temp_dir() -> str:
     """ 返回临时文件夹 """
@@ -86,13 +336,15 @@ def download_file(url:str, filename:str, proxy:str = None) -> int:
         proxies = {"http": proxy, "https": proxy}
     else:
         proxies = None
+    timeout = timeout_for(60)
 
     try:
-        response = requests.get(url, proxies=proxies)
+        response = requests.get(url, proxies=proxies, timeout=timeout)
         if response.status_code == 200:
             with open(filename, "wb") as file:
                 file.write(response.content)
-                return 0
+            register_temp_file(filename)
+            return 0
         else:
             return 1
     except requests.exceptions.RequestException as e:
@@ -16,6 +16,7 @@ class AdminCmd(Enum):
     list_preset = auto()
     chat_id = auto()
     test_msg = auto()
+    status = auto()
 
     @property
     def description(self):
@@ -29,6 +30,7 @@ class AdminCmd(Enum):
             AdminCmd.list_preset: "列出当前可用预设",
             AdminCmd.chat_id: "显示当前对话(群聊或单聊)的id",
             AdminCmd.test_msg: "发送测试卡片消息",
+            AdminCmd.status: "显示运行状态统计",
         }
         return texts.get(self, "")
 
@@ -116,6 +118,35 @@ class Config(object):
         self.single_chat_prefix = self.BOT.get('single_chat_prefix', [])
         self.accept_friend:bool = self.BOT.get('accpet_friend', False)
         self.group_presets:dict = self.BOT.get('group_presets', {})
+        self.group_overrides:dict = self.BOT.get('group_overrides', {})
+        self.group_rate_limits:dict = self.BOT.get('group_rate_limits', {})
+        self.sender_rate_limit:float = self.BOT.get('sender_rate_limit', 0)
+        self.room_rate_limit:float = self.BOT.get('room_rate_limit', 0)
+        self.slow_down_reply:str = self.BOT.get('slow_down_reply', "")
+        self.concurrency:int = self.BOT.get('concurrency', 4)     # 工作线程数. 重新载入配置不改变已创建的线程池
+        self.receive_queue_size:int = self.BOT.get('receive_queue_size', 1000)
+        self.dedup_window:float = self.BOT.get('dedup_window', 600)
+        self.dedup_size:int = self.BOT.get('dedup_size', 10000)
+        self.async_max_chats:int = self.BOT.get('async_max_chats', 200)     # 重新载入配置不改变, 需要重启
+        self.coalesce_window:float = self.BOT.get('coalesce_window', 0)
+        self.coalesce_max:int = self.BOT.get('coalesce_max', 10)
+        self.max_pending_chat:int = self.BOT.get('max_pending_chat', 20)
+        self.max_pending_total:int = self.BOT.get('max_pending_total', 500)
+        self.overload_policy:str = self.BOT.get('overload_policy', 'drop_oldest')
+        self.max_staleness:float = self.BOT.get('max_staleness', 600)
+        self.busy_reply:str = self.BOT.get('busy_reply', "消息太多, 请稍后再试")
+        self.preempt_runs:bool = self.BOT.get('preempt_runs', False)
+        self.single_deadline:float = self.BOT.get('single_deadline', 300)
+        self.group_deadline:float = self.BOT.get('group_deadline', 180)
+        self.temp_max_size:float = self.BOT.get('temp_max_size', 1024)     # MB
+        self.temp_max_age:float = self.BOT.get('temp_max_age', 72)         # 小时
+        self.send_interval:float = self.BOT.get('send_interval', 1.0)
+        self.send_interval_global:float = self.BOT.get('send_interval_global', 0.2)
+        self.send_retries:int = self.BOT.get('send_retries', 2)
+        self.media_prefetch:bool = self.BOT.get('media_prefetch', False)
+        self.prefetch_queue_size:int = self.BOT.get('prefetch_queue_size', 100)
+        self.prefetch_cache_size:int = self.BOT.get('prefetch_cache_size', 500)
+        self.prefetch_cache_mb:float = self.BOT.get('prefetch_cache_mb', 200)    # MB
 
         self.default_preset:preset.Preset = preset.get_default_preset()
 
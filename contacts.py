@@ -0,0 +1,302 @@
+""" 联系人缓存: 减少通过 RPC 读取整个联系人列表的次数 """
+import json
+import pathlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable
+
+import common
+
+
+class Contact:
+    """ 一个联系人, 只包含用到的字段 """
+    __slots__ = ("wxid", "code", "name")
+
+    def __init__(self, wxid:str, code:str, name:str) -> None:
+        self.wxid = wxid
+        self.code = code    # 微信号
+        self.name = name    # 昵称
+
+
+class ContactTable:
+    """ 紧凑的联系人表: wxid -> 行号的索引, 加上按行存放的微信号和昵称两个并行列表。
+    只保留用到的字段, 不为每个联系人保存 dict; 查询时才创建 Contact 对象。
+
+    合成的 5 万联系人账号 (每个联系人有 wcferry 返回的 8 个字段) 用 tracemalloc 测得:
+    - {wxid: contact_dict}: 约 33.0 MB
+    - ContactTable: 约 13.3 MB
+    - ContactTable + sys.intern 所有字符串: 约 17.0 MB. wxid 和昵称几乎都不重复, intern 表反而增加内存, 因此不使用
+    """
+    __slots__ = ("_index", "_codes", "_names")
+
+    def __init__(self, wxids:list[str], codes:list[str], names:list[str]) -> None:
+        """ 初始化. 三个列表按行对应 """
+        self._index = {w: i for i, w in enumerate(wxids)}
+        self._codes = [c or "" for c in codes]
+        self._names = [n or "" for n in names]
+
+    @classmethod
+    def from_contacts(cls, contact_list:list[dict]) -> "ContactTable":
+        """ 由 wcferry 的联系人列表 [contact_dict] 创建 """
+        return cls([c['wxid'] for c in contact_list],
+            [c.get('code') for c in contact_list], [c.get('name') for c in contact_list])
+
+    def get(self, wxid:str) -> Contact:
+        """ 返回联系人, 找不到返回 None """
+        i = self._index.get(wxid)
+        if i is None:
+            return None
+        return Contact(wxid, self._codes[i], self._names[i])
+
+    def __contains__(self, wxid:str) -> bool:
+        return wxid in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def to_json(self) -> dict:
+        """ 返回按列保存的数据, 用于快照 """
+        return {'wxid': list(self._index), 'code': self._codes, 'name': self._names}
+
+    @classmethod
+    def from_json(cls, data) -> "ContactTable":
+        """ 由快照数据创建. 兼容旧的 [contact_dict] 格式 """
+        if isinstance(data, list):
+            return cls.from_contacts(data)
+        return cls(data['wxid'], data['code'], data['name'])
+
+
+class ContactCache:
+    """ 联系人缓存 {wxid: Contact}, 保存在紧凑的 ContactTable 中
+    - 启动时优先读取硬盘快照, 不阻塞在 get_contacts 上; 之后在后台刷新
+    - 缓存超过 TTL 后, 下一次查询触发后台刷新, 期间继续返回旧数据
+    - 查不到的 wxid 可能是新联系人: 触发后台刷新, 最多等待 MISS_WAIT 秒。刷新完成仍查不到 (如非好友的群成员)
+      才记入否定缓存, 在 NEGATIVE_TTL 内不再为它刷新; 等待超时返回 None 但不记入否定缓存, 刷新完成后即可查到
+    - 同一时间只有一次刷新 (single-flight), 其他等待刷新的线程共用结果
+    """
+
+    TTL = 3600              # 联系人列表过期时间(秒)
+    NEGATIVE_TTL = 600      # 否定缓存过期时间(秒)
+    MIN_REFRESH_INTERVAL = 30   # 因未命中触发刷新的最短间隔(秒)
+    MISS_WAIT = 3           # 未命中时最多等待刷新的时间(秒)
+    NEGATIVE_PRUNE_SIZE = 1000  # 否定缓存超过该数量时清理过期记录
+
+    def __init__(self, loader:Callable[[], list[dict]], snapshot_file:str=None) -> None:
+        """ 初始化
+
+        Args:
+            loader (Callable): 读取完整联系人列表的函数, 返回 [contact_dict]
+            snapshot_file (str): 硬盘快照文件. None=不使用快照
+        """
+        self.loader = loader
+        self.snapshot_file = snapshot_file
+        self.hits = 0           # 命中次数
+        self.misses = 0         # 未命中次数 (含否定缓存命中)
+        self.refreshes = 0      # 刷新次数
+        self._contacts = ContactTable([], [], [])
+        self._negative:dict[str, float] = {}       # {wxid: 过期时间}
+        self._loaded_at = 0.0                       # 上次刷新成功时间 (time.monotonic)
+        self._attempted_at = 0.0                    # 上次开始刷新时间 (time.monotonic)
+        self._lock = threading.Lock()
+        self._refreshing:threading.Event = None     # 正在进行的刷新, 完成时 set
+
+    def start(self):
+        """ 载入联系人. 有快照时读取快照并在后台刷新, 否则阻塞读取 """
+        if self._load_snapshot():
+            self.refresh_async()
+        else:
+            self.refresh()
+
+    def get(self, wxid:str) -> Contact:
+        """ 返回 wxid 对应的联系人, 找不到返回 None """
+        contact = self._contacts.get(wxid)
+        if contact is not None:
+            self.hits += 1
+            if time.monotonic() - self._loaded_at > self.TTL:
+                self.refresh_async()
+            return contact
+
+        self.misses += 1
+        now = time.monotonic()
+        if self._negative.get(wxid, 0) > now:
+            return None
+        if now - self._attempted_at > self.MIN_REFRESH_INTERVAL:
+            if not self.refresh_async().wait(self.MISS_WAIT):   # 可能是新联系人, 重新读取
+                return None
+        contact = self._contacts.get(wxid)
+        if contact is None:
+            self._add_negative(wxid)
+        return contact
+
+    def _add_negative(self, wxid:str):
+        """ 记入否定缓存. 记录较多时先清理过期的记录 """
+        now = time.monotonic()
+        with self._lock:
+            if len(self._negative) >= self.NEGATIVE_PRUNE_SIZE:
+                self._prune_negative(now)
+            self._negative[wxid] = now + self.NEGATIVE_TTL
+
+    def _prune_negative(self, now:float, table:ContactTable=None):
+        """ 删除过期的否定缓存记录, 以及已在联系人表 table 中的记录. 需要在锁内调用 """
+        for k in [k for k, v in self._negative.items() if v <= now or (table is not None and k in table)]:
+            del self._negative[k]
+
+    def refresh(self):
+        """ 重新读取联系人列表. 已有刷新在进行时, 等待其完成 """
+        with self._lock:
+            event = self._refreshing
+            if event is None:
+                event = self._refreshing = threading.Event()
+                leader = True
+            else:
+                leader = False
+
+        if not leader:
+            event.wait()
+            return
+        self._refresh(event)
+
+    def refresh_async(self) -> threading.Event:
+        """ 在后台线程刷新联系人. 已有刷新在进行时不重复刷新. 返回刷新完成时 set 的 Event """
+        with self._lock:
+            if self._refreshing is not None:
+                return self._refreshing
+            event = self._refreshing = threading.Event()
+        threading.Thread(target=self._refresh, args=(event,), name="contact_refresh", daemon=True).start()
+        return event
+
+    def _refresh(self, event:threading.Event):
+        """ 执行一次刷新, 完成后 set event """
+        try:
+            self._attempted_at = time.monotonic()
+            table = ContactTable.from_contacts(self.loader())   # 在新表中建立, 完成后整体替换, 查询不受影响
+            self._contacts = table
+            with self._lock:
+                self._prune_negative(time.monotonic(), table)
+            self._loaded_at = time.monotonic()
+            self.refreshes += 1
+            common.logger().info("读取联系人 %d 个", len(table))
+            self._save_snapshot(table)
+        except Exception as e:
+            common.logger().error("读取联系人失败: %s", common.error_trace(e))
+        finally:
+            with self._lock:
+                self._refreshing = None
+            event.set()
+
+    def invalidate(self, wxid:str=None):
+        """ 清除否定缓存, 使下次查询重新读取. wxid=None 清除全部 """
+        with self._lock:
+            if wxid is None:
+                self._negative.clear()
+            else:
+                self._negative.pop(wxid, None)
+
+    def __len__(self) -> int:
+        return len(self._contacts)
+
+    def _load_snapshot(self) -> bool:
+        """ 从硬盘快照载入联系人, 返回是否成功 """
+        if not self.snapshot_file or not pathlib.Path(self.snapshot_file).exists():
+            return False
+        try:
+            with open(self.snapshot_file, "r", encoding="utf-8") as f:
+                self._contacts = ContactTable.from_json(json.load(f))
+            common.logger().info("从快照载入联系人 %d 个", len(self._contacts))
+            return True
+        except Exception as e:
+            common.logger().warning("读取联系人快照失败: %s", e)
+            return False
+
+    def _save_snapshot(self, table:ContactTable):
+        """ 保存联系人快照到硬盘. 先写临时文件再替换, 避免写入中断损坏快照 """
+        if not self.snapshot_file:
+            return
+        try:
+            tmp_file = pathlib.Path(self.snapshot_file + ".tmp")
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(table.to_json(), f, ensure_ascii=False)
+            tmp_file.replace(self.snapshot_file)
+        except Exception as e:
+            common.logger().warning("保存联系人快照失败: %s", e)
+
+
+class RoomMemberCache:
+    """ 群成员和群内昵称缓存
+    - 群成员列表 {wxid: 昵称} 按群缓存, 超过 TTL 后重新读取
+    - 查询的成员不在缓存中时 (如新入群), 重新读取该群成员, 每群最多每 MIN_RELOAD_INTERVAL 秒一次
+    - 群内昵称按 (群, wxid) 缓存, 超过 TTL 后重新读取; 最多缓存 ALIAS_CACHE_SIZE 个, 超出时淘汰最久未使用的
+    """
+
+    TTL = 600                   # 缓存过期时间(秒)
+    MIN_RELOAD_INTERVAL = 30    # 因成员缺失重新读取群成员的最短间隔(秒)
+    ALIAS_CACHE_SIZE = 5000     # 群内昵称最多缓存数
+
+    def __init__(self, members_loader:Callable[[str], dict], alias_loader:Callable[[str, str], str]) -> None:
+        """ 初始化
+
+        Args:
+            members_loader (Callable): 读取群成员的函数 (roomid) -> {wxid: 昵称}
+            alias_loader (Callable): 读取群内昵称的函数 (wxid, roomid) -> 群内昵称
+        """
+        self.members_loader = members_loader
+        self.alias_loader = alias_loader
+        self.hits = 0
+        self.misses = 0
+        self._members:dict[str, tuple[dict, float]] = {}        # {roomid: ({wxid: 昵称}, 读取时间)}
+        self._aliases:OrderedDict[tuple[str, str], tuple[str, float]] = OrderedDict()  # {(roomid, wxid): (群内昵称, 读取时间)}, LRU 顺序
+        self._aliases_lock = threading.Lock()
+
+    def members(self, roomid:str) -> dict:
+        """ 返回群成员 {wxid: 昵称} """
+        cached = self._members.get(roomid)
+        if cached and time.monotonic() - cached[1] < self.TTL:
+            self.hits += 1
+            return cached[0]
+        self.misses += 1
+        return self._load(roomid)
+
+    def member_name(self, roomid:str, wxid:str) -> str:
+        """ 返回群成员的昵称, 找不到返回空字符串 """
+        members = self.members(roomid)
+        if wxid in members:
+            return members[wxid]
+
+        # 成员不在缓存中, 可能是新成员: 重新读取
+        loaded_at = self._members.get(roomid, ({}, 0))[1]
+        if time.monotonic() - loaded_at > self.MIN_RELOAD_INTERVAL:
+            self.misses += 1
+            members = self._load(roomid)
+        return members.get(wxid, "")
+
+    def alias(self, roomid:str, wxid:str) -> str:
+        """ 返回成员的群内昵称 """
+        key = (roomid, wxid)
+        with self._aliases_lock:
+            cached = self._aliases.get(key)
+            if cached and time.monotonic() - cached[1] < self.TTL:
+                self._aliases.move_to_end(key)
+                self.hits += 1
+                return cached[0]
+        self.misses += 1
+        alias = self.alias_loader(wxid, roomid)
+        with self._aliases_lock:
+            self._aliases[key] = (alias, time.monotonic())
+            self._aliases.move_to_end(key)
+            while len(self._aliases) > self.ALIAS_CACHE_SIZE:
+                self._aliases.popitem(last=False)
+        return alias
+
+    def invalidate(self, roomid:str):
+        """ 清除一个群的缓存 """
+        self._members.pop(roomid, None)
+        with self._aliases_lock:
+            for key in [k for k in self._aliases if k[0] == roomid]:
+                del self._aliases[key]
+
+    def _load(self, roomid:str) -> dict:
+        """ 读取群成员并缓存 """
+        members = self.members_loader(roomid) or {}
+        self._members[roomid] = (members, time.monotonic())
+        return members
@@ -0,0 +1,464 @@
+""" 消息接收与分发: 接收线程收取消息, 按对话分组在有限的工作线程池中并发处理 """
+import asyncio
+import heapq
+import queue
+import threading
+import time
+from collections import deque
+from enum import Enum, auto
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable
+
+from parsed_msg import ParsedMsg
+
+import common
+from wcf_wrapper import WcfWrapper
+
+
+class SeenFilter:
+    """ 已见消息id过滤器, 用于丢弃重复投递的消息。
+    按到达顺序记录最近的消息id, 超过时间窗口或容量上限的最早记录被淘汰, 内存有界。
+    """
+
+    def __init__(self, window:float=600, maxsize:int=10000) -> None:
+        """ 初始化
+
+        Args:
+            window (float): 记录保留时间(秒)
+            maxsize (int): 最多记录的消息id数
+        """
+        self.window = window
+        self.maxsize = max(1, int(maxsize))
+        self.hits = 0                               # 过滤掉的重复消息数
+        self._ring:deque[tuple[float, Any]] = deque()   # (到达时间, 消息id), 按到达顺序
+        self._seen:dict[Any, float] = {}            # {消息id: 到达时间}
+
+    def seen(self, msgid:Any) -> bool:
+        """ 检查并记录消息id. 若在窗口内已见过返回True, 否则记录并返回False """
+        now = time.monotonic()
+        self._expire(now)
+        if msgid in self._seen:
+            self.hits += 1
+            return True
+        self._seen[msgid] = now
+        self._ring.append((now, msgid))
+        if len(self._ring) > self.maxsize:
+            self._expire(now)
+        return False
+
+    def _expire(self, now:float) -> None:
+        """ 淘汰过期和超出容量的记录 """
+        ring = self._ring
+        while ring and (len(ring) > self.maxsize or ring[0][0] < now - self.window):
+            t, msgid = ring.popleft()
+            if self._seen.get(msgid) == t:
+                del self._seen[msgid]
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+
+class MsgReceiver:
+    """ 消息接收线程。
+    阻塞等待 WechatFerry 的新消息, 放入内部有界队列, 与消息处理分离。
+    队列满时接收线程阻塞, 新消息暂存在 wcferry 的接收队列中, 不会丢失。
+    """
+
+    RATE_WINDOW = 60    # 统计接收速率的时间窗口(秒)
+
+    def __init__(self, wcfw:WcfWrapper, maxsize:int=1000, dedup_window:float=600, dedup_size:int=10000) -> None:
+        """ 初始化
+
+        Args:
+            wcfw (WcfWrapper): 微信接口
+            maxsize (int): 内部队列容量
+            dedup_window (float): 重复消息过滤的时间窗口(秒). 0=不过滤
+            dedup_size (int): 重复消息过滤最多记录的消息id数
+        """
+        self.wcfw = wcfw
+        self.queue:queue.Queue[ParsedMsg] = queue.Queue(maxsize)
+        self.dedup = SeenFilter(dedup_window, dedup_size) if dedup_window > 0 else None
+        self.received = 0                           # 收到消息总数
+        self.max_backlog = 0                        # 队列最大积压
+        self._recv_times:deque[float] = deque(maxlen=10000)    # 最近收到消息的时间, 用于计算速率
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="msg_receiver", daemon=True)
+
+    def start(self) -> None:
+        """ 启动接收线程 """
+        self._thread.start()
+
+    def stop(self) -> None:
+        """ 停止接收线程 """
+        self._stop_event.set()
+
+    def is_running(self) -> bool:
+        """ 接收线程是否在运行 """
+        return self._thread.is_alive()
+
+    def _run(self) -> None:
+        """ 接收循环. wcfw.get_msg 无消息时阻塞等待, 超时抛出 queue.Empty """
+        while not self._stop_event.is_set() and self.wcfw.wcf.is_receiving_msg():
+            try:
+                msg = self.wcfw.get_msg()
+            except queue.Empty:
+                continue
+            except Exception as e:
+                common.logger().error("接收微信消息错误: %s", common.error_trace(e))
+                self._stop_event.wait(1)
+                continue
+
+            if self.dedup is not None and self.dedup.seen(msg.id):
+                common.logger().warning("丢弃重复消息 id=%s (累计 %d 条)", msg.id, self.dedup.hits)
+                continue
+
+            self.received += 1
+            self._recv_times.append(time.time())
+            self.queue.put(msg)
+            self.max_backlog = max(self.max_backlog, self.queue.qsize())
+
+    def get(self, timeout:float=None) -> ParsedMsg:
+        """ 取出一条消息. 超时无消息抛出 queue.Empty """
+        return self.queue.get(timeout=timeout)
+
+    def backlog(self) -> int:
+        """ 返回队列中等待分发的消息数 """
+        return self.queue.qsize()
+
+    def duplicates(self) -> int:
+        """ 返回过滤掉的重复消息数 """
+        return self.dedup.hits if self.dedup is not None else 0
+
+    def rate(self) -> float:
+        """ 返回最近 RATE_WINDOW 秒内的接收速率 (条/分钟) """
+        since = time.time() - self.RATE_WINDOW
+        count = 0
+        for t in reversed(self._recv_times):
+            if t < since:
+                break
+            count += 1
+        return count * 60 / self.RATE_WINDOW
+
+
+class OverloadPolicy(Enum):
+    """ 队列满时的处理策略 """
+    drop_oldest = auto()    # 丢弃最早的等待消息, 接受新消息
+    drop_newest = auto()    # 丢弃新消息
+    reply_busy = auto()     # 丢弃新消息, 并回复忙碌提示
+
+
+class ShedReason(Enum):
+    """ 消息被丢弃的原因 """
+    drop_oldest = auto()    # 队列满, 丢弃最早的消息
+    drop_newest = auto()    # 队列满, 丢弃新消息
+    reply_busy = auto()     # 队列满, 丢弃新消息并回复忙碌
+    stale = auto()          # 等待时间超过上限
+
+
+class _Pending:
+    """ 队列中等待处理的消息 """
+    __slots__ = ("item", "arrival", "priority")
+
+    def __init__(self, item:Any, priority:bool) -> None:
+        self.item = item
+        self.arrival = time.monotonic()
+        self.priority = priority
+
+
+class ChatDispatcher:
+    """ 按对话(群聊roomid 或 单聊wxid)分发消息到工作线程池.
+    同一对话的消息严格按到达顺序处理; 不同对话的消息并行处理, 并发数不超过 max_workers。
+    同一对话在处理期间新到的消息会排队, 下次一起取出作为一批交给 handler (合并消息)。
+    过载保护: 每个对话和全局的等待消息数有上限, 超出时按 policy 丢弃消息; 等待过久的消息在取出时丢弃。
+    优先消息(如管理员命令)不受过载保护限制, 并排在对话队列最前。
+    """
+
+    def __init__(self, handler:Callable[[list], None], max_workers:int=4,
+        coalesce_window:float=0, max_batch:int=1,
+        max_pending_chat:int=0, max_pending_total:int=0,
+        policy:OverloadPolicy=OverloadPolicy.drop_oldest, max_staleness:float=0,
+        on_shed:Callable[[str, Any, ShedReason], None]=None) -> None:
+        """ 初始化
+
+        Args:
+            handler (Callable): 处理一批消息的函数, 在工作线程中调用. 参数为同一对话的消息列表
+            max_workers (int): 工作线程数, 即最多同时处理的对话数
+            coalesce_window (float): 合并窗口(秒). 对话最后一条消息到达后等待该时间, 再取出一批处理
+            max_batch (int): 每批最多取出的消息数. 1=不合并
+            max_pending_chat (int): 每个对话最多等待的消息数. 0=不限
+            max_pending_total (int): 所有对话最多等待的消息总数. 0=不限
+            policy (OverloadPolicy): 超出上限时的处理策略
+            max_staleness (float): 消息最长等待时间(秒), 超过则在取出时丢弃. 0=不限
+            on_shed (Callable): 消息被丢弃时的回调 (chatid, item, 原因), 在锁外调用
+        """
+        self.handler = handler
+        self.max_workers = max(1, int(max_workers))
+        self.coalesce_window = max(0.0, float(coalesce_window))
+        self.max_batch = max(1, int(max_batch))
+        self.set_limits(max_pending_chat, max_pending_total, policy, max_staleness)
+        self.on_shed = on_shed
+        self.shed_counts:dict[ShedReason, int] = {r:0 for r in ShedReason}  # 丢弃消息计数
+        self._total = 0                         # 所有对话等待的消息总数
+        self._lock = threading.Lock()
+        self._pending:dict[str, deque[_Pending]] = {}     # 每个对话等待处理的消息 {chatid: deque}
+        self._active:set[str] = set()           # 已交给线程池处理的对话
+        self._last_arrival:dict[str, float] = {}    # 每个对话最后一条消息的到达时间
+        self.batches = 0                        # 已处理的批次数
+        self.coalesced = 0                      # 被合并进其他消息的消息数
+        self._timers:list[tuple[float, str]] = []   # 等待合并窗口结束的对话 (到期时间, chatid)
+        self._timer_cond = threading.Condition()
+        self._timer_thread:threading.Thread = None
+        self._executor = self._create_executor()
+
+    def set_limits(self, max_pending_chat:int, max_pending_total:int,
+        policy:OverloadPolicy, max_staleness:float) -> None:
+        """ 设置过载保护参数, 参数说明见 __init__ """
+        self.max_pending_chat = max(0, int(max_pending_chat))
+        self.max_pending_total = max(0, int(max_pending_total))
+        self.policy = policy
+        self.max_staleness = max(0.0, float(max_staleness))
+
+    def set_coalesce(self, coalesce_window:float, max_batch:int) -> None:
+        """ 设置合并参数, 参数说明见 __init__. 对之后取出的批次生效 """
+        self.coalesce_window = max(0.0, float(coalesce_window))
+        self.max_batch = max(1, int(max_batch))
+
+    def _create_executor(self) -> ThreadPoolExecutor:
+        """ 创建工作线程池 """
+        return ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="chat_worker")
+
+    def submit(self, chatid:str, item:Any, priority:bool=False) -> bool:
+        """ 提交一条消息, 加入对应对话的队列
+
+        Args:
+            chatid (str): 对话id (roomid 或 wxid)
+            item (Any): 消息, 将传给 handler
+            priority (bool): 优先消息. 不受过载保护限制, 排在对话队列最前
+
+        Returns:
+            bool: 是否接受该消息. 过载被丢弃时返回 False
+        """
+        shed = []   # 被丢弃的消息 [(chatid, item, reason)]
+        with self._lock:
+            accepted = priority or self._admit(chatid, item, shed)
+            if accepted:
+                q = self._pending.setdefault(chatid, deque())
+                if priority:
+                    q.appendleft(_Pending(item, True))
+                else:
+                    q.append(_Pending(item, False))
+                self._total += 1
+                self._last_arrival[chatid] = time.monotonic()
+                schedule = chatid not in self._active   # 对话正在处理中时, 处理完当前消息后会继续取出
+                self._active.add(chatid)
+            else:
+                schedule = False
+
+        self._notify_shed(shed)
+        if schedule:
+            self._schedule(chatid)
+        return accepted
+
+    def _admit(self, chatid:str, item:Any, shed:list) -> bool:
+        """ 检查队列上限, 按策略决定是否接受新消息. 需要在锁内调用
+        被丢弃的消息加入 shed 列表 """
+        q = self._pending.get(chatid)
+        chat_full = bool(self.max_pending_chat) and q is not None and len(q) >= self.max_pending_chat
+        total_full = bool(self.max_pending_total) and self._total >= self.max_pending_total
+        if not chat_full and not total_full:
+            return True
+
+        if self.policy == OverloadPolicy.drop_oldest:
+            # 对话队列满时丢弃本对话最早的消息; 否则丢弃全局最早的消息
+            victim_chat = chatid if chat_full else self._oldest_chat()
+            if victim_chat is not None and self._drop_oldest(victim_chat, shed):
+                return True
+            # 只有优先消息, 无法腾出位置: 丢弃新消息
+
+        reason = ShedReason.reply_busy if self.policy == OverloadPolicy.reply_busy else ShedReason.drop_newest
+        shed.append((chatid, item, reason))
+        return False
+
+    def _oldest_chat(self) -> str:
+        """ 返回队首消息最早的对话id. 需要在锁内调用 """
+        oldest = None
+        oldest_time = None
+        for chatid, q in self._pending.items():
+            for p in q:
+                if not p.priority:
+                    if oldest_time is None or p.arrival < oldest_time:
+                        oldest, oldest_time = chatid, p.arrival
+                    break
+        return oldest
+
+    def _drop_oldest(self, chatid:str, shed:list) -> bool:
+        """ 丢弃对话中最早的非优先消息. 需要在锁内调用. 返回是否成功丢弃 """
+        q = self._pending[chatid]
+        for p in q:
+            if not p.priority:
+                q.remove(p)
+                self._total -= 1
+                shed.append((chatid, p.item, ShedReason.drop_oldest))
+                return True
+        return False
+
+    def _notify_shed(self, shed:list) -> None:
+        """ 记录被丢弃的消息并调用回调 """
+        for chatid, item, reason in shed:
+            self.shed_counts[reason] += 1
+            if self.on_shed:
+                try:
+                    self.on_shed(chatid, item, reason)
+                except Exception as e:
+                    common.logger().error("处理丢弃消息错误: %s", common.error_trace(e))
+
+    def _schedule(self, chatid:str) -> None:
+        """ 把对话交给线程池处理 """
+        self._executor.submit(self._run_chat, chatid)
+
+    def _schedule_later(self, chatid:str, delay:float) -> None:
+        """ delay 秒后再把对话交给线程池. 由一个计时线程统一调度 """
+        with self._timer_cond:
+            if self._timer_thread is None:
+                self._timer_thread = threading.Thread(target=self._timer_loop, name="coalesce_timer", daemon=True)
+                self._timer_thread.start()
+            heapq.heappush(self._timers, (time.monotonic() + delay, chatid))
+            self._timer_cond.notify()
+
+    def _timer_loop(self) -> None:
+        """ 计时循环: 对话的合并窗口结束时交给线程池 """
+        while True:
+            with self._timer_cond:
+                while not self._timers or self._timers[0][0] > time.monotonic():
+                    self._timer_cond.wait(self._timers[0][0] - time.monotonic() if self._timers else None)
+                _, chatid = heapq.heappop(self._timers)
+            try:
+                self._schedule(chatid)
+            except Exception as e:  # 线程池已关闭
+                common.logger().error("调度对话 %s 错误: %s", chatid, common.error_trace(e))
+
+    def _run_chat(self, chatid:str) -> None:
+        """ 在工作线程中处理对话的一批消息。
+        每次只处理一批, 之后对话重新排队, 避免消息多的对话长期占用工作线程 """
+        delay = self._coalesce_delay(chatid)
+        if delay > 0:   # 合并窗口未结束: 窗口结束时再调度, 等待期间不占用工作线程
+            self._schedule_later(chatid, delay)
+            return
+
+        batch = self._next(chatid)
+        if batch:
+            try:
+                self.handler(batch)
+            except Exception as e:
+                common.logger().error("处理对话 %s 的消息错误: %s", chatid, common.error_trace(e))
+        self._finish(chatid)
+
+    def _coalesce_delay(self, chatid:str) -> float:
+        """ 返回距离合并窗口结束的剩余时间(秒) """
+        if self.coalesce_window <= 0 or self.max_batch <= 1:
+            return 0
+        with self._lock:
+            if len(self._pending[chatid]) >= self.max_batch:
+                return 0
+            elapsed = time.monotonic() - self._last_arrival[chatid]
+        return self.coalesce_window - elapsed
+
+    def _next(self, chatid:str) -> list:
+        """ 取出对话的下一批消息. 丢弃等待时间超过上限的消息. 可能返回空列表 """
+        shed = []
+        with self._lock:
+            q = self._pending[chatid]
+            now = time.monotonic()
+            batch = []
+            while q and len(batch) < self.max_batch:
+                p = q.popleft()
+                self._total -= 1
+                if self.max_staleness and not p.priority and now - p.arrival > self.max_staleness:
+                    shed.append((chatid, p.item, ShedReason.stale))
+                else:
+                    batch.append(p.item)
+            if batch:
+                self.batches += 1
+                self.coalesced += len(batch) - 1
+
+        self._notify_shed(shed)
+        return batch
+
+    def _finish(self, chatid:str) -> None:
+        """ 处理完一批消息后, 若对话还有消息则重新排队, 否则标记为空闲 """
+        with self._lock:
+            if self._pending[chatid]:
+                reschedule = True
+            else:   # 对话已无待处理消息
+                del self._pending[chatid]
+                self._last_arrival.pop(chatid, None)
+                self._active.discard(chatid)
+                reschedule = False
+        if reschedule:
+            self._schedule(chatid)
+
+    def pending_count(self) -> int:
+        """ 返回所有对话等待处理的消息总数 """
+        return self._total
+
+    def active_count(self) -> int:
+        """ 返回正在处理的对话数 """
+        with self._lock:
+            return len(self._active)
+
+    def shutdown(self, wait:bool=True) -> None:
+        """ 停止线程池 """
+        self._executor.shutdown(wait=wait)
+
+
+class AsyncChatDispatcher(ChatDispatcher):
+    """ asyncio 版本的对话分发器。
+    每个有消息的对话对应事件循环中的一个任务, 同一对话顺序处理;
+    同时运行的对话数不超过 max_workers。submit 可以在任意线程调用。
+    """
+
+    def __init__(self, handler:Callable[[list], Awaitable[None]], max_workers:int=200, **kwargs) -> None:
+        """ 初始化. 参数同 ChatDispatcher, handler 为协程函数, max_workers 为最多同时处理的对话数 """
+        super().__init__(handler, max_workers, **kwargs)
+        self._loop:asyncio.AbstractEventLoop = None
+        self._semaphore:asyncio.Semaphore = None
+        self._tasks:set[asyncio.Task] = set()     # 保持任务引用, 避免被回收
+
+    def _create_executor(self) -> None:
+        """ 不使用线程池 """
+        return None
+
+    def start(self, loop:asyncio.AbstractEventLoop) -> None:
+        """ 绑定事件循环. 需要在事件循环中调用 """
+        self._loop = loop
+        self._semaphore = asyncio.Semaphore(self.max_workers)
+
+    def _schedule(self, chatid:str) -> None:
+        """ 在事件循环中创建对话的处理任务 """
+        self._loop.call_soon_threadsafe(self._create_task, chatid)
+
+    def _create_task(self, chatid:str) -> None:
+        task = self._loop.create_task(self._run_chat(chatid))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_chat(self, chatid:str) -> None:
+        """ 处理对话的一批消息, 之后对话重新排队 """
+        delay = self._coalesce_delay(chatid)
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self._coalesce_delay(chatid)
+
+        async with self._semaphore:
+            batch = self._next(chatid)
+            if batch:
+                try:
+                    await self.handler(batch)
+                except Exception as e:
+                    common.logger().error("处理对话 %s 的消息错误: %s", chatid, common.error_trace(e))
+        self._finish(chatid)
+
+    def shutdown(self, wait:bool=True) -> None:
+        """ 取消所有处理中的任务 """
+        for task in list(self._tasks):
+            task.cancel()
@@ -0,0 +1,88 @@
+""" 本地解码微信图片 .dat 文件
+
+微信把收到的图片保存在 FileStorage/MsgAttach/.../Image 下的 .dat 文件中,
+文件内容是原图每个字节与同一个单字节密钥异或的结果。
+根据 JPEG/PNG/GIF 文件头推算密钥, 即可不经过 wcferry 直接解码。
+"""
+import os
+import pathlib
+import uuid
+
+import numpy as np
+
+import common
+
+
+IMAGE_MAGICS = (
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"\x89PNG", ".png"),
+    (b"GIF8", ".gif"),
+)
+""" 图片文件头和对应的扩展名 """
+
+
+def detect_key(head:bytes) -> tuple[int, str]:
+    """ 根据 .dat 文件开头的字节推算异或密钥
+
+    Args:
+        head (bytes): 文件开头至少4个字节
+
+    Returns:
+        (int, str): (密钥, 扩展名). 不是已知图片格式返回 None
+    """
+    for magic, ext in IMAGE_MAGICS:
+        if len(head) < len(magic):
+            continue
+        key = head[0] ^ magic[0]
+        if all(h ^ key == m for h, m in zip(head, magic)):
+            return key, ext
+    return None
+
+
+def dat_path(extra:str) -> str:
+    """ 从消息 extra 中取出 .dat 文件路径, 没有返回 None.
+    extra 可能是 "缩略图路径\\x01原图路径" 的形式, 取最后一个 .dat 路径 """
+    for part in reversed(extra.split("\x01")):
+        if part.lower().endswith(".dat"):
+            return part
+    return None
+
+
+def decode_dat(dat_file:str, out_dir:str) -> str:
+    """ 解码 .dat 文件, 保存为 out_dir 下的同名图片文件
+
+    Args:
+        dat_file (str): .dat 文件路径
+        out_dir (str): 保存文件夹
+
+    Returns:
+        str: 解码后的文件路径. 文件不存在或不是已知图片格式时返回 None
+    """
+    try:
+        size = os.path.getsize(dat_file)
+    except OSError:     # 原图还没有下载到本地
+        return None
+    if size < 4:
+        return None
+    with open(dat_file, "rb") as f:
+        detected = detect_key(f.read(4))
+    if detected is None:
+        common.logger().warning("无法识别的 .dat 文件格式: %s", dat_file)
+        return None
+    key, ext = detected
+
+    stem = pathlib.Path(dat_file).stem
+    out_file = pathlib.Path(out_dir) / (stem + ext)
+    # 主名不同, 写入中的文件不会被当作已下载的图片; 加随机串, 同时解码同一图片 (如预取和引用) 时各写各的临时文件
+    tmp_file = out_file.with_name(f"{stem}_part_{uuid.uuid4().hex[:8]}{ext}")
+    try:
+        src = np.memmap(dat_file, dtype=np.uint8, mode="r")
+        dst = np.memmap(tmp_file, dtype=np.uint8, mode="w+", shape=src.shape)
+        np.bitwise_xor(src, np.uint8(key), out=dst)
+        dst.flush()
+        del src, dst    # 关闭映射后才能在 Windows 上替换文件
+        os.replace(tmp_file, out_file)
+    except Exception:
+        tmp_file.unlink(missing_ok=True)
+        raise
+    return str(out_file)
@@ -3,7 +3,7 @@
 import time
 import threading
 from enum import Enum, auto
-from functools import reduce
+from functools import partial, reduce
 from hashlib import md5
 import urllib.parse
 
@@ -264,7 +264,7 @@ class LiveMonitor:
             # 之前没开播，现在开播了：通知
             common.logger().info("发送开播通知: %s-%s(%s) -> %s", site.name, roomid, title, chat_list)
             for chatid in chat_list:
-                self.wcfw.wcf.send_rich_text(
+                send = partial(self.wcfw.wcf.send_rich_text,
                     name=name,
                     account=account,
                     title=title,
@@ -273,6 +273,7 @@ class LiveMonitor:
                     thumburl=thumburl,
                     receiver=chatid,
                 )
+                self.wcfw.sender.submit(chatid, send)
         self.live_status_dict[(site, roomid)] = is_live
 
 
@@ -15,12 +15,19 @@ import openai_wrapper
 import common
 from tools import toolbase
 
-def main(cfg:str):
-    """ 主程序入口"""
+def main(cfg:str, engine:str="sync"):
+    """ 主程序入口
+    args:
+        cfg (str): 配置文件路径
+        engine (str): 消息处理引擎. sync=线程池, async=asyncio 事件循环
+    """
     the_config = config.Config(cfg)    # 初始化配置
 
-    common.logger().info("初始化OpenAI API...")
-    oaiw = openai_wrapper.OpenAIWrapper(the_config)
+    common.logger().info("初始化OpenAI API (引擎=%s)...", engine)
+    if engine == "async":
+        oaiw = openai_wrapper.AsyncOpenAIWrapper(the_config)
+    else:
+        oaiw = openai_wrapper.OpenAIWrapper(the_config)
     tool_list = load_tools(the_config, oaiw)
     oaiw.add_tools(tool_list)
 
@@ -43,7 +50,10 @@ def main(cfg:str):
 
     # 创建机器人并运行
     common.logger().info("启动微信机器人...")
-    bot = chatbot.Chatbot(the_config, wcfw, oaiw)
+    if engine == "async":
+        bot = chatbot.AsyncChatbot(the_config, wcfw, oaiw)
+    else:
+        bot = chatbot.Chatbot(the_config, wcfw, oaiw)
     common.logger().info("开始运行并接收消息")
     bot.start_main_loop()
 
@@ -81,8 +91,10 @@ if __name__ == "__main__":
     try:
         parser = ArgumentParser()
         parser.add_argument('-c', type=str, default=common.DEFAULT_CONFIG, help='使用的配置文件路径')
-        c = parser.parse_args().c
-        main(c)
+        parser.add_argument('-e', type=str, default="sync", choices=["sync", "async"],
+            help='消息处理引擎: sync=线程池(默认), async=asyncio 事件循环')
+        args = parser.parse_args()
+        main(args.c, args.e)
     except Exception as e:
         print(f"主程序发生错误: {common.error_trace(e)}")
         common.logger().fatal("主程序发生错误, 即将退出: %s", common.error_trace(e))
@@ -0,0 +1,140 @@
+""" 媒体预取: 图片/语音/视频消息到达时在后台下载, 之后引用该消息时直接使用已下载的文件 """
+import os
+import queue
+import threading
+from collections import OrderedDict
+from typing import Callable
+
+import common
+from common import ChatMsg, ContentType
+from parsed_msg import ParsedMsg
+
+
+MEDIA_TYPES = (3, 34, 43)
+""" 预取的消息类型: 图片, 语音, 视频 """
+
+
+class MediaPrefetcher:
+    """ 媒体预取器
+    - 收到的媒体消息放入有界队列, 由后台线程下载; 队列满时丢弃, 不阻塞接收
+    - 下载结果按 MsgSvrID 缓存, 记录数超过 cache_size 或文件总大小超过 cache_bytes 时删除最久未用的记录
+    - 查询正在下载的消息时, 等待下载完成
+    """
+
+    def __init__(self, fetch:Callable[[ParsedMsg], ChatMsg], queue_size:int=100, cache_size:int=500,
+        cache_bytes:int=200*1024*1024) -> None:
+        """ 初始化
+
+        Args:
+            fetch (Callable): 下载一条媒体消息的函数, 返回 ChatMsg, 失败返回 None
+            queue_size (int): 等待下载的最大消息数
+            cache_size (int): 缓存的最大记录数
+            cache_bytes (int): 缓存文件的最大总字节数
+        """
+        self.fetch = fetch
+        self.enabled = False
+        self.prefetched = 0     # 下载成功数
+        self.dropped = 0        # 队列满丢弃数
+        self.hits = 0           # 引用时命中缓存次数
+        self.misses = 0         # 引用时未命中次数
+        self.queue_size = queue_size
+        self.cache_size = cache_size
+        self.cache_bytes = cache_bytes
+        self.cached_bytes = 0   # 缓存文件总字节数
+        self._queue:queue.Queue[ParsedMsg] = queue.Queue()
+        self._cache:OrderedDict[int, ChatMsg] = OrderedDict()     # {MsgSvrID: 下载结果}
+        self._sizes:dict[int, int] = {}                           # {MsgSvrID: 文件字节数}
+        self._pending:dict[int, threading.Event] = {}             # 排队或下载中的消息, 完成时 set
+        self._lock = threading.Lock()
+        self._thread:threading.Thread = None
+
+    def configure(self, enabled:bool, queue_size:int, cache_size:int, cache_bytes:int):
+        """ 设置是否启用及队列和缓存大小. 启用时启动下载线程 """
+        self.enabled = enabled
+        self.queue_size = queue_size
+        with self._lock:
+            self.cache_size = cache_size
+            self.cache_bytes = cache_bytes
+            self._shrink()
+        if enabled and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="media_prefetch", daemon=True)
+            self._thread.start()
+
+    def submit(self, msg:ParsedMsg) -> bool:
+        """ 把媒体消息加入下载队列. 未启用、不是媒体消息、已缓存或队列满时返回False """
+        if not self.enabled or msg.type not in MEDIA_TYPES:
+            return False
+        with self._lock:
+            if msg.id in self._cache or msg.id in self._pending:
+                return False
+            if self._queue.qsize() >= self.queue_size:
+                self.dropped += 1
+                return False
+            self._queue.put(msg)
+            self._pending[msg.id] = threading.Event()
+            return True
+
+    def get(self, svrid:int, timeout:float=30) -> ChatMsg:
+        """ 返回已下载的媒体. 正在下载时最多等待 timeout 秒. 没有或文件已被删除时返回 None """
+        with self._lock:
+            event = self._pending.get(svrid)
+        if event is not None:
+            event.wait(common.timeout_for(timeout))
+
+        with self._lock:
+            chat_msg = self._cache.get(svrid)
+            if chat_msg is not None and not os.path.exists(chat_msg.content):    # 已被临时文件清理删除
+                self._remove(svrid)
+                chat_msg = None
+            if chat_msg is None:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(svrid)
+            self.hits += 1
+            return chat_msg
+
+    def backlog(self) -> int:
+        """ 返回等待下载的消息数 """
+        return self._queue.qsize()
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def _remove(self, svrid:int):
+        """ 删除一条缓存记录. 调用时需持有 _lock """
+        del self._cache[svrid]
+        self.cached_bytes -= self._sizes.pop(svrid, 0)
+
+    def _shrink(self):
+        """ 删除最久未用的记录, 直到记录数和总字节数都不超过上限. 调用时需持有 _lock """
+        while self._cache and (len(self._cache) > self.cache_size or self.cached_bytes > self.cache_bytes):
+            self._remove(next(iter(self._cache)))
+
+    def _run(self):
+        """ 下载循环 """
+        while True:
+            msg = self._queue.get()
+            chat_msg = None
+            size = 0
+            try:
+                chat_msg = self.fetch(msg)
+                if chat_msg is not None and chat_msg.type != ContentType.ERROR and chat_msg.content:
+                    size = os.path.getsize(chat_msg.content)
+                else:
+                    chat_msg = None
+            except Exception as e:
+                chat_msg = None
+                common.logger().warning("预取媒体失败, 消息id=%s: %s", msg.id, common.error_trace(e))
+
+            with self._lock:
+                if chat_msg is not None:
+                    self.prefetched += 1
+                    if msg.id in self._cache:
+                        self._remove(msg.id)
+                    self._cache[msg.id] = chat_msg
+                    self._sizes[msg.id] = size
+                    self.cached_bytes += size
+                    self._shrink()
+                event = self._pending.pop(msg.id, None)
+            if event is not None:
+                event.set()
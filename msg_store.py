@@ -0,0 +1,82 @@
+""" 最近消息缓存: 按消息id记录最近收到的消息, 引用这些消息时无需查询数据库 """
+import threading
+from collections import deque
+
+from wcferry import WxMsg
+
+
+class StoredMsg:
+    """ 缓存的消息记录, 只保留解析引用需要的字段 """
+    __slots__ = ("type", "extra", "thumb", "content")
+
+    def __init__(self, type:int, extra:str, thumb:str, content:str) -> None:
+        """ 初始化
+        args:
+            type (int): 消息类型
+            extra (str): 消息extra (图片、文件、视频的路径)
+            thumb (str): 缩略图路径
+            content (str): 消息内容
+        """
+        self.type = type
+        self.extra = extra
+        self.thumb = thumb
+        self.content = content
+
+    def size(self) -> int:
+        """ 记录占用的大致字节数 """
+        return 64 + len(self.extra or "") + len(self.thumb or "") + len(self.content or "")
+
+
+class RecentMsgStore:
+    """ 最近消息的环形缓存 {消息id: StoredMsg}
+    按到达顺序记录, 记录数超过 maxsize 或总大小超过 max_bytes 时淘汰最早的记录。线程安全 """
+
+    def __init__(self, maxsize:int=5000, max_bytes:int=16*2**20) -> None:
+        """ 初始化
+
+        Args:
+            maxsize (int): 最多记录的消息数
+            max_bytes (int): 记录总大小上限(字节)
+        """
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.hits = 0           # 查询命中次数
+        self.misses = 0         # 查询未命中次数
+        self._ring:deque[int] = deque()     # 消息id, 按到达顺序
+        self._msgs:dict[int, StoredMsg] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, msg:WxMsg):
+        """ 记录一条消息 """
+        record = StoredMsg(msg.type, msg.extra, msg.thumb, msg.content)
+        with self._lock:
+            old = self._msgs.get(msg.id)
+            if old is not None:     # 重复的消息, 只更新记录
+                self._bytes -= old.size()
+            else:
+                self._ring.append(msg.id)
+            self._msgs[msg.id] = record
+            self._bytes += record.size()
+            while self._ring and (len(self._ring) > self.maxsize or self._bytes > self.max_bytes):
+                self._bytes -= self._msgs.pop(self._ring.popleft()).size()
+
+    def get(self, msgid:int) -> StoredMsg:
+        """ 返回消息id对应的记录, 没有返回None """
+        try:
+            msgid = int(msgid)
+        except (TypeError, ValueError):
+            return None
+        record = self._msgs.get(msgid)
+        if record is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return record
+
+    def __len__(self) -> int:
+        return len(self._msgs)
+
+    def nbytes(self) -> int:
+        """ 返回记录总大小(字节) """
+        return self._bytes
@@ -1,11 +1,19 @@
 """ OpenAIWrapper 类。管理与OpenAI API 交互"""
-import time
+import asyncio
+import contextlib
+import contextvars
 import pathlib
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from typing import Any
 
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 import httpx
 import common
 import config
+import run_poller
 from common import ContentType, ChatMsg, MSG_CALLBACK
 
 
@@ -16,6 +24,205 @@ from tools import toolbase
 ASSISTANT_NAME = 'Wechat_AI_Assistant'
 ASSISTANT_DESC = "用于微信机器人的assistant"
 
+RUN_ACTIVE = ('queued', 'in_progress', 'requires_action')
+""" 未结束的 run 状态 """
+
+CANCEL_WAIT = 10
+""" 取消 run 后, 最多等待其结束的秒数 """
+
+
+class StreamTextBuffer:
+    """ 流式运行的文本缓冲: 累积 AI 输出的文字片段, 在段落或句子结束处切出可以发送的部分 """
+
+    MIN_CHARS = 50      # 在段落结束处发送的最少字数
+    MAX_CHARS = 500     # 没有段落结束时, 超过该字数在句子结束处发送
+    SENTENCE_ENDS = "。！？!?\n"
+
+    def __init__(self) -> None:
+        self.text = ""
+
+    def feed(self, text:str, annotations:list[str]=None) -> str:
+        """ 加入文字片段, 返回可以发送的部分, 没有则返回空字符串
+
+        Args:
+            text (str): 新的文字片段
+            annotations (list[str]): 需要去掉的注释文本 (如引用来源标记)
+        """
+        self.text += text
+        for a in annotations or []:
+            self.text = self.text.replace(a, "")
+
+        if self.text.count("```") % 2:     # 代码块未结束, 不切分
+            return ""
+        end = len(self.text)
+        if self.text.rfind("【") > self.text.rfind("】"):     # 注释未结束, 不切分注释
+            end = self.text.rfind("【")
+
+        cut = self.text.rfind("\n\n", 0, end)
+        if cut < self.MIN_CHARS:
+            cut = -1
+            if end >= self.MAX_CHARS:
+                cut = max(self.text.rfind(c, 0, end) for c in self.SENTENCE_ENDS) + 1
+        if cut <= 0:
+            return ""
+        ready, self.text = self.text[:cut], self.text[cut:]
+        return ready
+
+    def flush(self) -> str:
+        """ 返回并清空剩余的文字 """
+        text, self.text = self.text, ""
+        return text
+
+
+class StreamRun:
+    """ 流式运行的事件处理。根据事件更新 run, 返回需要执行的动作 [(动作, 参数)], 同步和异步版本的运行循环共用:
+    - ("begin", run_id): run 已创建
+    - ("text", 文字): 发送一段文字
+    - ("image", file_id) / ("file", file_id): 下载并发送图片/文件
+    - ("tools", tool_calls): 执行工具调用, 提交结果后继续读取新的流
+    - ("usage", run): run 完成, 记录token消耗
+    """
+
+    def __init__(self) -> None:
+        self.run = None
+        self.buffer = StreamTextBuffer()
+
+    def active(self) -> bool:
+        """ run 是否未结束 """
+        return self.run is not None and self.run.status in RUN_ACTIVE
+
+    def handle(self, event) -> list[tuple[str, Any]]:
+        """ 处理一个流事件, 返回需要执行的动作 """
+        actions = []
+        name = event.event
+        if name.startswith("thread.run.") and not name.startswith("thread.run.step."):    # run 事件, 不含 run step 事件
+            self.run = event.data
+            if name == "thread.run.created":
+                actions.append(("begin", self.run.id))
+
+        if name == "thread.message.delta":
+            for part in event.data.delta.content or []:
+                if part.type == 'text' and part.text:
+                    annotations = [a.text for a in part.text.annotations or [] if a.text]
+                    self._text(actions, self.buffer.feed(part.text.value or "", annotations))
+                elif part.type == 'image_file' and part.image_file:
+                    self._text(actions, self.buffer.flush())
+                    actions.append(("image", part.image_file.file_id))
+        elif name == "thread.message.completed":
+            self._text(actions, self.buffer.flush())
+            for f in event.data.attachments or []:     # 处理每个附件
+                actions.append(("file", f.file_id))
+        elif name == "thread.run.requires_action":
+            self._text(actions, self.buffer.flush())
+            actions.append(("tools", self.run.required_action.submit_tool_outputs.tool_calls))
+        elif name in ("thread.run.failed", "thread.run.expired", "thread.run.cancelled", "thread.run.incomplete"):
+            self._text(actions, self.buffer.flush())
+            actions.append(("text", self._end_notice(name)))
+        elif name == "thread.run.completed":
+            actions.append(("usage", self.run))
+        elif name == "error":
+            common.logger().error("流式运行错误: %s", event.data)
+        return actions
+
+    def flush(self) -> list[tuple[str, Any]]:
+        """ 流结束时, 返回发送剩余文字的动作 """
+        actions = []
+        self._text(actions, self.buffer.flush())
+        return actions
+
+    def _text(self, actions:list, text:str):
+        """ 去掉多余空行后加入发送文字的动作. 空白文字不发送 """
+        text = text.replace('\n\n', '\n').strip()
+        if text:
+            actions.append(("text", text))
+
+    def _end_notice(self, name:str) -> str:
+        """ 记录 run 未正常完成的原因, 返回告知用户的文字 """
+        run = self.run
+        if name == "thread.run.failed":
+            common.logger().warning('run id %s 运行失败:%s', run.id, str(run.last_error))
+            return f"API运行失败: {run.last_error.code if run.last_error else 'unknown'}"
+        if name == "thread.run.expired":
+            common.logger().warning('run id %s 已过期', run.id)
+            return "API运行超时, 已过期"
+        if name == "thread.run.cancelled":
+            common.logger().warning('run id %s 已被取消', run.id)
+            return "API运行已被取消"
+        reason = run.incomplete_details.reason if run.incomplete_details else "unknown"
+        common.logger().warning('run id %s 未完成: %s', run.id, reason)
+        return f"API运行未完成: {reason}"
+
+
+_STREAM_END = object()
+""" 流事件读取结束的标记 """
+
+def _iter_events(stream, tick:float):
+    """ 在后台线程读取流事件并逐个返回. 每 tick 秒没有事件时返回 None, 供调用方检查取消请求和截止时间 """
+    events = queue.Queue()
+
+    def read():
+        try:
+            for event in stream:
+                events.put(event)
+            events.put(_STREAM_END)
+        except Exception as e:  # 包括调用方关闭流
+            events.put(e)
+
+    threading.Thread(target=read, name="stream_reader", daemon=True).start()
+    while True:
+        try:
+            item = events.get(timeout=tick)
+        except queue.Empty:
+            yield None
+            continue
+        if item is _STREAM_END:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+async def _aiter_events(stream, tick:float):
+    """ 异步版本的 _iter_events: 在任务中读取流事件, 每 tick 秒没有事件时返回 None """
+    events = asyncio.Queue()
+
+    async def read():
+        try:
+            async for event in stream:
+                events.put_nowait(event)
+            events.put_nowait(_STREAM_END)
+        except Exception as e:
+            events.put_nowait(e)
+
+    reader = asyncio.create_task(read())
+    try:
+        while True:
+            try:
+                item = await asyncio.wait_for(events.get(), tick)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            if item is _STREAM_END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        reader.cancel()
+
+def _call_in_thread(fn, *args) -> Future:
+    """ 在新线程中调用 fn, 继承当前的 contextvars (如截止时间), 返回 Future """
+    future = Future()
+    ctx = contextvars.copy_context()
+
+    def run():
+        try:
+            future.set_result(ctx.run(fn, *args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, name="stream_tools", daemon=True).start()
+    return future
+
 class OpenAIWrapper:
     """ 用于处理OpenAI交互的类
     参考: openai API 文档: https://platform.openai.com/docs/api-reference
@@ -36,7 +243,12 @@ class OpenAIWrapper:
         self.uploaded_files:dict[str,str] = {}        # 已上传文件. file_id:硬盘文件名
 
         self._assistant_id:str = None
+        self._lock = threading.Lock()     # 多个工作线程共用 chat_threads
+        self._active_runs:dict[str, str] = {}       # 正在运行的run {chatid: run_id}
+        self._cancel_requests:set[str] = set()      # 请求取消运行的 chatid
+        self.runs_cancelled = 0                     # 已取消的run数
         self.tools:dict[str, toolbase.ToolBase] = {}        # 工具列表 {名字:Tool}
+        self.poller = self.create_run_poller()              # 所有进行中 run 的状态轮询
         self.config = cfg
         self.load_config()
 
@@ -57,6 +269,7 @@ class OpenAIWrapper:
         self.voice:str = openai_config.get("voice", "alloy")
         self.voice_speed:float = openai_config.get("voice_speed", 1.0)
         self.transcript_prompt:str = openai_config.get("transcript_prompt", "请将语音消息转录成文本")
+        self.stream:bool = openai_config.get("stream", False)     # 流式运行, 边生成边发送
 
         self._default_prompt = self.config.default_preset.sys_prompt    # 默认prompt来自default
         self.client = self.create_openai_client()
@@ -75,6 +288,14 @@ class OpenAIWrapper:
         help_text = ', '.join(lines)
         return help_text
 
+    def create_run_poller(self) -> run_poller.RunPoller:
+        """ 创建 run 状态轮询服务 """
+        return run_poller.RunPoller(self._retrieve_run)
+
+    def _retrieve_run(self, thread_id:str, run_id:str):
+        """ 查询 run 的状态 """
+        return self.client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id, timeout=10)
+
     def create_openai_client(self) -> OpenAI:
         """ 创建openai客户端 """
 
@@ -138,12 +359,13 @@ class OpenAIWrapper:
             str: thread_id
         """
 
-        if chatid not in self.chat_threads:
-            thread = self.client.beta.threads.create()
-            self.chat_threads[chatid] = thread.id
-            common.logger().info("为新对话 %s 创建新thread %s", chatid, thread.id)
+        with self._lock:
+            if chatid not in self.chat_threads:
+                thread = self.client.beta.threads.create()
+                self.chat_threads[chatid] = thread.id
+                common.logger().info("为新对话 %s 创建新thread %s", chatid, thread.id)
 
-        return self.chat_threads[chatid]
+            return self.chat_threads[chatid]
 
     def set_chat_prompt(self, chatid:str, prompt:str):
         """ 为指定对话设置预设prompt"""
@@ -155,11 +377,69 @@ class OpenAIWrapper:
 
     def clear_chat_thread(self, chatid:str):
         """ 删除chat对应thread"""
-        thread_id = self.chat_threads.pop(chatid, None)
+        with self._lock:
+            thread_id = self.chat_threads.pop(chatid, None)
         if thread_id:
             self.client.beta.threads.delete(thread_id)
         return
 
+    def request_cancel(self, chatid:str, reason:str) -> bool:
+        """ 请求取消对话正在进行的run. 由处理该run的线程在下次轮询时取消。
+        可在任意线程调用, 不阻塞
+
+        Returns:
+            bool: 是否有正在进行的run
+        """
+        with self._lock:
+            run_id = self._active_runs.get(chatid)
+            if run_id is None:
+                return False
+            self._cancel_requests.add(chatid)
+        self.poller.wake(run_id)    # 唤醒等待状态的线程, 立即处理取消
+        common.logger().info("请求取消对话 %s 的运行 %s (%s)", chatid, run_id, reason)
+        return True
+
+    def _begin_run(self, chatid:str, run_id:str):
+        """ 记录对话正在进行的run """
+        with self._lock:
+            self._active_runs[chatid] = run_id
+
+    def _end_run(self, chatid:str):
+        """ run 结束, 清除记录和未处理的取消请求 """
+        with self._lock:
+            self._active_runs.pop(chatid, None)
+            self._cancel_requests.discard(chatid)
+
+    def _take_cancel(self, chatid:str) -> bool:
+        """ 返回是否有取消请求, 并清除请求 """
+        with self._lock:
+            if chatid not in self._cancel_requests:
+                return False
+            self._cancel_requests.discard(chatid)
+            return True
+
+    def _cancel_run(self, thread_id:str, run):
+        """ 取消run, 返回取消后的run. 若run已结束无法取消, 返回最新状态 """
+        try:
+            run = self.client.beta.threads.runs.cancel(run.id, thread_id=thread_id)
+            self.runs_cancelled += 1
+            common.logger().info("已取消运行 %s (累计 %d 次)", run.id, self.runs_cancelled)
+        except Exception as e:
+            common.logger().warning("取消运行 %s 失败: %s", run.id, e)
+            run = self.client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id, timeout=10)
+        return run
+
+    def _cancel_run_wait(self, thread_id:str, run):
+        """ 取消run, 并等待其结束 (最多 CANCEL_WAIT 秒), 使 thread 可以立即用于下一个 run. 返回最新的 run """
+        run = self._cancel_run(thread_id, run)
+        end = time.monotonic() + CANCEL_WAIT
+        while run.status in RUN_ACTIVE + ('cancelling',) and time.monotonic() < end:
+            time.sleep(0.5)
+            run = self._retrieve_run(thread_id, run.id)
+        if run.status in RUN_ACTIVE + ('cancelling',):
+            common.logger().warning("run id %s 取消后 %d 秒仍未结束: %s", run.id, CANCEL_WAIT, run.status)
+        return run
+
     def upload_file(self, filename:str, purpose:str="assistants") -> str:
         """ 上传文件到OpenAI 并返回file id. 如果失败返回None
 
@@ -171,7 +451,8 @@ class OpenAIWrapper:
         """
         fo = self.client.files.create(
             file=open(filename, "rb"),
-            purpose=purpose
+            purpose=purpose,
+            timeout=common.timeout_for(60)
         )
         self.uploaded_files[fo.id] = filename
         return fo.id
@@ -231,38 +512,41 @@ class OpenAIWrapper:
                 callback_msg(ChatMsg(ContentType.text, note))
             attach_files.append(fid)
 
-        # 创建附带图片的消息
-        if not text_msg:
-            text_msg = ""
-        content = [{"type":"text", "text":text_msg}]
-        for f in image_files:
-            content.append({"type":"image_file", "image_file":{"file_id":f, "detail": "high"}})
-
         # 创建消息到 thread
-        tools_object = [{"type": "code_interpreter"}, {"type":"file_search"}]
-        attach_object = [{"file_id": file_id, "tools": tools_object} for file_id in attach_files]
+        content, attach_object = self._msg_content(text_msg, image_files, attach_files)
         text_msg = self.client.beta.threads.messages.create(
             thread_id=thread_id,
             role="user",
             content=content,
-            attachments=attach_object
+            attachments=attach_object,
+            timeout=common.timeout_for(30)
         )
         last_msg_id = text_msg.id
 
         # create run
         chat_prompt = self.chat_promprts.get(chatid, None)
+        if self.stream:
+            self._run_stream(chatid, thread_id, chat_prompt, callback_msg)
+            return
 
         run = self.client.beta.threads.runs.create(
             thread_id=thread_id,
             assistant_id=self.assistant_id,
             instructions=chat_prompt,
-            timeout=30
+            timeout=common.timeout_for(30)
         )
+        self._begin_run(chatid, run.id)
+        self.poller.track(thread_id, run)
 
         try:
             # 运行run, 并处理结果, 直到停止
             while run.status in ('queued','in_progress', 'requires_action', 'cancelling'):
-                if run.status == 'requires_action':     # 调用tool call
+                if run.status != 'cancelling':
+                    common.check_deadline()
+                if run.status != 'cancelling' and self._take_cancel(chatid):    # 被新消息取代, 取消运行
+                    run = self._cancel_run(thread_id, run)
+                    self.poller.update(run)
+                elif run.status == 'requires_action':     # 调用tool call
                     last_msg_id = self._process_new_msgs(thread_id, last_msg_id, callback_msg)
                     tool_outputs = []
 
@@ -274,39 +558,152 @@ class OpenAIWrapper:
                         thread_id=thread_id,
                         run_id=run.id,
                         tool_outputs=tool_outputs,
+                        timeout=common.timeout_for(30)
                     )
+                    self.poller.update(run)
+
+                else:   # 其他运行状态: 等待轮询服务得到新状态. 每秒返回一次, 检查取消和截止时间
+                    run = self.poller.wait(run.id, 1)
 
-                else:   # 其他运行状态: 重新pull run的状态
-                    time.sleep(0.1)
-                    run = self.client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id,timeout=10)
+            if run.status == 'cancelled':   # 已取消, 不再发送未完成的回复
+                common.logger().info("run id %s 已取消", run.id)
+                return
 
             # run 运行结束(complete / failed / ...)，处理新消息
             last_msg_id = self._process_new_msgs(thread_id, last_msg_id, callback_msg)
             if run.status == 'failed':
                 common.logger().warning('run id %s 运行失败:%s', run.id, str(run.last_error))
                 callback_msg(ChatMsg(ContentType.text, f"API运行失败: {run.last_error.code}"))
-            common.logger().info("Run 完成。token消耗: 输入=%s, 输出=%s, 总token=%s, 估计成本=$%.4f",
-                run.usage.prompt_tokens, run.usage.completion_tokens, run.usage.total_tokens,
-                run.usage.prompt_tokens/1000*0.005 + run.usage.completion_tokens/1000*0.015)
+            self._log_run_usage(run)
+        except common.DeadlineExceeded:
+            if run.status in ('queued','in_progress', 'requires_action'):
+                common.logger().warning("run id %s 超过处理时限, 取消运行", run.id)
+                run = self._cancel_run_wait(thread_id, run)
+            raise
         finally:
+            self._end_run(chatid)
+            common.logger().debug("run id %s 状态查询 %d 次", run.id, self.poller.untrack(run.id))
             if run.status == 'requires_action': # 若中途出错退出, 需要取消运行, 避免thread被锁住
                 common.logger().warning("Run状态=reuires_action, 取消运行以解锁thread")
                 self.client.beta.threads.runs.cancel(run.id, thread_id=thread_id)
 
+    def _run_stream(self, chatid:str, thread_id:str, chat_prompt:str, callback_msg:MSG_CALLBACK):
+        """ 以流式方式运行 run: 文字每完成一段就发送, 图片和文件在事件到达时下载发送, 工具调用在流中处理。
+        等待事件和工具调用期间每秒检查一次取消请求和截止时间 """
+        stream = self.client.beta.threads.runs.create(
+            thread_id=thread_id,
+            assistant_id=self.assistant_id,
+            instructions=chat_prompt,
+            stream=True,
+            timeout=common.timeout_for(60)
+        )
+        state = StreamRun()
+        try:
+            while stream is not None:
+                next_stream = None
+                with stream:
+                    for event in _iter_events(stream, 1):
+                        if state.active():
+                            common.check_deadline()
+                            if self._take_cancel(chatid):    # 被新消息取代, 取消运行, 不再发送未完成的回复
+                                state.run = self._cancel_run_wait(thread_id, state.run)
+                                common.logger().info("run id %s 已取消", state.run.id)
+                                return
+                        if event is None:
+                            continue
+
+                        for action, arg in state.handle(event):
+                            if action == "tools":   # 调用tool call, 提交结果后继续读取新的流
+                                tool_outputs = self._wait_tools(chatid, arg, callback_msg)
+                                if tool_outputs is None:
+                                    state.run = self._cancel_run_wait(thread_id, state.run)
+                                    common.logger().info("run id %s 已取消", state.run.id)
+                                    return
+                                next_stream = self.client.beta.threads.runs.submit_tool_outputs(
+                                    thread_id=thread_id,
+                                    run_id=state.run.id,
+                                    tool_outputs=tool_outputs,
+                                    stream=True,
+                                    timeout=common.timeout_for(60)
+                                )
+                                state.run.status = 'in_progress'
+                            else:
+                                self._do_stream_action(chatid, action, arg, callback_msg)
+                        if next_stream is not None:
+                            break
+                stream = next_stream
+            for action, arg in state.flush():
+                self._do_stream_action(chatid, action, arg, callback_msg)
+        except common.DeadlineExceeded:
+            if state.active():
+                common.logger().warning("run id %s 超过处理时限, 取消运行", state.run.id)
+                state.run = self._cancel_run_wait(thread_id, state.run)
+            raise
+        finally:
+            self._end_run(chatid)
+            if state.run is not None and state.run.status == 'requires_action': # 若中途出错退出, 需要取消运行, 避免thread被锁住
+                common.logger().warning("Run状态=reuires_action, 取消运行以解锁thread")
+                self.client.beta.threads.runs.cancel(state.run.id, thread_id=thread_id)
+
+    def _do_stream_action(self, chatid:str, action:str, arg:Any, callback_msg:MSG_CALLBACK):
+        """ 执行 StreamRun 返回的动作 (工具调用除外) """
+        if action == "begin":
+            self._begin_run(chatid, arg)
+        elif action == "text":
+            callback_msg(ChatMsg(ContentType.text, arg))
+        elif action == "image":
+            callback_msg(ChatMsg(ContentType.image, self.download_openai_file(arg)))
+        elif action == "file":
+            callback_msg(ChatMsg(ContentType.file, self.download_openai_file(arg)))
+        elif action == "usage":
+            self._log_run_usage(arg)
+
+    def _call_tools(self, tool_calls:list, callback_msg:MSG_CALLBACK) -> list[dict]:
+        """ 依次处理 tool call, 返回提交的结果列表 """
+        return [{"tool_call_id": tc.id, "output": self._call_tool(tc.function.name, tc.function.arguments, callback_msg)}
+            for tc in tool_calls]
+
+    def _wait_tools(self, chatid:str, tool_calls:list, callback_msg:MSG_CALLBACK) -> list[dict]:
+        """ 在后台线程处理 tool call, 每秒检查一次截止时间和取消请求。
+        返回提交的结果列表; 有取消请求时返回 None (工具在后台继续运行, 结果丢弃) """
+        future = _call_in_thread(self._call_tools, tool_calls, callback_msg)
+        while True:
+            try:
+                return future.result(timeout=1)
+            except FutureTimeout:
+                common.check_deadline()
+                if self._take_cancel(chatid):
+                    return None
+
+    def _msg_content(self, text_msg:str, image_files:list[str], attach_files:list[str]) -> tuple[list, list]:
+        """ 构造 thread 消息的 content (文本和图片) 和 attachments (附件) """
+        if not text_msg:
+            text_msg = ""
+        content = [{"type":"text", "text":text_msg}]
+        for f in image_files:
+            content.append({"type":"image_file", "image_file":{"file_id":f, "detail": "high"}})
+
+        tools_object = [{"type": "code_interpreter"}, {"type":"file_search"}]
+        attach_object = [{"file_id": file_id, "tools": tools_object} for file_id in attach_files]
+        return content, attach_object
+
+    def _log_run_usage(self, run):
+        """ 记录 run 的token消耗 """
+        common.logger().info("Run 完成。token消耗: 输入=%s, 输出=%s, 总token=%s, 估计成本=$%.4f",
+            run.usage.prompt_tokens, run.usage.completion_tokens, run.usage.total_tokens,
+            run.usage.prompt_tokens/1000*0.005 + run.usage.completion_tokens/1000*0.015)
+
 
 
     def _process_new_msgs(self, thread_id, last_msg_id, callback_msg:MSG_CALLBACK) -> str:
         """ 处理所有在last_msg_id之后的新消息, 返回最后一条消息id"""
-        msgs = self.client.beta.threads.messages.list(thread_id=thread_id, order="asc", after=last_msg_id)
+        msgs = self.client.beta.threads.messages.list(thread_id=thread_id, order="asc", after=last_msg_id,
+            timeout=common.timeout_for(30))
         for m in msgs:
             last_msg_id = m.id
             for c in m.content:     # 处理 message 的每个 content
                 if c.type == 'text':
-                    msg_text = c.text.value
-                    for a in c.text.annotations:            # 去掉所有注释
-                        msg_text = msg_text.replace(a.text, "")
-                    msg_text = msg_text.replace('\n\n', '\n')       #去掉多余空行
-                    callback_msg(ChatMsg(ContentType.text, msg_text))
+                    callback_msg(ChatMsg(ContentType.text, self._clean_text(c.text)))
                 elif c.type == 'image_file':
                     dl_image = self.download_openai_file(c.image_file.file_id)
                     callback_msg(ChatMsg(ContentType.image, dl_image))
@@ -317,6 +714,14 @@ class OpenAIWrapper:
 
         return last_msg_id
 
+    def _clean_text(self, text) -> str:
+        """ 返回消息文本内容, 去掉注释和多余空行 """
+        msg_text = text.value
+        for a in text.annotations:            # 去掉所有注释
+            msg_text = msg_text.replace(a.text, "")
+        msg_text = msg_text.replace('\n\n', '\n')       #去掉多余空行
+        return msg_text
+
 
     def _call_tool(self, name:str, arguments:str, callback_msg:MSG_CALLBACK) -> str:
         """ 处理工具调用, 返回结果 """
@@ -353,6 +758,7 @@ class OpenAIWrapper:
             size=self.image_size,
             quality=quality,
             n=1,
+            timeout=common.timeout_for(120)
         )
         revised_prompt = res.data[0].revised_prompt
         url = res.data[0].url
@@ -370,12 +776,13 @@ class OpenAIWrapper:
             str: 语音文件路径
         """
 
-        speech_file = common.temp_file(f"tts_{common.timestamp()}.mp3")
+        speech_file = common.unique_temp_file("tts", ".mp3")
         response = self.client.audio.speech.create(
             model="tts-1-hd",
             voice=self.voice,
             speed=self.voice_speed,
-            input=text
+            input=text,
+            timeout=common.timeout_for(60)
         )
         response.stream_to_file(speech_file)
         return str(speech_file)
@@ -395,6 +802,7 @@ class OpenAIWrapper:
                 model="whisper-1",
                 response_format="text",
                 prompt=self.transcript_prompt,
+                timeout=common.timeout_for(60)
             )
         return str(transcript).strip()
 
@@ -408,8 +816,8 @@ class OpenAIWrapper:
         Returns:
             str: 保存的本地文件名
         """
-        file_data = self.client.files.content(file_id)
-        file = self.client.files.retrieve(file_id)
+        file_data = self.client.files.content(file_id, timeout=common.timeout_for(60))
+        file = self.client.files.retrieve(file_id, timeout=common.timeout_for(30))
 
         if name_override:
             save_name = common.temp_file(name_override)
@@ -424,6 +832,320 @@ class OpenAIWrapper:
         return save_name
 
 
+class AsyncOpenAIWrapper(OpenAIWrapper):
+    """ asyncio 版本的 OpenAIWrapper。
+    处理消息的 run_msg, 文件上传下载和工具调用都是协程, 使用 AsyncOpenAI 在同一个事件循环中运行,
+    不需要为每个运行中的对话占用一个线程。
+    作图、语音等工具仍然使用同步客户端, 工具调用交给线程池执行。
+    """
+
+    _assistant_task:asyncio.Future = None     # 正在查询 assistant_id 的任务, 多个协程共用
+
+    def load_config(self):
+        """ 载入配置, 生成同步和异步客户端 """
+        super().load_config()
+        self.aclient = self.create_async_openai_client()
+
+    def create_run_poller(self) -> run_poller.AsyncRunPoller:
+        """ 创建 run 状态轮询服务 (协程版本) """
+        return run_poller.AsyncRunPoller(self._retrieve_run)
+
+    async def _retrieve_run(self, thread_id:str, run_id:str):
+        """ 查询 run 的状态 """
+        return await self.aclient.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id, timeout=10)
+
+    def create_async_openai_client(self) -> AsyncOpenAI:
+        """ 创建异步openai客户端 """
+        if self.proxy:
+            http_client = httpx.AsyncClient(proxies=self.proxy)
+        else:
+            http_client = httpx.AsyncClient()
+
+        openai_client = AsyncOpenAI(
+            api_key=self.api_key,
+            base_url=self.base_url,
+            http_client=http_client,
+            timeout=60
+        )
+        return openai_client
+
+    async def get_assistant_id_async(self) -> str:
+        """ assistant_id 的协程版本. 首次使用时查找/创建 assistant 是阻塞调用, 放到线程中执行, 不阻塞事件循环 """
+        if self._assistant_id is not None:
+            return self._assistant_id
+        if self._assistant_task is None or self._assistant_task.done():
+            self._assistant_task = asyncio.ensure_future(asyncio.to_thread(lambda: self.assistant_id))
+        # shield: 某个等待的协程被取消时, 不取消其他协程共用的查询任务
+        return await asyncio.shield(self._assistant_task)
+
+    async def get_thread_async(self, chatid:str) -> str:
+        """根据chatid(wxid或roomid)获得对应的thread id. 同一chatid不会并发调用 """
+        thread_id = self.chat_threads.get(chatid, None)
+        if thread_id:
+            return thread_id
+
+        thread = await self.aclient.beta.threads.create()
+        with self._lock:
+            self.chat_threads[chatid] = thread.id
+        common.logger().info("为新对话 %s 创建新thread %s", chatid, thread.id)
+        return thread.id
+
+    async def upload_file(self, filename:str, purpose:str="assistants") -> str:
+        """ 上传文件到OpenAI 并返回file id """
+        with open(filename, "rb") as f:
+            fo = await self.aclient.files.create(file=f, purpose=purpose, timeout=common.timeout_for(60))
+        self.uploaded_files[fo.id] = filename
+        return fo.id
+
+    async def run_msg(self, chatid:str,
+        text_msg:str, images:list[str], files:list[str],
+        callback_msg:MSG_CALLBACK):
+        """ 将消息传给 openai 处理, 发送返回的结果消息和文件, 并响应中途的工具函数调用。
+        协程, 直到所有结果返回并处理完毕。参数同 OpenAIWrapper.run_msg
+        callback_msg 是阻塞调用, 在线程池中执行。
+        """
+        images = images or []
+        files = files or []
+        async def send(msg:ChatMsg):
+            await asyncio.to_thread(callback_msg, msg)
+
+        thread_id = await self.get_thread_async(chatid)
+        log_msg = f"调用Assistant处理(Thread={thread_id}):\n{text_msg}"
+        if images:
+            names = [pathlib.Path(image).name for image in images]
+            log_msg += f" (图片:{', '.join(names)})"
+        if files:
+            names = [pathlib.Path(f).name for f in files]
+            log_msg += f" (附件:{', '.join(names)})"
+        common.logger().info(log_msg)
+
+        # 并发上传图片和文件
+        image_files = await asyncio.gather(*(self.upload_file(f, "vision") for f in images))
+        attach_files = await asyncio.gather(*(self.upload_file(f) for f in files))
+
+        # 创建消息到 thread
+        content, attach_object = self._msg_content(text_msg, image_files, attach_files)
+        new_msg = await self.aclient.beta.threads.messages.create(
+            thread_id=thread_id,
+            role="user",
+            content=content,
+            attachments=attach_object,
+            timeout=common.timeout_for(30)
+        )
+        last_msg_id = new_msg.id
+
+        # create run
+        chat_prompt = self.chat_promprts.get(chatid, None)
+        if self.stream:
+            await self._run_stream(chatid, thread_id, chat_prompt, callback_msg, send)
+            return
+
+        run = await self.aclient.beta.threads.runs.create(
+            thread_id=thread_id,
+            assistant_id=await self.get_assistant_id_async(),
+            instructions=chat_prompt,
+            timeout=common.timeout_for(30)
+        )
+        self._begin_run(chatid, run.id)
+        self.poller.track(thread_id, run)
+
+        try:
+            # 运行run, 并处理结果, 直到停止
+            while run.status in ('queued','in_progress', 'requires_action', 'cancelling'):
+                if run.status != 'cancelling':
+                    common.check_deadline()
+                if run.status != 'cancelling' and self._take_cancel(chatid):    # 被新消息取代, 取消运行
+                    run = await self._cancel_run(thread_id, run)
+                    self.poller.update(run)
+                elif run.status == 'requires_action':     # 调用tool call
+                    last_msg_id = await self._process_new_msgs(thread_id, last_msg_id, send)
+
+                    # 并发处理所有 tool call, 提交结果
+                    tool_calls = run.required_action.submit_tool_outputs.tool_calls
+                    outputs = await asyncio.gather(
+                        *(self._call_tool(tc.function.name, tc.function.arguments, callback_msg) for tc in tool_calls))
+                    tool_outputs = [{"tool_call_id": tc.id, "output":output} for tc, output in zip(tool_calls, outputs)]
+                    run = await self.aclient.beta.threads.runs.submit_tool_outputs(
+                        thread_id=thread_id,
+                        run_id=run.id,
+                        tool_outputs=tool_outputs,
+                        timeout=common.timeout_for(30)
+                    )
+                    self.poller.update(run)
+
+                else:   # 其他运行状态: 等待轮询服务得到新状态. 每秒返回一次, 检查取消和截止时间
+                    run = await self.poller.wait(run.id, 1)
+
+            if run.status == 'cancelled':   # 已取消, 不再发送未完成的回复
+                common.logger().info("run id %s 已取消", run.id)
+                return
+
+            # run 运行结束(complete / failed / ...)，处理新消息
+            last_msg_id = await self._process_new_msgs(thread_id, last_msg_id, send)
+            if run.status == 'failed':
+                common.logger().warning('run id %s 运行失败:%s', run.id, str(run.last_error))
+                await send(ChatMsg(ContentType.text, f"API运行失败: {run.last_error.code}"))
+            self._log_run_usage(run)
+        except common.DeadlineExceeded:
+            if run.status in ('queued','in_progress', 'requires_action'):
+                common.logger().warning("run id %s 超过处理时限, 取消运行", run.id)
+                run = await self._cancel_run_wait(thread_id, run)
+            raise
+        finally:
+            self._end_run(chatid)
+            common.logger().debug("run id %s 状态查询 %d 次", run.id, self.poller.untrack(run.id))
+            if run.status == 'requires_action': # 若中途出错退出, 需要取消运行, 避免thread被锁住
+                common.logger().warning("Run状态=reuires_action, 取消运行以解锁thread")
+                await self.aclient.beta.threads.runs.cancel(run.id, thread_id=thread_id)
+
+    async def _run_stream(self, chatid:str, thread_id:str, chat_prompt:str, callback_msg:MSG_CALLBACK, send):
+        """ 以流式方式运行 run. 同 OpenAIWrapper._run_stream, send 是发送消息的协程函数 """
+        stream = await self.aclient.beta.threads.runs.create(
+            thread_id=thread_id,
+            assistant_id=await self.get_assistant_id_async(),
+            instructions=chat_prompt,
+            stream=True,
+            timeout=common.timeout_for(60)
+        )
+        state = StreamRun()
+        try:
+            while stream is not None:
+                next_stream = None
+                async with stream, contextlib.aclosing(_aiter_events(stream, 1)) as events:
+                    async for event in events:
+                        if state.active():
+                            common.check_deadline()
+                            if self._take_cancel(chatid):    # 被新消息取代, 取消运行, 不再发送未完成的回复
+                                state.run = await self._cancel_run_wait(thread_id, state.run)
+                                common.logger().info("run id %s 已取消", state.run.id)
+                                return
+                        if event is None:
+                            continue
+
+                        for action, arg in state.handle(event):
+                            if action == "tools":   # 并发处理所有 tool call, 提交结果后继续读取新的流
+                                tool_outputs = await self._wait_tools(chatid, arg, callback_msg)
+                                if tool_outputs is None:
+                                    state.run = await self._cancel_run_wait(thread_id, state.run)
+                                    common.logger().info("run id %s 已取消", state.run.id)
+                                    return
+                                next_stream = await self.aclient.beta.threads.runs.submit_tool_outputs(
+                                    thread_id=thread_id,
+                                    run_id=state.run.id,
+                                    tool_outputs=tool_outputs,
+                                    stream=True,
+                                    timeout=common.timeout_for(60)
+                                )
+                                state.run.status = 'in_progress'
+                            else:
+                                await self._do_stream_action(chatid, action, arg, send)
+                        if next_stream is not None:
+                            break
+                stream = next_stream
+            for action, arg in state.flush():
+                await self._do_stream_action(chatid, action, arg, send)
+        except common.DeadlineExceeded:
+            if state.active():
+                common.logger().warning("run id %s 超过处理时限, 取消运行", state.run.id)
+                state.run = await self._cancel_run_wait(thread_id, state.run)
+            raise
+        finally:
+            self._end_run(chatid)
+            if state.run is not None and state.run.status == 'requires_action': # 若中途出错退出, 需要取消运行, 避免thread被锁住
+                common.logger().warning("Run状态=reuires_action, 取消运行以解锁thread")
+                await self.aclient.beta.threads.runs.cancel(state.run.id, thread_id=thread_id)
+
+    async def _do_stream_action(self, chatid:str, action:str, arg:Any, send):
+        """ 执行 StreamRun 返回的动作 (工具调用除外). send 是发送消息的协程函数 """
+        if action == "begin":
+            self._begin_run(chatid, arg)
+        elif action == "text":
+            await send(ChatMsg(ContentType.text, arg))
+        elif action == "image":
+            await send(ChatMsg(ContentType.image, await self.download_openai_file(arg)))
+        elif action == "file":
+            await send(ChatMsg(ContentType.file, await self.download_openai_file(arg)))
+        elif action == "usage":
+            self._log_run_usage(arg)
+
+    async def _wait_tools(self, chatid:str, tool_calls:list, callback_msg:MSG_CALLBACK) -> list[dict]:
+        """ 并发处理 tool call, 每秒检查一次截止时间和取消请求。
+        返回提交的结果列表; 有取消请求时返回 None, 未完成的工具调用被取消 """
+        task = asyncio.ensure_future(asyncio.gather(
+            *(self._call_tool(tc.function.name, tc.function.arguments, callback_msg) for tc in tool_calls)))
+        try:
+            while True:
+                done, _ = await asyncio.wait({task}, timeout=1)
+                if done:
+                    return [{"tool_call_id": tc.id, "output": output} for tc, output in zip(tool_calls, task.result())]
+                common.check_deadline()
+                if self._take_cancel(chatid):
+                    return None
+        finally:
+            if not task.done():
+                task.cancel()
+
+    async def _cancel_run(self, thread_id:str, run):
+        """ 取消run, 返回取消后的run. 若run已结束无法取消, 返回最新状态 """
+        try:
+            run = await self.aclient.beta.threads.runs.cancel(run.id, thread_id=thread_id)
+            self.runs_cancelled += 1
+            common.logger().info("已取消运行 %s (累计 %d 次)", run.id, self.runs_cancelled)
+        except Exception as e:
+            common.logger().warning("取消运行 %s 失败: %s", run.id, e)
+            run = await self.aclient.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id, timeout=10)
+        return run
+
+    async def _cancel_run_wait(self, thread_id:str, run):
+        """ 取消run, 并等待其结束 (最多 CANCEL_WAIT 秒), 使 thread 可以立即用于下一个 run. 返回最新的 run """
+        run = await self._cancel_run(thread_id, run)
+        end = time.monotonic() + CANCEL_WAIT
+        while run.status in RUN_ACTIVE + ('cancelling',) and time.monotonic() < end:
+            await asyncio.sleep(0.5)
+            run = await self._retrieve_run(thread_id, run.id)
+        if run.status in RUN_ACTIVE + ('cancelling',):
+            common.logger().warning("run id %s 取消后 %d 秒仍未结束: %s", run.id, CANCEL_WAIT, run.status)
+        return run
+
+    async def _process_new_msgs(self, thread_id, last_msg_id, send) -> str:
+        """ 处理所有在last_msg_id之后的新消息, 返回最后一条消息id
+        send 是发送消息的协程函数 """
+        async for m in self.aclient.beta.threads.messages.list(thread_id=thread_id, order="asc", after=last_msg_id,
+            timeout=common.timeout_for(30)):
+            last_msg_id = m.id
+            for c in m.content:     # 处理 message 的每个 content
+                if c.type == 'text':
+                    await send(ChatMsg(ContentType.text, self._clean_text(c.text)))
+                elif c.type == 'image_file':
+                    dl_image = await self.download_openai_file(c.image_file.file_id)
+                    await send(ChatMsg(ContentType.image, dl_image))
+
+            for f in m.attachments:     # 处理每个附件
+                dl_file = await self.download_openai_file(f.file_id)
+                await send(ChatMsg(ContentType.file, dl_file))
+
+        return last_msg_id
+
+    async def _call_tool(self, name:str, arguments:str, callback_msg:MSG_CALLBACK) -> str:
+        """ 在线程池中处理工具调用, 返回结果 """
+        return await asyncio.to_thread(super()._call_tool, name, arguments, callback_msg)
+
+    async def download_openai_file(self, file_id:str, name_override:str = None) -> str:
+        """ 下载 OpenAI 文件保存到临时目录, 返回保存的本地文件名 """
+        file_data, file = await asyncio.gather(
+            self.aclient.files.content(file_id, timeout=common.timeout_for(60)),
+            self.aclient.files.retrieve(file_id, timeout=common.timeout_for(30)))
+
+        if name_override:
+            save_name = common.temp_file(name_override)
+        else:
+            filename = pathlib.Path(file.filename).name
+            save_name = common.temp_file(file.id + "_" + filename)
+
+        await asyncio.to_thread(pathlib.Path(save_name).write_bytes, file_data.content)
+        return save_name
+
+
 if __name__ == "__main__":
     # Test
     cfg = config.Config(common.DEFAULT_CONFIG)
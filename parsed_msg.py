@@ -0,0 +1,123 @@
+""" 解析后的微信消息: content 和 xml 最多解析一次, 各字段第一次访问时计算并缓存 """
+import re
+import time
+import xml.etree.ElementTree as ET
+
+from wcferry import WxMsg
+
+
+_UNSET = object()   # 表示字段尚未计算
+
+AT_USER_LIST = re.compile(r"<atuserlist>(?:<!\[CDATA\[)?(.*?)(?:\]\]>)?</atuserlist>", re.S)
+""" 匹配 msg.xml 中的 @ 名单 """
+
+AT_ALL = re.compile(r"@(?:所有人|all|All)")
+""" 匹配@所有人 """
+
+
+class ReferInfo:
+    """ 引用消息中被引用的消息 """
+    __slots__ = ("type", "svrid", "content")
+
+    def __init__(self, type:int, svrid:int, content:str) -> None:
+        """ 初始化
+        args:
+            type (int): 被引用消息的类型
+            svrid (int): 被引用消息的 MsgSvrID
+            content (str): 被引用消息的内容 (文本或xml)
+        """
+        self.type = type
+        self.svrid = svrid
+        self.content = content
+
+
+class ParsedMsg:
+    """ WxMsg 的包装, 缓存从 content / xml 解析得到的信息。
+    WxMsg 的属性和方法 (id, type, sender, roomid, from_group() 等) 直接转发给原消息。
+    """
+    __slots__ = ("msg", "my_wxid", "received", "rate_checked", "_content_xml", "_content_type", "_text", "_refer", "_at_list", "_at_me")
+
+    def __init__(self, msg:WxMsg, my_wxid:str) -> None:
+        """ 初始化
+        args:
+            msg (WxMsg): 原始消息
+            my_wxid (str): 自己的wxid, 用于判断是否@自己
+        """
+        self.msg = msg
+        self.my_wxid = my_wxid
+        self.received = time.monotonic()    # 收到消息的时间, 处理时限从这里开始计算
+        self.rate_checked = False   # 分发时已通过限流检查, 处理时不再检查
+        self._content_xml = _UNSET
+        self._content_type = _UNSET
+        self._text = _UNSET
+        self._refer = _UNSET
+        self._at_list = _UNSET
+        self._at_me = _UNSET
+
+    def __getattr__(self, name:str):
+        # 只有 __slots__ 以外的属性会到这里
+        return getattr(self.msg, name)
+
+    def __str__(self) -> str:
+        return str(self.msg)
+
+    @property
+    def content_xml(self) -> ET.Element:
+        """ content 解析得到的 xml, 不是xml时为None """
+        if self._content_xml is _UNSET:
+            try:
+                self._content_xml = ET.fromstring(self.msg.content) if self.msg.type != 1 else None
+            except Exception:
+                self._content_xml = None
+        return self._content_xml
+
+    @property
+    def content_type(self) -> int:
+        """ content xml 中的 appmsg/type, 没有的话为None """
+        if self._content_type is _UNSET:
+            try:
+                self._content_type = int(self.content_xml.find('appmsg/type').text)
+            except Exception:
+                self._content_type = None
+        return self._content_type
+
+    @property
+    def text(self) -> str:
+        """ 消息的文字部分, 没有则为空字符串 """
+        if self._text is _UNSET:
+            text = ""
+            if self.msg.type == 1:
+                text = self.msg.content
+            elif self.msg.type == 49 and self.content_xml is not None:    # 引用
+                title = self.content_xml.find('appmsg/title')
+                if title is not None and title.text:
+                    text = title.text
+            self._text = text
+        return self._text
+
+    @property
+    def refer(self) -> ReferInfo:
+        """ 被引用的消息, 不是引用消息时为None """
+        if self._refer is _UNSET:
+            self._refer = None
+            if self.msg.type == 49 and self.content_xml is not None:
+                refer_xml = self.content_xml.find('appmsg/refermsg')
+                if refer_xml is not None:
+                    self._refer = ReferInfo(int(refer_xml.find('type').text),
+                        int(refer_xml.find('svrid').text), refer_xml.find('content').text)
+        return self._refer
+
+    @property
+    def at_list(self) -> list[str]:
+        """ 消息@的 wxid 列表 """
+        if self._at_list is _UNSET:
+            m = AT_USER_LIST.search(self.msg.xml or "")
+            self._at_list = [w for w in m.group(1).split(",") if w] if m else []
+        return self._at_list
+
+    @property
+    def at_me(self) -> bool:
+        """ 是否@自己 (@所有人不算) """
+        if self._at_me is _UNSET:
+            self._at_me = not AT_ALL.search(self.msg.content or "") and self.my_wxid in self.at_list
+        return self._at_me
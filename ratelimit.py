@@ -0,0 +1,93 @@
+""" 令牌桶限流: 限制群内每个成员和每个群触发 AI 的频率 """
+import threading
+import time
+from typing import Hashable
+
+
+class TokenBucket:
+    """ 令牌桶. 容量为每分钟允许次数, 按恒定速率补充令牌 """
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, per_minute:float) -> None:
+        """ 初始化
+        args:
+            per_minute (float): 每分钟允许次数, 同时作为桶容量(允许的突发次数)
+        """
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60         # 每秒补充的令牌数
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now:float) -> None:
+        """ 按经过的时间补充令牌 """
+        if now <= self.updated:     # 桶在 now 之后创建
+            return
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_full(self, now:float) -> bool:
+        """ 桶是否已满 (长时间未使用) """
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class RateLimiter:
+    """ 按 key 管理一组令牌桶. 线程安全 """
+
+    PRUNE_SIZE = 1000   # 桶数超过该值时清理已满的桶
+
+    def __init__(self) -> None:
+        self.throttled = 0      # 被限流的消息数
+        self._buckets:dict[Hashable, TokenBucket] = {}
+        self._notified:set[Hashable] = set()   # 已提示过的 key, 恢复后清除
+        self._lock = threading.Lock()
+
+    def allow(self, limits:list[tuple[Hashable, float]]) -> bool:
+        """ 检查一组限制. 只有全部有令牌时才各消耗一个令牌并返回True, 否则不消耗并返回False
+
+        args:
+            limits (list): [(key, 每分钟允许次数)], 次数为 0 或 None 表示不限
+        """
+        now = time.monotonic()
+        with self._lock:
+            buckets = []
+            for key, per_minute in limits:
+                if not per_minute:
+                    continue
+                bucket = self._buckets.get(key)
+                if bucket is None or bucket.capacity != per_minute:
+                    bucket = self._buckets[key] = TokenBucket(per_minute)
+                bucket.refill(now)
+                buckets.append(bucket)
+
+            if any(b.tokens < 1 for b in buckets):
+                self.throttled += 1
+                return False
+
+            for b in buckets:
+                b.tokens -= 1
+            for key, _ in limits:
+                self._notified.discard(key)
+            if len(self._buckets) > self.PRUNE_SIZE:
+                self._prune(now)
+            return True
+
+    def refund(self, limits:list[tuple[Hashable, float]]) -> None:
+        """ 退还 allow 消耗的令牌 (如消息通过限流后未被处理). 参数同 allow """
+        with self._lock:
+            for key, per_minute in limits:
+                bucket = self._buckets.get(key)
+                if per_minute and bucket is not None:
+                    bucket.tokens = min(bucket.capacity, bucket.tokens + 1)
+
+    def first_notice(self, key:Hashable) -> bool:
+        """ 限流后是否是第一次提示该 key. 再次通过限流前只返回一次True """
+        with self._lock:
+            if key in self._notified:
+                return False
+            self._notified.add(key)
+            return True
+
+    def _prune(self, now:float) -> None:
+        """ 删除已满的桶, 等同于没有使用记录 """
+        for key in [k for k, b in self._buckets.items() if b.is_full(now)]:
+            del self._buckets[key]
@@ -0,0 +1,187 @@
+""" 消息路由表: 把白名单、前缀等配置预先编译成按对话id查找的路由, 快速判断是否响应消息 """
+import re
+import threading
+import time
+from typing import Callable
+
+import config
+from parsed_msg import ParsedMsg
+
+
+AT_PATTERN = re.compile(r"@.*?([\u2005\s]|$)")
+""" 匹配@前缀: @开头 + 任意字符 + \\u2005(1/4空格)或任意空白或结尾 """
+
+
+class PrefixMatcher:
+    """ 预编译的前缀匹配, 最长前缀优先 """
+    __slots__ = ("_regex",)
+
+    def __init__(self, prefixes:list[str]) -> None:
+        prefixes = sorted({str(p) for p in prefixes or [] if p}, key=len, reverse=True)
+        if prefixes:
+            self._regex = re.compile("|".join(re.escape(p) for p in prefixes))
+        else:
+            self._regex = None
+
+    def __bool__(self) -> bool:
+        return self._regex is not None
+
+    def match(self, text:str) -> bool:
+        """ 文本是否以任一前缀开头 """
+        return self._regex is not None and self._regex.match(text) is not None
+
+    def strip(self, text:str) -> str:
+        """ 去掉前缀返回正文. 若不以任一前缀开头, 返回None """
+        if self._regex is None:
+            return None
+        m = self._regex.match(text)
+        if m is None:
+            return None
+        return text[m.end():].strip()
+
+
+class GroupRoute:
+    """ 一个群聊的路由配置 """
+    __slots__ = ("enabled", "voice_msg", "preset", "prefix", "sender_rate", "room_rate")
+
+    def __init__(self, enabled:bool, voice_msg:bool, preset:str=None, prefix:PrefixMatcher=None,
+        sender_rate:float=0, room_rate:float=0) -> None:
+        """ 初始化
+        args:
+            enabled (bool): 是否响应该群
+            voice_msg (bool): 是否响应群中的语音消息
+            preset (str): 群的预设名, None=使用默认
+            prefix (PrefixMatcher): 群内无需@即可触发的前缀
+            sender_rate (float): 群内每个成员每分钟最多触发次数, 0=不限
+            room_rate (float): 整个群每分钟最多触发次数, 0=不限
+        """
+        self.enabled = enabled
+        self.voice_msg = voice_msg
+        self.preset = preset
+        self.prefix = prefix if prefix is not None else PrefixMatcher([])
+        self.sender_rate = sender_rate
+        self.room_rate = room_rate
+
+
+class RoutingTable:
+    """ 由配置编译得到的路由表. 在载入和重新载入配置时重建。
+    群聊按 roomid O(1) 查找路由; 单聊白名单按 wxid 缓存判断结果, 只在第一次遇到时查询微信号。
+    """
+
+    NEGATIVE_TTL = 600      # 单聊不在白名单的判断结果缓存时间(秒), 过期后重新查询微信号
+    SINGLE_CACHE_SIZE = 10000   # 单聊判断结果最多缓存数. 超出时先删除过期记录, 仍超出则删除最早的记录
+
+    def __init__(self, cfg:config.Config, wxid_to_wxcode:Callable[[str], str]) -> None:
+        """ 编译路由表
+
+        args:
+            cfg (Config): 配置
+            wxid_to_wxcode (Callable): 查询wxid对应微信号的函数
+        """
+        self.wxid_to_wxcode = wxid_to_wxcode
+        self.self_prefix = PrefixMatcher(cfg.self_prefix)
+        self.single_prefix = PrefixMatcher(cfg.single_chat_prefix)
+
+        # 群聊
+        all_groups = "$all" in cfg.group_whitelist
+        self.default_group = self._new_group(all_groups, cfg)
+        self.groups:dict[str, GroupRoute] = {}
+        for roomid in cfg.group_whitelist:
+            if roomid != "$all":
+                self.groups[roomid] = self._new_group(True, cfg)
+        for roomid, pr_name in (cfg.group_presets or {}).items():
+            self._group(roomid, all_groups, cfg).preset = pr_name
+        for roomid, override in (cfg.group_overrides or {}).items():  # 单独设置的群
+            route = self._group(roomid, all_groups, cfg)
+            override = override or {}
+            route.voice_msg = override.get('voice_msg', route.voice_msg)
+            route.preset = override.get('preset', route.preset)
+            route.prefix = PrefixMatcher(override.get('prefix', []))
+        for roomid, limits in (cfg.group_rate_limits or {}).items():    # 单独设置限流的群
+            route = self._group(roomid, all_groups, cfg)
+            limits = limits or {}
+            route.sender_rate = limits.get('sender', route.sender_rate)
+            route.room_rate = limits.get('room', route.room_rate)
+
+        # 单聊
+        self.all_singles = "$all" in cfg.single_chat_whitelist
+        self.single_codes = frozenset(cfg.single_chat_whitelist)
+        self._single_cache:dict[str, tuple[bool, float]] = {}     # {wxid: (是否在白名单, 过期时间)}, 按加入顺序
+        self._single_lock = threading.Lock()
+
+    def _new_group(self, enabled:bool, cfg:config.Config) -> GroupRoute:
+        """ 按全局配置创建群路由 """
+        return GroupRoute(enabled, cfg.group_voice_msg,
+            sender_rate=cfg.sender_rate_limit, room_rate=cfg.room_rate_limit)
+
+    def _group(self, roomid:str, enabled:bool, cfg:config.Config) -> GroupRoute:
+        """ 返回群的路由, 没有则创建 """
+        if roomid not in self.groups:
+            self.groups[roomid] = self._new_group(enabled, cfg)
+        return self.groups[roomid]
+
+    def group_route(self, roomid:str) -> GroupRoute:
+        """ 返回群聊的路由 """
+        return self.groups.get(roomid, self.default_group)
+
+    def group_presets(self) -> dict[str, str]:
+        """ 返回配置了预设的群 {roomid: 预设名} """
+        return {roomid: r.preset for roomid, r in self.groups.items() if r.preset}
+
+    def single_allowed(self, wxid:str) -> bool:
+        """ 单聊对象是否在白名单 """
+        if self.all_singles:
+            return True
+        cached = self._single_cache.get(wxid)
+        if cached and (cached[0] or cached[1] > time.time()):
+            return cached[0]
+        code = self.wxid_to_wxcode(wxid)
+        allowed = code in self.single_codes
+        if code:    # 查不到的联系人不缓存: 可能是联系人列表还在刷新的新好友. 联系人缓存自己有否定缓存
+            self._cache_single(wxid, allowed)
+        return allowed
+
+    def _cache_single(self, wxid:str, allowed:bool):
+        """ 缓存单聊白名单判断结果, 保持缓存数不超过 SINGLE_CACHE_SIZE """
+        now = time.time()
+        with self._single_lock:
+            cache = self._single_cache
+            cache.pop(wxid, None)
+            if len(cache) >= self.SINGLE_CACHE_SIZE:
+                for k in [k for k, (ok, expire) in cache.items() if not ok and expire <= now]:
+                    del cache[k]
+                while len(cache) >= self.SINGLE_CACHE_SIZE:
+                    del cache[next(iter(cache))]
+            cache[wxid] = (allowed, now + self.NEGATIVE_TTL)
+
+    def chat_allowed(self, msg:ParsedMsg) -> bool:
+        """ 消息所在的对话是否在白名单 """
+        if msg.from_group():
+            return self.group_route(msg.roomid).enabled
+        return self.single_allowed(msg.sender)
+
+    def is_at_me(self, msg:ParsedMsg) -> bool:
+        """ 判断群消息是否@自己 (排除@所有人) """
+        return msg.at_me
+
+    def may_respond(self, msg:ParsedMsg) -> bool:
+        """ 分发前的快速检查, 不做RPC和XML解析。
+        返回 False 的消息一定不需要响应; 返回 True 的消息仍需完整过滤 """
+        if msg.type not in (1, 34, 49):
+            return False
+
+        if msg.from_group():
+            route = self.group_route(msg.roomid)
+            if not route.enabled:
+                return False
+            if msg.type == 34:
+                return route.voice_msg
+            if msg.from_self():
+                return msg.type == 49 or self.self_prefix.match(msg.content.strip())
+            if self.is_at_me(msg):
+                return True
+            if msg.type == 1:
+                return route.prefix.match(msg.content.strip())
+            return bool(route.prefix)  # 引用消息需要解析XML才能判断前缀
+
+        return self.single_allowed(msg.sender)
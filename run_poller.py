@@ -0,0 +1,274 @@
+""" 集中查询 Assistant run 状态: 所有进行中的 run 由一个轮询服务查询, 间隔随 run 的运行时间增加 """
+import asyncio
+import heapq
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable
+
+import common
+
+
+class _TrackedRun:
+    """ 一个被轮询的 run """
+    __slots__ = ("thread_id", "run", "version", "started", "next_poll", "polls", "polling", "changed")
+
+    def __init__(self, thread_id:str, run:Any, changed:Any) -> None:
+        self.thread_id = thread_id
+        self.run = run                  # 最新的 run 对象
+        self.version = 0                # 调用方每次更新 run 加1, 丢弃更新前发出的查询结果
+        self.started = time.monotonic() # 计算轮询间隔的起始时间
+        self.next_poll = 0.0
+        self.polls = 0                  # 查询次数
+        self.polling = False            # 是否有查询在进行
+        self.changed = changed          # 状态变化时通知等待者 (threading.Event 或 asyncio.Event)
+
+
+class RunPoller:
+    """ run 状态轮询服务。
+    - 所有进行中的 run 由一个轮询线程按到期时间调度, 查询交给少量线程执行
+    - 轮询间隔 = run 运行时间 x BACKOFF_RATIO, 限制在 [MIN_INTERVAL, MAX_INTERVAL] 内: 刚开始的 run 频繁查询, 长时间运行的 run 逐渐放慢
+    - 等待者在 run 状态变化时被唤醒
+    """
+
+    MIN_INTERVAL = 0.1      # 最短轮询间隔(秒)
+    MAX_INTERVAL = 2.0      # 最长轮询间隔(秒)
+    BACKOFF_RATIO = 0.1     # 轮询间隔与运行时间的比例
+
+    def __init__(self, retrieve:Callable[[str, str], Any], workers:int=4) -> None:
+        """ 初始化
+
+        Args:
+            retrieve (Callable): 查询 run 的函数 (thread_id, run_id) -> run
+            workers (int): 同时进行的查询数
+        """
+        self.retrieve = retrieve
+        self.workers = workers
+        self.polls = 0          # 累计查询次数
+        self.finished = 0       # 已结束跟踪的 run 数
+        self.max_polls = 0      # 单个 run 的最多查询次数
+        self._runs:dict[str, _TrackedRun] = {}          # {run_id: 跟踪记录}
+        self._heap:list[tuple[float, str]] = []         # (下次查询时间, run_id)
+        self._cond = threading.Condition()
+        self._executor:ThreadPoolExecutor = None
+        self._thread:threading.Thread = None
+
+    def interval(self, tracked:_TrackedRun, now:float) -> float:
+        """ 返回 run 的轮询间隔 """
+        return min(self.MAX_INTERVAL, max(self.MIN_INTERVAL, (now - tracked.started) * self.BACKOFF_RATIO))
+
+    def track(self, thread_id:str, run:Any):
+        """ 开始跟踪 run """
+        with self._cond:
+            if self._thread is None:
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="run_poll")
+                self._thread = threading.Thread(target=self._run, name="run_poller", daemon=True)
+                self._thread.start()
+            tracked = _TrackedRun(thread_id, run, threading.Event())
+            self._runs[run.id] = tracked
+            self._schedule(tracked, time.monotonic())
+
+    def update(self, run:Any):
+        """ 调用方得到了新的 run 对象 (如提交工具结果后). 重新从最短间隔开始轮询 """
+        with self._cond:
+            tracked = self._runs.get(run.id)
+            if tracked is None:
+                return
+            tracked.run = run
+            tracked.version += 1
+            tracked.started = time.monotonic()
+            tracked.changed.clear()
+            self._schedule(tracked, tracked.started)
+
+    def wait(self, run_id:str, timeout:float) -> Any:
+        """ 等待 run 状态变化, 最多 timeout 秒. 返回最新的 run 对象 """
+        tracked = self._runs[run_id]
+        if tracked.changed.wait(timeout):
+            tracked.changed.clear()
+        return tracked.run
+
+    def wake(self, run_id:str):
+        """ 唤醒等待该 run 的调用方 (如请求取消时) """
+        tracked = self._runs.get(run_id)
+        if tracked is not None:
+            tracked.changed.set()
+
+    def untrack(self, run_id:str) -> int:
+        """ 停止跟踪 run, 返回它的查询次数 """
+        with self._cond:
+            tracked = self._runs.pop(run_id, None)
+            if tracked is None:
+                return 0
+            self.finished += 1
+            self.max_polls = max(self.max_polls, tracked.polls)
+            return tracked.polls
+
+    def active(self) -> int:
+        """ 正在跟踪的 run 数 """
+        return len(self._runs)
+
+    def avg_polls(self) -> float:
+        """ 平均每个 run 的查询次数 """
+        n = self.finished + len(self._runs)
+        return self.polls / n if n else 0.0
+
+    def _schedule(self, tracked:_TrackedRun, now:float):
+        tracked.next_poll = now + self.interval(tracked, now)
+        heapq.heappush(self._heap, (tracked.next_poll, tracked.run.id))
+        self._cond.notify()
+
+    def _due(self) -> _TrackedRun:
+        """ 取出下一个到期的 run. 调用时持有锁. 过期的堆记录直接丢弃 """
+        while True:
+            if not self._heap:
+                self._cond.wait()
+                continue
+            due, run_id = self._heap[0]
+            tracked = self._runs.get(run_id)
+            if tracked is None or tracked.next_poll != due or tracked.polling:
+                heapq.heappop(self._heap)
+                continue
+            wait = due - time.monotonic()
+            if wait > 0:
+                self._cond.wait(wait)
+                continue
+            heapq.heappop(self._heap)
+            tracked.polling = True
+            return tracked
+
+    def _run(self):
+        """ 轮询循环 """
+        while True:
+            with self._cond:
+                tracked = self._due()
+            self._executor.submit(self._poll, tracked)
+
+    def _poll(self, tracked:_TrackedRun):
+        """ 查询一次 run 状态, 状态变化时通知等待者 """
+        run = None
+        version = tracked.version
+        try:
+            run = self.retrieve(tracked.thread_id, tracked.run.id)
+        except Exception as e:
+            common.logger().warning("查询 run %s 状态失败: %s", tracked.run.id, e)
+        with self._cond:
+            tracked.polling = False
+            tracked.polls += 1
+            self.polls += 1
+            if tracked.run.id not in self._runs:
+                return
+            if run is not None and version == tracked.version:
+                changed = run.status != tracked.run.status
+                tracked.run = run       # 先更新再通知, 被唤醒的等待者读到的是新状态
+                if changed:
+                    tracked.changed.set()
+            self._schedule(tracked, time.monotonic())
+
+
+class AsyncRunPoller(RunPoller):
+    """ asyncio 版本的 run 状态轮询服务. 在事件循环中以一个任务调度所有查询, 等待者使用 asyncio.Event """
+
+    def __init__(self, retrieve:Callable[[str, str], Awaitable[Any]], workers:int=4) -> None:
+        """ 初始化. retrieve 是查询 run 的协程函数 (thread_id, run_id) -> run """
+        super().__init__(retrieve, workers)
+        self._loop:asyncio.AbstractEventLoop = None
+        self._wakeup:asyncio.Event = None
+        self._task:asyncio.Task = None
+        self._semaphore:asyncio.Semaphore = None
+
+    def track(self, thread_id:str, run:Any):
+        """ 开始跟踪 run. 在事件循环中调用 """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+            self._semaphore = asyncio.Semaphore(self.workers)
+            self._task = loop.create_task(self._run_async())
+        tracked = _TrackedRun(thread_id, run, asyncio.Event())
+        self._runs[run.id] = tracked
+        self._schedule(tracked, time.monotonic())
+
+    async def wait(self, run_id:str, timeout:float) -> Any:
+        """ 等待 run 状态变化, 最多 timeout 秒. 返回最新的 run 对象 """
+        tracked = self._runs[run_id]
+        try:
+            await asyncio.wait_for(tracked.changed.wait(), timeout)
+            tracked.changed.clear()
+        except asyncio.TimeoutError:
+            pass
+        return tracked.run
+
+    def wake(self, run_id:str):
+        """ 唤醒等待该 run 的协程. 可在任意线程调用 """
+        tracked = self._runs.get(run_id)
+        if tracked is not None and self._loop is not None:
+            self._loop.call_soon_threadsafe(tracked.changed.set)
+
+    def untrack(self, run_id:str) -> int:
+        """ 停止跟踪 run, 返回它的查询次数 """
+        tracked = self._runs.pop(run_id, None)
+        if tracked is None:
+            return 0
+        self.finished += 1
+        self.max_polls = max(self.max_polls, tracked.polls)
+        return tracked.polls
+
+    def update(self, run:Any):
+        """ 调用方得到了新的 run 对象. 重新从最短间隔开始轮询 """
+        tracked = self._runs.get(run.id)
+        if tracked is None:
+            return
+        tracked.run = run
+        tracked.version += 1
+        tracked.started = time.monotonic()
+        tracked.changed.clear()
+        self._schedule(tracked, tracked.started)
+
+    def _schedule(self, tracked:_TrackedRun, now:float):
+        tracked.next_poll = now + self.interval(tracked, now)
+        heapq.heappush(self._heap, (tracked.next_poll, tracked.run.id))
+        self._wakeup.set()
+
+    async def _run_async(self):
+        """ 轮询循环: 等到最早到期的 run, 为它创建查询任务 """
+        while True:
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+            due, run_id = self._heap[0]
+            tracked = self._runs.get(run_id)
+            if tracked is None or tracked.next_poll != due or tracked.polling:
+                heapq.heappop(self._heap)
+                continue
+            wait = due - time.monotonic()
+            if wait > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._heap)
+            tracked.polling = True
+            self._loop.create_task(self._poll_async(tracked))
+
+    async def _poll_async(self, tracked:_TrackedRun):
+        """ 查询一次 run 状态, 状态变化时通知等待者 """
+        run = None
+        version = tracked.version
+        try:
+            async with self._semaphore:
+                run = await self.retrieve(tracked.thread_id, tracked.run.id)
+        except Exception as e:
+            common.logger().warning("查询 run %s 状态失败: %s", tracked.run.id, e)
+        tracked.polling = False
+        tracked.polls += 1
+        self.polls += 1
+        if tracked.run.id not in self._runs:
+            return
+        if run is not None and version == tracked.version:
+            changed = run.status != tracked.run.status
+            tracked.run = run
+            if changed:
+                tracked.changed.set()
+        self._schedule(tracked, time.monotonic())
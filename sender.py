@@ -0,0 +1,179 @@
+""" 发送调度: 所有发出的微信消息经过一个队列, 由单独的发送线程依次发送 """
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from typing import Any, Callable
+
+import common
+
+
+class _SendJob:
+    """ 一个待发送的任务 """
+    __slots__ = ("fn", "args", "kwargs", "on_done", "queued_at", "attempts")
+
+    def __init__(self, fn:Callable[..., int], args:tuple, kwargs:dict, on_done:Callable[[Any], None]=None) -> None:
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.on_done = on_done      # 发送成功或放弃后调用, 参数为最后一次的结果
+        self.queued_at = time.monotonic()
+        self.attempts = 0
+
+
+class SendScheduler:
+    """ 发送调度器。
+    - 每个接收者的消息严格按提交顺序发送
+    - 同一接收者两次发送至少间隔 interval 秒, 所有发送至少间隔 global_interval 秒, 避免被微信限制
+    - 发送结果非0时重试, 间隔按 backoff 指数增加; 重试期间不阻塞其他接收者
+    - 调用方只入队, 不等待发送完成
+    """
+
+    def __init__(self, interval:float=1.0, global_interval:float=0.2, retries:int=2, backoff:float=1.0) -> None:
+        """ 初始化
+
+        Args:
+            interval (float): 同一接收者的最小发送间隔(秒)
+            global_interval (float): 所有发送的最小间隔(秒)
+            retries (int): 发送失败时的重试次数
+            backoff (float): 第一次重试的等待时间(秒), 之后每次加倍
+        """
+        self.configure(interval, global_interval, retries, backoff)
+        self.sent = 0               # 发送成功数
+        self.failed = 0             # 重试后仍失败数
+        self.retried = 0            # 重试次数
+        self.max_depth = 0          # 最大排队数
+        self.total_latency = 0.0    # 从入队到发送完成的总耗时(秒)
+        self.max_latency = 0.0      # 最大耗时(秒)
+
+        self._queues:dict[str, deque[_SendJob]] = {}     # 每个接收者的待发送队列
+        self._heap:list[tuple[float, int, str]] = []     # 有待发送消息的接收者 (可发送时间, 序号, 接收者)
+        self._next_time:dict[str, float] = {}           # 每个接收者下次可发送时间
+        self._global_next = 0.0
+        self._depth = 0
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name="msg_sender", daemon=True)
+
+    def configure(self, interval:float, global_interval:float, retries:int, backoff:float=1.0):
+        """ 设置发送间隔和重试参数 """
+        self.interval = interval
+        self.global_interval = global_interval
+        self.retries = retries
+        self.backoff = backoff
+
+    def start(self):
+        """ 启动发送线程 """
+        self._thread.start()
+
+    def stop(self, timeout:float=5):
+        """ 等待队列发送完毕(最多 timeout 秒)后停止发送线程 """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._depth and time.monotonic() < deadline:
+                self._cond.wait(0.1)
+            self._stop = True
+            self._cond.notify_all()
+
+    def submit(self, receiver:str, fn:Callable[..., int], *args, on_done:Callable[[Any], None]=None, **kwargs):
+        """ 把发送任务加入接收者的队列. fn(*args, **kwargs) 返回0表示成功
+
+        Args:
+            receiver (str): 接收者 wxid 或 roomid, 同一接收者按顺序发送
+            fn (Callable): 发送函数
+            on_done (Callable): 发送成功或重试后放弃时, 在发送线程中调用 on_done(结果)
+        """
+        job = _SendJob(fn, args, kwargs, on_done)
+        with self._cond:
+            q = self._queues.get(receiver)
+            if q is None:
+                q = self._queues[receiver] = deque()
+            q.append(job)
+            if len(q) == 1:     # 接收者之前没有待发送消息, 加入调度
+                self._push(receiver, self._next_time.get(receiver, 0))
+            self._depth += 1
+            self.max_depth = max(self.max_depth, self._depth)
+            self._cond.notify()
+
+    def depth(self) -> int:
+        """ 返回排队中的消息数 """
+        return self._depth
+
+    def avg_latency(self) -> float:
+        """ 返回平均发送耗时(秒) """
+        done = self.sent + self.failed
+        return self.total_latency / done if done else 0.0
+
+    def _push(self, receiver:str, ready_time:float):
+        heapq.heappush(self._heap, (ready_time, next(self._seq), receiver))
+
+    def _run(self):
+        """ 发送循环: 取出最早可发送的接收者, 发送其队首消息 """
+        while True:
+            with self._cond:
+                while True:
+                    if self._stop:
+                        return
+                    if self._heap:
+                        now = time.monotonic()
+                        ready = max(self._heap[0][0], self._global_next)
+                        if ready <= now:
+                            break
+                        self._cond.wait(ready - now)
+                    else:
+                        self._cond.wait()
+                _, _, receiver = heapq.heappop(self._heap)
+                job = self._queues[receiver][0]
+
+            result = self._send(job)
+            now = time.monotonic()
+
+            with self._cond:
+                self._global_next = now + self.global_interval
+                self._next_time[receiver] = now + self.interval
+                q = self._queues[receiver]
+                if result != 0 and job.attempts <= self.retries:    # 失败: 留在队首, 等待后重试
+                    self.retried += 1
+                    wait = self.backoff * 2 ** (job.attempts - 1)
+                    common.logger().warning("发送给 %s 失败(结果=%s), %.1f秒后第%d次重试", receiver, result, wait, job.attempts)
+                    self._push(receiver, max(now + wait, self._next_time[receiver]))    # 重试也遵守接收者的发送间隔
+                    continue
+
+                q.popleft()
+                self._depth -= 1
+                latency = now - job.queued_at
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+                if result == 0:
+                    self.sent += 1
+                else:
+                    self.failed += 1
+                    common.logger().error("发送给 %s 失败(结果=%s), 已放弃", receiver, result)
+                if q:
+                    self._push(receiver, self._next_time[receiver])
+                else:
+                    del self._queues[receiver]
+                    self._cleanup_next_time(now)
+                self._cond.notify_all()
+
+            if job.on_done is not None:
+                try:
+                    job.on_done(result)
+                except Exception as e:
+                    common.logger().error("发送完成回调错误: %s", common.error_trace(e))
+
+    def _send(self, job:_SendJob) -> Any:
+        """ 执行一次发送, 返回结果. 出错返回 -1 """
+        job.attempts += 1
+        try:
+            return job.fn(*job.args, **job.kwargs)
+        except Exception as e:
+            common.logger().error("发送消息错误: %s", common.error_trace(e))
+            return -1
+
+    def _cleanup_next_time(self, now:float):
+        """ 删除已过期的接收者发送间隔记录, 避免记录无限增长 """
+        if len(self._next_time) > 1000:
+            self._next_time = {r: t for r, t in self._next_time.items() if t > now or r in self._queues}
@@ -0,0 +1,229 @@
+""" 单元测试. 运行: python -m pytest test_cases.py """
+import asyncio
+import json
+import threading
+import time
+import unittest
+
+import bytes_extra
+
+try:     # 依赖 openai/httpx 等, 缺少依赖时跳过相关测试
+    import httpx
+    from openai import OpenAI, AsyncOpenAI
+    import openai_wrapper
+except ImportError:
+    openai_wrapper = None
+
+
+# BytesExtra 样本 (hex). 注意: 这是按 MSG 表 BytesExtra 字段的结构手工构造的合成数据, 不是抓取的真实数据,
+# 与真实数据的差异 (未知字段、字段顺序等) 测试不到. 取得真实样本后应替换为抓取的 BytesExtra, 并把 wxid/路径等标识脱敏
+IMAGE_EXTRA = bytes.fromhex(
+    "0a04081010001a4b080212473c6d7367736f757263653e3c7365635f6d73675f6e6f64653e3c757569643e3263316534"
+    "613c2f757569643e3c2f7365635f6d73675f6e6f64653e3c2f6d7367736f757263653e1a7b08031277777869645f6162"
+    "633132335c46696c6553746f726167655c4d73674174746163685c346665333761383438396531363139633666666462"
+    "66323463386664643662305c5468756d625c323032342d30315c34626230353163616662326539383238316632646136"
+    "373163323535653166365f742e6461741a7908041275777869645f6162633132335c46696c6553746f726167655c4d73"
+    "674174746163685c34666533376138343839653136313963366666646266323463386664643662305c496d6167655c32"
+    "3032342d30315c34626230353163616662326539383238316632646136373163323535653166362e646174")
+""" 图片消息: 消息来源xml, 缩略图路径, 图片路径 """
+
+GROUP_TEXT_EXTRA = bytes.fromhex(
+    "0a04081010001a110801120d777869645f73656e64657230311a4b080212473c6d7367736f757263653e3c7365635f6d"
+    "73675f6e6f64653e3c757569643e3263316534613c2f757569643e3c2f7365635f6d73675f6e6f64653e3c2f6d736773"
+    "6f757263653e")
+""" 群文字消息: 发送者wxid, 消息来源xml """
+
+LONG_FILE_PATH = "wxid_abc123\\FileStorage\\File\\2024-01\\" + "季度报告_最终版" * 12 + ".pdf"
+""" 文件路径超过127字节, 长度需要两个字节的 varint """
+
+
+def _varint(n:int) -> bytes:
+    out = b""
+    while True:
+        b, n = n & 0x7f, n >> 7
+        if n == 0:
+            return out + bytes([b])
+        out += bytes([b | 0x80])
+
+
+def _field(num:int, payload:bytes) -> bytes:
+    return _varint(num << 3 | 2) + _varint(len(payload)) + payload
+
+
+def _item(extra_type:int, value:str) -> bytes:
+    return _field(3, _varint(1 << 3) + _varint(extra_type) + _field(2, value.encode()))
+
+
+class TestBytesExtra(unittest.TestCase):
+    """ bytes_extra 解析 """
+
+    def test_read_varint(self):
+        self.assertEqual(bytes_extra.read_varint(b"\x05", 0), (5, 1))
+        self.assertEqual(bytes_extra.read_varint(b"\xb6\x02", 0), (310, 2))
+        self.assertEqual(bytes_extra.read_varint(b"\x00\xac\x02", 1), (300, 3))
+        with self.assertRaises(ValueError):
+            bytes_extra.read_varint(b"\x80", 0)
+
+    def test_image(self):
+        extra = bytes_extra.decode(IMAGE_EXTRA)
+        self.assertEqual(extra.path, "wxid_abc123\\FileStorage\\MsgAttach\\4fe37a8489e1619c6ffdbf24c8fdd6b0"
+            "\\Image\\2024-01\\4bb051cafb2e98281f2da671c255e1f6.dat")
+        self.assertEqual(extra.thumb, "wxid_abc123\\FileStorage\\MsgAttach\\4fe37a8489e1619c6ffdbf24c8fdd6b0"
+            "\\Thumb\\2024-01\\4bb051cafb2e98281f2da671c255e1f6_t.dat")
+        self.assertIsNone(extra.wxid)
+        self.assertTrue(extra.values[bytes_extra.ExtraType.msg_source].startswith("<msgsource>"))
+
+    def test_group_text(self):
+        extra = bytes_extra.decode(GROUP_TEXT_EXTRA)
+        self.assertEqual(extra.wxid, "wxid_sender01")
+        self.assertIsNone(extra.path)
+        self.assertIsNone(extra.thumb)
+
+    def test_long_path(self):
+        data = bytes.fromhex("0a0408101000") + _item(4, LONG_FILE_PATH)
+        self.assertEqual(bytes_extra.decode(data).path, LONG_FILE_PATH)
+
+    def test_first_value_wins(self):
+        data = _item(4, "first.dat") + _item(4, "second.dat")
+        self.assertEqual(bytes_extra.decode(data).path, "first.dat")
+
+    def test_skips_unknown_fields(self):
+        fixed = _varint(5 << 3 | 1) + bytes(8) + _varint(6 << 3 | 5) + bytes(4) + _varint(7 << 3) + _varint(2**40)
+        data = fixed + _item(1, "wxid_x") + _item(9, "unknown")
+        extra = bytes_extra.decode(data)
+        self.assertEqual(extra.wxid, "wxid_x")
+        self.assertEqual(extra.values[9], "unknown")
+
+    def test_empty(self):
+        self.assertEqual(bytes_extra.decode(b"").values, {})
+
+    def test_truncated(self):
+        with self.assertRaises(ValueError):
+            bytes_extra.decode(IMAGE_EXTRA[:-10])
+        with self.assertRaises(ValueError):
+            bytes_extra.decode(b"\x0b\x00")     # wire type 3 (group) 不支持
+
+def _run_obj(status:str, **kw) -> dict:
+    run = {"id": "run_1", "object": "thread.run", "created_at": 0, "thread_id": "thread_1", "assistant_id": "asst_1",
+        "status": status, "instructions": "", "model": "gpt-4o", "tools": [], "parallel_tool_calls": True,
+        "tool_choice": "auto", "truncation_strategy": None, "usage": None}
+    run.update(kw)
+    return run
+
+
+def _step_obj(status:str) -> dict:
+    return {"id": "step_1", "object": "thread.run.step", "created_at": 0, "run_id": "run_1", "thread_id": "thread_1",
+        "assistant_id": "asst_1", "type": "tool_calls", "status": status,
+        "step_details": {"type": "tool_calls", "tool_calls": []}}
+
+
+def _text_delta(text:str) -> dict:
+    return {"id": "msg_1", "object": "thread.message.delta",
+        "delta": {"content": [{"index": 0, "type": "text", "text": {"value": text, "annotations": []}}]}}
+
+
+def _sse(events:list) -> str:
+    return "".join(f"event: {e}\ndata: {json.dumps(d)}\n\n" for e, d in events) + "event: done\ndata: [DONE]\n\n"
+
+
+# 录制的事件序列: 第一段流在 requires_action 结束, 提交工具结果后继续第二段流
+TOOL_CALLS = {"type": "submit_tool_outputs", "submit_tool_outputs": {"tool_calls": [
+    {"id": "call_1", "type": "function", "function": {"name": "get_time", "arguments": "{}"}}]}}
+STREAM_EVENTS = [
+    ("thread.run.created", _run_obj("queued")),
+    ("thread.run.in_progress", _run_obj("in_progress")),
+    ("thread.run.step.created", _step_obj("in_progress")),
+    ("thread.run.step.delta", {"id": "step_1", "object": "thread.run.step.delta",
+        "delta": {"step_details": {"type": "tool_calls", "tool_calls": []}}}),
+    ("thread.message.delta", _text_delta("第一段" * 20 + "\n\n第二")),
+    ("thread.message.delta", _text_delta("段")),
+    ("thread.run.requires_action", _run_obj("requires_action", required_action=TOOL_CALLS)),
+]
+SUBMIT_EVENTS = [
+    ("thread.run.step.completed", _step_obj("completed")),
+    ("thread.message.delta", _text_delta("工具之后")),
+    ("thread.message.completed", {"id": "msg_1", "object": "thread.message", "created_at": 0, "thread_id": "thread_1",
+        "role": "assistant", "content": [], "attachments": [], "status": "completed", "metadata": {},
+        "assistant_id": "asst_1", "run_id": "run_1", "completed_at": 0, "incomplete_at": None, "incomplete_details": None}),
+    ("thread.run.step.completed", _step_obj("completed")),
+    ("thread.run.completed", _run_obj("completed", usage={"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15})),
+]
+
+
+@unittest.skipIf(openai_wrapper is None, "缺少 openai_wrapper 的依赖")
+class TestStreamRun(unittest.TestCase):
+    """ 回放录制的流式事件, 检查 run step 事件不会覆盖 run """
+
+    def setUp(self):
+        self.requests = []
+        self.sent = []
+        self.stream_events = STREAM_EVENTS
+        wrapper = object.__new__(openai_wrapper.OpenAIWrapper)
+        wrapper._lock = threading.Lock()
+        wrapper._active_runs = {}
+        wrapper._cancel_requests = set()
+        wrapper.runs_cancelled = 0
+        wrapper._assistant_id = "asst_1"
+        wrapper.tools = {}
+        wrapper._call_tool = lambda name, arguments, callback_msg: "12:00"
+        wrapper.client = OpenAI(api_key="test", http_client=httpx.Client(transport=httpx.MockTransport(self._handle)))
+        self.wrapper = wrapper
+
+    def _handle(self, request:httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        if request.url.path.endswith("/cancel"):
+            return httpx.Response(200, json=_run_obj("cancelled"))
+        events = SUBMIT_EVENTS if request.url.path.endswith("/submit_tool_outputs") else self.stream_events
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, text=_sse(events))
+
+    async def _ahandle(self, request:httpx.Request) -> httpx.Response:
+        return self._handle(request)
+
+    def test_replay(self):
+        self.wrapper._run_stream("chat_1", "thread_1", None, lambda msg: self.sent.append(msg.content))
+        self.assertEqual(self.sent, ["第一段" * 20, "第二段", "工具之后"])
+        self.assertEqual([r.url.path for r in self.requests],
+            ["/v1/threads/thread_1/runs", "/v1/threads/thread_1/runs/run_1/submit_tool_outputs"])
+        body = json.loads(self.requests[1].content)
+        self.assertEqual(body["tool_outputs"], [{"tool_call_id": "call_1", "output": "12:00"}])
+        self.assertEqual(self.wrapper._active_runs, {})
+
+    def test_replay_async(self):
+        wrapper = object.__new__(openai_wrapper.AsyncOpenAIWrapper)
+        wrapper.__dict__.update(self.wrapper.__dict__)
+        wrapper.aclient = AsyncOpenAI(api_key="test",
+            http_client=httpx.AsyncClient(transport=httpx.MockTransport(self._ahandle)))
+        async def call_tool(name, arguments, callback_msg):
+            return "12:00"
+        wrapper._call_tool = call_tool
+        async def send(msg):
+            self.sent.append(msg.content)
+        asyncio.run(wrapper._run_stream("chat_1", "thread_1", None, None, send))
+        self.assertEqual(self.sent, ["第一段" * 20, "第二段", "工具之后"])
+        self.assertEqual(len(self.requests), 2)
+
+    def test_terminal_events(self):
+        for event, notice in (("thread.run.expired", "API运行超时, 已过期"),
+            ("thread.run.incomplete", "API运行未完成: max_completion_tokens")):
+            self.sent.clear()
+            self.stream_events = STREAM_EVENTS[:2] + [("thread.message.delta", _text_delta("部分回复")),
+                (event, _run_obj(event.rsplit(".", 1)[1], incomplete_details={"reason": "max_completion_tokens"}))]
+            self.wrapper._run_stream("chat_1", "thread_1", None, lambda msg: self.sent.append(msg.content))
+            self.assertEqual(self.sent, ["部分回复", notice])
+
+    def test_cancel_during_tool_call(self):
+        def slow_tool(name, arguments, callback_msg):
+            self.wrapper.request_cancel("chat_1", "测试")  # 工具运行期间收到新消息
+            time.sleep(5)
+            return "late"
+        self.wrapper._call_tool = slow_tool
+        self.wrapper.poller = openai_wrapper.run_poller.RunPoller(None)
+        start = time.monotonic()
+        self.wrapper._run_stream("chat_1", "thread_1", None, lambda msg: self.sent.append(msg.content))
+        self.assertLess(time.monotonic() - start, 3)
+        self.assertTrue(self.requests[-1].url.path.endswith("/runs/run_1/cancel"))
+        self.assertNotIn("工具之后", self.sent)
+
+
+if __name__ == "__main__":
+    unittest.main()
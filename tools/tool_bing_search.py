@@ -78,7 +78,7 @@ class Tool_bing_search(ToolBase):
         headers = { 'Ocp-Apim-Subscription-Key': api_key }
 
         # Call the API        
-        response = requests.get(endpoint, headers=headers, params=params)
+        response = requests.get(endpoint, headers=headers, params=params, timeout=common.timeout_for(10))
         response.raise_for_status()
         results = response.json()
         
@@ -53,7 +53,7 @@ class Tool_text_to_image(ToolBase):
         url, revised_prompt = self.oaiw.text_to_image(prompt, quality)
 
         # common.logger().info("下载图片: %s", url)
-        tempfile = common.temp_file(f"openai_image_{common.timestamp()}.png")
+        tempfile = common.unique_temp_file("openai_image", ".png")
         proxy = self.config.OPENAI.get('proxy', None)   # 使用openai proxy
         res = common.download_file(url, tempfile, proxy)
         if res == 0:    #下载成功:
@@ -0,0 +1,166 @@
+""" WechatFerry 命令执行器: 所有 wcf 调用经过这里, 串行执行命令请求、合并相同的并发读取、统计每个方法的请求耗时 """
+import bisect
+import threading
+import time
+from typing import Any
+
+from wcferry import Wcf
+
+
+class LatencyHistogram:
+    """ 耗时直方图. 按固定的桶边界(毫秒)计数 """
+    __slots__ = ("counts", "total", "max")
+
+    BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+    """ 桶上限(毫秒), 超过最后一个上限的计入最后一个桶 """
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(self.BOUNDS_MS) + 1)
+        self.total = 0.0        # 总耗时(秒)
+        self.max = 0.0          # 最大耗时(秒)
+
+    def record(self, seconds:float):
+        """ 记录一次耗时 """
+        self.counts[bisect.bisect_left(self.BOUNDS_MS, seconds * 1000)] += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def count(self) -> int:
+        """ 记录次数 """
+        return sum(self.counts)
+
+    def mean(self) -> float:
+        """ 平均耗时(秒) """
+        n = self.count()
+        return self.total / n if n else 0.0
+
+    def percentile(self, p:float) -> float:
+        """ 返回耗时的 p 分位数(秒), 取所在桶的上限 (不超过最大耗时) """
+        n = self.count()
+        if n == 0:
+            return 0.0
+        rank = p / 100 * n
+        acc = 0
+        for i, c in enumerate(self.counts):
+            acc += c
+            if acc >= rank and c:
+                return min(self.BOUNDS_MS[i] / 1000, self.max) if i < len(self.BOUNDS_MS) else self.max
+        return self.max
+
+
+class _Flight:
+    """ 一次进行中的调用, 供相同请求的其他线程等待结果 """
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result:Any = None
+        self.error:BaseException = None
+
+
+class WcfExecutor:
+    """ Wcf 对象的线程安全代理。
+    - wcferry 的所有命令请求共用一个 pynng socket, 多个线程同时请求会使请求和应答错乱。
+      锁只加在 Wcf._send_request (一次请求/应答) 上, 方法内的等待 (如 download_image 等待文件下载) 不占用 socket
+    - SINGLE_FLIGHT 中的只读方法, 参数相同的并发调用只执行一次, 其他线程等待并共用结果
+    - 按方法统计每次请求/应答的耗时 (不含等锁和方法内的等待) 和合并的调用次数
+    """
+
+    UNLOCKED = ("get_msg", "is_receiving_msg")
+    """ 不经过命令 socket 的方法, 直接返回原方法 """
+
+    SINGLE_FLIGHT = ("get_contacts", "get_chatroom_members", "query_sql")
+    """ 可以合并并发调用的只读方法 """
+
+    def __init__(self, wcf:Wcf) -> None:
+        self._wcf = wcf
+        self._lock = threading.Lock()       # 串行执行命令请求
+        self._local = threading.local()     # 当前线程正在执行的方法名, 请求耗时计入该方法
+        self._send_request = wcf._send_request
+        wcf._send_request = self._locked_request    # wcf 内部的所有请求都经过锁
+        self._flights_lock = threading.Lock()
+        self._flights:dict[tuple, _Flight] = {}
+        self.latency:dict[str, LatencyHistogram] = {}   # {方法名: 耗时直方图}
+        self.merged:dict[str, int] = {}                 # {方法名: 合并的调用次数}
+
+    def __getattr__(self, name:str):
+        attr = getattr(self._wcf, name)
+        if not callable(attr) or name in self.UNLOCKED:
+            return attr
+
+        if name in self.SINGLE_FLIGHT:
+            def single_flight_call(*args, **kwargs):
+                return self._single_flight(name, attr, args, kwargs)
+            return single_flight_call
+
+        def named_call(*args, **kwargs):
+            return self._call(name, attr, args, kwargs)
+        return named_call
+
+    def _call(self, name:str, fn, args:tuple, kwargs:dict) -> Any:
+        """ 执行一次调用. 期间的命令请求耗时计入 name (嵌套调用计入最外层的方法) """
+        outer = getattr(self._local, "method", None)
+        if outer is None:
+            self._local.method = name
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            if outer is None:
+                self._local.method = None
+
+    def _locked_request(self, req) -> Any:
+        """ 在锁内执行一次命令请求/应答, 记录耗时 """
+        name = getattr(self._local, "method", None) or "_send_request"
+        with self._lock:
+            start = time.perf_counter()
+            try:
+                return self._send_request(req)
+            finally:
+                hist = self.latency.get(name)
+                if hist is None:
+                    hist = self.latency[name] = LatencyHistogram()
+                hist.record(time.perf_counter() - start)
+
+    def _single_flight(self, name:str, fn, args:tuple, kwargs:dict) -> Any:
+        """ 执行调用. 已有参数相同的调用在进行时, 等待并返回它的结果 """
+        key = (name, args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:   # 参数不可哈希, 不合并
+            return self._call(name, fn, args, kwargs)
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                leader = True
+            else:
+                leader = False
+                self.merged[name] = self.merged.get(name, 0) + 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self._call(name, fn, args, kwargs)
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._flights_lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def stats(self) -> list[str]:
+        """ 返回每个方法的调用统计文本, 按总耗时从大到小 """
+        lines = []
+        for name, h in sorted(self.latency.items(), key=lambda kv: kv[1].total, reverse=True):
+            line = (f"{name}: {h.count()}次, 平均 {h.mean()*1000:.0f}ms, "
+                f"p50 {h.percentile(50)*1000:.0f}ms, p95 {h.percentile(95)*1000:.0f}ms, 最大 {h.max*1000:.0f}ms")
+            if self.merged.get(name):
+                line += f", 合并 {self.merged[name]}次"
+            lines.append(line)
+        return lines
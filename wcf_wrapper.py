@@ -5,42 +5,60 @@ import pathlib
 from wcferry import Wcf, WxMsg
 import common
 from common import ContentType, ChatMsg
+import bytes_extra
+import contacts
+import image_dat
+import media
+import msg_store
+import sender
+import wcf_rpc
+from parsed_msg import ParsedMsg
 import threading
+import time
+from collections import OrderedDict
 import xml.etree.ElementTree as ET
 
 class WcfWrapper:
     """ 通过 WechatFerry 操作微信 """
+
+    SVRID_INDEX_SIZE = 10000    # MsgSvrID->分片索引的最大记录数
+    RECENT_MSG_SIZE = 5000      # 最近消息缓存的最大记录数
+    RECENT_MSG_BYTES = 16*2**20 # 最近消息缓存的大小上限(字节)
+    MSG_DBS_TTL = 60            # 查找不到消息时, 重新读取分片列表的最短间隔(秒)
+
     def __init__(self) -> None:
-        self.wcf = Wcf(debug=True)   # 创建WechatFerry实例，用于控制wechat
+        self.wcf = wcf_rpc.WcfExecutor(Wcf(debug=True))   # 创建WechatFerry实例，用于控制wechat. 多线程共用, 所有调用经过执行器串行执行
         # self.wxid = self.wcf.get_self_wxid()    #自己的微信ID
         self.userinfo = self.wcf.get_user_info()
         self.my_name = self.userinfo['name']
         self.my_wxid = self.userinfo['wxid']
         self.msg_types = self.wcf.get_msg_types()
         self.msg_types[49] = '引用,文件,共享链接,..'
-        self.contacts = self.read_contacts()
-        self.wcf_lock = threading.Lock()
+        self.contacts = contacts.ContactCache(self.wcf.get_contacts, common.data_file(f"contacts_{self.my_wxid}.json"))
+        self.contacts.start()
+        self.room_members = contacts.RoomMemberCache(self.wcf.get_chatroom_members, self.wcf.get_alias_in_chatroom)
+        self._msg_dbs:list[str] = None      # 消息数据库分片列表, 最新的在前
+        self._msg_dbs_time = 0.0
+        self._svrid_index:OrderedDict[int, str] = OrderedDict()    # {MsgSvrID: 所在分片}
+        self._index_lock = threading.Lock()
+        self.recent_msgs = msg_store.RecentMsgStore(self.RECENT_MSG_SIZE, self.RECENT_MSG_BYTES)    # 最近收到的消息, 解析引用时优先查找
+        self.msg_dbs()
+        self.sender = sender.SendScheduler()    # 发送队列, 所有发送由发送线程完成
+        self.sender.start()
+        self.prefetcher = media.MediaPrefetcher(self.fetch_media)    # 媒体预取, 由 configure 启用
         common.logger().info("Wechat Ferry 初始化完成。登录微信=%s (wxid=%s)", self.my_name, self.my_wxid)
         self.wcf.enable_receiving_msg() # 开始接收消息
 
     def __del__(self):
         self.wcf.cleanup()  # 退出清理，否则微信客户端会异常
 
-    def read_contacts(self) -> dict:
-        """ 读取联系人列表, 存到dict {wxid:contact_dict}"""
-        contact_list = self.wcf.get_contacts()
-        contact_dict = {}
-        for contact in contact_list:
-            contact_dict[contact['wxid']] = contact
-        return contact_dict
-
     def msg_preview_str(self, msg:WxMsg) -> str:
         """ 返回消息预览字符串 """
         # 群聊：群id|sender, 群名|发送人nickname
         # 单聊：sender, 发送人nickname
         if msg.from_group():
             room_name = self.wxid_to_nickname(msg.roomid)
-            nickname = self.wcf.get_chatroom_members(msg.roomid).get(msg.sender, "")            
+            nickname = self.room_members.member_name(msg.roomid, msg.sender)
             sender_str = f"{msg.roomid}|{msg.sender},{room_name}|{nickname}"
         else:
             nickname = self.wxid_to_nickname(msg.sender)
@@ -53,20 +71,15 @@ class WcfWrapper:
         preview =  sender_str + ": " + content
         return preview
 
-    def wxid_to_contact(self, wxid:str) -> dict:
-        """ 根据 wxid 返回联系人 dict。如果找不到返回 None"""
-        if wxid in self.contacts:
-            return self.contacts[wxid]
-        else:
-            # 重试读取最新联系人
-            self.contacts = self.read_contacts()
-            return self.contacts.get(wxid, None)
+    def wxid_to_contact(self, wxid:str) -> contacts.Contact:
+        """ 根据 wxid 返回联系人。如果找不到返回 None"""
+        return self.contacts.get(wxid)
 
     def wxid_to_nickname(self, wxid:str) -> str:
         """ 返回wxid对应的昵称, 或者None """
         c = self.wxid_to_contact(wxid)
         if c:
-            return c['name']
+            return c.name
         else:
             return ""
         # # sender = self.wcf.get_info_by_wxid(wxid)['name']
@@ -78,65 +91,40 @@ class WcfWrapper:
         """ 返回wxid对应的微信号, 或者None """
         c = self.wxid_to_contact(wxid)
         if c:
-            return c['code']
+            return c.code
         else:
             return ""
 
-    def get_msg(self) -> WxMsg:
-        """ 从wechat ferry获取消息, 无消息抛异常
+    def parse(self, msg:WxMsg) -> ParsedMsg:
+        """ 返回解析后的消息. 已经是 ParsedMsg 则直接返回 """
+        if isinstance(msg, ParsedMsg):
+            return msg
+        return ParsedMsg(msg, self.my_wxid)
+
+    def get_msg(self) -> ParsedMsg:
+        """ 从wechat ferry获取消息. 无消息时阻塞等待, 超过1秒仍无消息抛出 queue.Empty
 
         Returns:
-            WxMsg: 消息对象
+            ParsedMsg: 解析后的消息对象
         """
-        msg = self.wcf.get_msg()
-        # if self.msg_dict is None:
-        #     self.msg_dict:dict = {}
-        # self.msg_dict[msg.id] = msg
-
-        # if len(self.msg_dict) > 2000:
-        #     common.logger().info("消息缓存过多, 清理删除一半")
-        #     keys_to_remove = list(self.msg_dict)[:len(self.msg_dict)//2]  # 获取前一半的键
-        #     for key in keys_to_remove:
-        #         del self.msg_dict[key]  # 删除这些键
+        msg = self.parse(self.wcf.get_msg())
+        if self._msg_dbs:   # 新消息写入最新的分片
+            self._index_msg(msg.id, self._msg_dbs[0])
+        self.recent_msgs.add(msg)
         return msg
 
     def is_msg_at_me(self, msg:WxMsg) -> bool:
         """ 判断消息是否@自己"""
-        members = self.wcf.get_chatroom_members(msg.roomid)
-        # my_wxid = next((k for k, v in members.items() if v == self.my_name), None)
-        # if not my_wxid:
-        #     common.logger().warning("无法找到自己的wxid, 无法判断是否@自己")
-        #     return False
-        if re.findall(r"@(?:所有人|all|All)", msg.content):
-            return False  # 排除 @ 所有人
-        if re.findall(f"<atuserlist>[\s|\S]*({self.my_wxid})[\s|\S]*</atuserlist>", msg.xml):
-            return True  # 在 @ 清单里
-        else:
-            return False
+        return self.parse(msg).at_me
 
     def get_msg_text(self, msg:WxMsg) -> str:
         """ 返回消息的文字部分, 没有则返回空字符串"""
-        if msg.type == 1:
-            return msg.content
-        elif msg.type == 49:    # 引用
-            content = ET.fromstring(msg.content)
-            title = content.find('appmsg/title')
-            if title is not None:
-                return title.text
-            else:
-                return ""
-        else:
-            return ""
+        return self.parse(msg).text
 
 
     def get_content_type(self, msg:WxMsg) -> int:
         """ 返回content xml中的type, 没有的话返回None"""
-        try:
-            content_xml = ET.fromstring(msg.content)
-            t = int(content_xml.find('appmsg/type').text)
-            return t
-        except Exception as e:
-            return None
+        return self.parse(msg).content_type
 
     def get_refer_content(self, msg:WxMsg) -> ChatMsg:
         """返回被引用的内容, 如果没有返回None
@@ -151,17 +139,23 @@ class WcfWrapper:
             return None
 
         try:
-            content = ET.fromstring(msg.content)
-            refermsg_xml = content.find('appmsg/refermsg')
-            if refermsg_xml is None:
+            refer = self.parse(msg).refer
+            if refer is None:
                 return None
 
             # 判断refermsg类型
-            refer_type = int(refermsg_xml.find('type').text)  # 被引用消息type
-            refer_id = int(refermsg_xml.find('svrid').text)
+            refer_type = refer.type  # 被引用消息type
+            refer_id = refer.svrid
+            stored = self.recent_msgs.get(refer_id)     # 最近收到的消息有完整内容, 无需查询数据库
+            refer_content = stored.content if stored is not None and stored.content else refer.content
+
+            if refer_type in media.MEDIA_TYPES and self.prefetcher.enabled:     # 已预取的媒体
+                prefetched = self.prefetcher.get(refer_id)
+                if prefetched:
+                    return prefetched
 
             if refer_type == 1:   #文本
-                return ChatMsg(ContentType.text, refermsg_xml.find('content').text)
+                return ChatMsg(ContentType.text, refer_content)
 
             elif refer_type == 3: #图片 下载图片
                 refer_extra = self.get_msg_extra(refer_id, msg.extra)
@@ -173,7 +167,7 @@ class WcfWrapper:
                 return ChatMsg(ContentType.ERROR, None)
 
             elif refer_type == 34:    # 语音: 下载语音文件
-                audio_file = self.wcf.get_audio_msg(refer_id, common.temp_dir())
+                audio_file = self.get_audio(refer_id)
                 if audio_file:
                     return ChatMsg(ContentType.voice, audio_file)
                 else:
@@ -189,7 +183,7 @@ class WcfWrapper:
                     return ChatMsg(ContentType.ERROR, None)
 
             elif refer_type == 49:        # 文件，链接，公众号文章，或另一个引用. 需要进一步判断
-                refer_content_xml = ET.fromstring(refermsg_xml.find('content').text)
+                refer_content_xml = ET.fromstring(refer_content)
                 content_type = int(refer_content_xml.find('appmsg/type').text)
                 if content_type in [4,5]:   # 链接或公众号文章
                     texts = []
@@ -206,7 +200,6 @@ class WcfWrapper:
                     return ChatMsg(ContentType.link, text)
 
                 elif content_type == 6:     #文件
-                    # refer_msg = self.msg_dict.get(refer_id, None)
                     refer_extra = self.get_msg_extra(refer_id, msg.extra)
                     if refer_extra:
                         dl_file = refer_extra
@@ -228,24 +221,77 @@ class WcfWrapper:
                 common.logger().warning("不支持该类型引用, type=%s", str(refer_type))
                 return ChatMsg(ContentType.UNSUPPORTED, None)
 
+        except common.DeadlineExceeded:
+            raise
         except Exception as e:
             common.logger().error("读取引用消息发生错误: %s", common.error_trace(e))
             return ChatMsg(ContentType.ERROR, None)
 
+    def fetch_media(self, msg:WxMsg) -> ChatMsg:
+        """ 下载图片/语音/视频消息的文件, 供媒体预取使用. 失败返回 None """
+        if msg.type == 3:
+            dl_file = self.get_image(msg.id, msg.extra)
+            return ChatMsg(ContentType.image, dl_file) if dl_file else None
+        elif msg.type == 34:
+            audio_file = self._download_audio(msg.id)
+            return ChatMsg(ContentType.voice, audio_file) if audio_file else None
+        elif msg.type == 43:
+            video_file = self.get_video(msg.id, msg.extra)
+            return ChatMsg(ContentType.video, video_file) if video_file else None
+        return None
+
+    def msg_dbs(self, refresh:bool=False) -> list[str]:
+        """ 返回消息数据库分片列表 MSG0.db, MSG1.db..., 最新的分片在前. 列表缓存, refresh=True 时重新读取 """
+        if self._msg_dbs is None or refresh:
+            dbs = self.wcf.get_dbs()
+            msg_dbs = [db for db in dbs if re.fullmatch(r"MSG\d+\.db", db)]
+            msg_dbs.sort(key=lambda db: int(db[3:-3]), reverse=True)
+            self._msg_dbs = msg_dbs
+            self._msg_dbs_time = time.time()
+        return self._msg_dbs
+
+    def _index_msg(self, svrid:int, db:str):
+        """ 记录消息所在的数据库分片, 超过上限时删除最早的记录 """
+        with self._index_lock:     # 接收线程和工作线程都会写入
+            index = self._svrid_index
+            index[svrid] = db
+            index.move_to_end(svrid)
+            if len(index) > self.SVRID_INDEX_SIZE:
+                index.popitem(last=False)
+
     def get_msg_from_db(self, msgid:str) -> dict:
-        """ 从数据库查找 msgid 的信息,返回dict. 找不到则返回 None"""
-        dbs = self.wcf.get_dbs()
-        # find all strings from dbs like "MSG#.db" where # is a single digit number
-        msg_dbs = [db for db in dbs if re.match(r"MSG\d\.db", db)]
-        query = f"SELECT * FROM MSG WHERE MsgSvrID={msgid}"
-        for db in msg_dbs:
-            msg_data = self.wcf.query_sql(db, query)
+        """ 从数据库查找 msgid (MsgSvrID) 的信息, 返回dict (只含 BytesExtra). 找不到则返回 None
+        先查索引中记录的分片, 再从最新的分片开始依次查找 """
+        try:
+            svrid = int(msgid)     # query_sql 不支持参数绑定, 验证为整数后再拼接SQL
+        except (TypeError, ValueError):
+            common.logger().warning("无效的消息id: %s", msgid)
+            return None
+        query = f"SELECT BytesExtra FROM MSG WHERE MsgSvrID={svrid}"
+
+        def query_shards(dbs:list[str]) -> dict:
+            for db in dbs:
+                msg_data = self.wcf.query_sql(db, query)
+                if msg_data:
+                    self._index_msg(svrid, db)
+                    return msg_data[0]
+            return None
+
+        indexed = self._svrid_index.get(svrid)
+        if indexed:
+            msg_data = query_shards([indexed])
             if msg_data:
-                return msg_data[0]
-        return None
+                return msg_data
+        msg_dbs = [db for db in self.msg_dbs() if db != indexed]
+        msg_data = query_shards(msg_dbs)
+        if msg_data is None and time.time() - self._msg_dbs_time > self.MSG_DBS_TTL:
+            # 可能产生了新的分片
+            new_dbs = [db for db in self.msg_dbs(refresh=True) if db not in msg_dbs and db != indexed]
+            msg_data = query_shards(new_dbs)
+        return msg_data
 
     def get_msg_extra(self, msgid:str, sample_extra:str) -> str:
-        """ 获取历史消息的extra
+        """ 获取历史消息的extra. 先查最近消息缓存, 没有再查询数据库
 
         Args:
             msgid (str): WxMsg的id
@@ -254,28 +300,23 @@ class WcfWrapper:
         Returns:
             str: 消息extra, 若无法获取返回None
         """
+        recent = self.recent_msgs.get(msgid)
+        if recent is not None and recent.extra:
+            return recent.extra
 
         msg_data = self.get_msg_from_db(msgid)
         if not msg_data:
             return None
         bextra = msg_data.get('BytesExtra')
-
-        # 多种pattern搜索
-        patterns = [
-            b'\x08\x04\x12.(.*?)\x1a',          # 图片
-            b'\x08\x04\x12.(.*?)$',             # 文件
-            b'\x08\x04\x12.(.*?)\x1a'           # 自己发的文件
-            ]
-        match = None
-        for p in patterns:
-            match = re.compile(p).search(bextra)
-            if match:
-                break
-        if not match:
+        if not bextra:
+            return None
+        try:
+            new_extra = bytes_extra.decode(bextra).path     # 图片、视频、文件路径
+        except ValueError as e:
+            common.logger().warning("无法解析消息 BytesExtra, 消息id=%s: %s", msgid, e)
+            return None
+        if not new_extra:
             return None
-
-        extra = match.group(1)
-        new_extra:str = extra.decode('utf-8')
         # 拼接new_extra和sample_extra获得文件路径
         keyword = "FileStorage"
         # 获取sample_extra keyword之前的部分
@@ -294,12 +335,21 @@ class WcfWrapper:
 
     def downloaded_image(self, main_name:str) -> str:
         """ 如果图片已经下载，返回路径。否则返回 None"""
+        return common.find_temp_file(main_name)
 
-        tmp = common.get_path(common.TEMP_DIR)
-        for file in tmp.iterdir():
-            if file.is_file() and file.name.startswith(f"{main_name}."):
-                return file
-        return None
+    def decode_local_image(self, extra:str) -> str:
+        """ 解码 extra 指向的本地 .dat 图片文件, 保存到临时文件夹. 失败返回 None """
+        dat_file = image_dat.dat_path(extra)
+        if not dat_file:
+            return None
+        try:
+            dl_file = image_dat.decode_dat(dat_file, common.temp_dir())
+        except Exception as e:
+            common.logger().warning("解码图片文件失败 %s: %s", dat_file, common.error_trace(e))
+            return None
+        if dl_file:
+            common.register_temp_file(dl_file)
+        return dl_file
 
     def get_image(self, msgid:str, extra:str) -> str:
         """ 下载图片。若已经下载，直接返回已经存在的文件。
@@ -325,12 +375,32 @@ class WcfWrapper:
         if dl_file:
             return dl_file
 
-        # 若不存在，调用wcf下载图片
+        # 若不存在, 先尝试直接解码本地的 .dat 文件
+        dl_file = self.decode_local_image(extra)
+        if dl_file:
+            return dl_file
+
+        # 本地没有原图或无法解码，调用wcf下载图片
         dl_file = self.wcf.download_image(msgid, extra, common.temp_dir())
         if dl_file:
+            common.register_temp_file(dl_file)
             return dl_file
         return None
 
+    def get_audio(self, msgid:str) -> str:
+        """ 下载语音消息, 已预取时直接返回预取的文件. 失败返回空字符串 """
+        if self.prefetcher.enabled:
+            prefetched = self.prefetcher.get(int(msgid))
+            if prefetched:
+                return prefetched.content
+        return self._download_audio(msgid)
+
+    def _download_audio(self, msgid:str) -> str:
+        """ 调用wcf下载语音消息 """
+        audio_file = self.wcf.get_audio_msg(msgid, common.temp_dir())
+        common.register_temp_file(audio_file)
+        return audio_file
+
     def get_video(self, msgid:str, extra:str) -> str:
         """ 下载消息附件（视频、文件）
         Args:
@@ -347,7 +417,7 @@ class WcfWrapper:
             else:
                 pass
         else:
-            filename = common.temp_file(f"Wechat_video_{common.timestamp()}.mp4")
+            filename = common.unique_temp_file("Wechat_video", ".mp4")
 
         # 需要重新下载
         res = self.wcf.download_attach(msgid, filename, "")
@@ -374,6 +444,21 @@ class WcfWrapper:
         else:
             return 99
 
+    def queue_message(self, chat_msg:ChatMsg, receiver:str, at_list:str=""):
+        """ 把消息加入发送队列, 不等待发送完成. 参数同 send_message
+        图片/文件等在发送完成前不会被临时文件清理删除 """
+        if chat_msg.type in (ContentType.image, ContentType.file, ContentType.voice, ContentType.video):
+            files = [chat_msg.content]
+            common.temp_storage().pin(files)
+            self.sender.submit(receiver, self.send_message, chat_msg, receiver, at_list,
+                on_done=lambda result: common.temp_storage().unpin(files))
+        else:
+            self.sender.submit(receiver, self.send_message, chat_msg, receiver, at_list)
+
+    def queue_text(self, msg:str, receiver:str, at_list:str=""):
+        """ 把文字消息加入发送队列, 不等待发送完成. 参数同 send_text """
+        self.sender.submit(receiver, self.send_text, msg, receiver, at_list)
+
     # def send_message(self, tp:ContentType, payload:str, receiver:str, at_list:str="") -> int:
     #     """ Universal 通过微信发送各种类型消息
     #     Args:
@@ -410,7 +495,7 @@ class WcfWrapper:
                 wxids = at_list.split(",")
                 for wxid in wxids:
                     # 根据 wxid 查找群昵称
-                    at_str += f" @{self.wcf.get_alias_in_chatroom(wxid, receiver)}"
+                    at_str += f" @{self.room_members.alias(receiver, wxid)}"
 
         # 发送消息
         if at_str == "":
@@ -423,14 +508,12 @@ class WcfWrapper:
     def send_image(self, file:str, receiver:str) -> int:
         """ 微信发送图片 """
         common.logger().info("发送图片给%s(%s): %s", receiver, self.wxid_to_nickname(receiver), file)
-        with self.wcf_lock:
-            return self.wcf.send_image(file, receiver)
+        return self.wcf.send_image(file, receiver)
 
     def send_file(self, file:str, receiver:str) -> int:
         """ 微信发送文件"""
         common.logger().info("发送文件给%s(%s): %s", receiver, self.wxid_to_nickname(receiver), file)
-        with self.wcf_lock:
-            return self.wcf.send_file(file, receiver)
+        return self.wcf.send_file(file, receiver)
 
     def send_test_msg(self, receiver:str) -> int:
         """ 发送测试卡片消息 """